@@ -0,0 +1,150 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the memory and throughput options of `TimesFMFinetuner` on CPU.
+
+Each option runs in a fresh process, so that its peak resident memory is not
+shadowed by the previous ones.
+"""
+
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Any
+
+from absl import flags
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from finetuning.finetuning_torch import FinetuningConfig, TimesFMFinetuner
+from timesfm.pytorch_patched_decoder import PatchedTimeSeriesDecoder, TimesFMConfig
+
+_NUM_LAYERS = flags.DEFINE_integer(
+    "num_layers", 4, "Number of transformer layers, 50 for the 500m model.")
+_HIDDEN_SIZE = flags.DEFINE_integer("hidden_size", 1280,
+                                    "Hidden size of the transformer.")
+_CONTEXT_LEN = flags.DEFINE_integer("context_len", 512, "Context length.")
+_BATCH_SIZE = flags.DEFINE_integer(
+    "batch_size", 32, "Effective batch size of an optimizer step.")
+_ACCUMULATION_STEPS = flags.DEFINE_integer(
+    "accumulation_steps", 4,
+    "Micro-batches per step of the options with gradient accumulation.")
+_NUM_STEPS = flags.DEFINE_integer("num_steps", 4,
+                                  "Timed optimizer steps after a warm-up step.")
+_NUM_THREADS = flags.DEFINE_integer(
+    "num_threads", 0, "Number of torch threads, 0 for the torch default.")
+_OPTIONS = flags.DEFINE_list(
+    "options", ["fp32", "bf16", "accumulation", "checkpointing", "all"],
+    "Options to benchmark, among fp32 (the baseline), bf16, accumulation,"
+    " checkpointing and all.")
+
+_CONFIGS = {
+    "fp32": {},
+    "bf16": {"use_bf16_autocast": True},
+    "accumulation": {"gradient_accumulation_steps": None},
+    "checkpointing": {"use_activation_checkpointing": True},
+    "all": {
+        "use_bf16_autocast": True,
+        "gradient_accumulation_steps": None,
+        "use_activation_checkpointing": True,
+    },
+}
+
+
+def _peak_rss_mb() -> float:
+  # Kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_option(option: str, params: dict[str, Any]) -> dict[str, Any]:
+  """Trains `num_steps + 1` optimizer steps with `option` and measures them."""
+  if params["num_threads"]:
+    torch.set_num_threads(params["num_threads"])
+  torch.manual_seed(0)
+  kwargs = dict(_CONFIGS[option])
+  if "gradient_accumulation_steps" in kwargs:
+    kwargs["gradient_accumulation_steps"] = params["accumulation_steps"]
+  accumulation_steps = kwargs.get("gradient_accumulation_steps", 1)
+  config = FinetuningConfig(
+      batch_size=params["batch_size"] // accumulation_steps,
+      device="cpu",
+      **kwargs,
+  )
+  tfm_config = TimesFMConfig(
+      num_layers=params["num_layers"],
+      hidden_size=params["hidden_size"],
+      intermediate_size=params["hidden_size"],
+      head_dim=params["hidden_size"] // 16,
+  )
+  model = PatchedTimeSeriesDecoder(tfm_config)
+  finetuner = TimesFMFinetuner(model, config)
+  for module in model.modules():
+    if hasattr(module, "gradient_checkpointing"):
+      module.gradient_checkpointing = config.use_activation_checkpointing
+  optimizer = torch.optim.Adam(model.parameters(), lr=config.learning_rate)
+
+  def loader(num_steps):
+    num_samples = num_steps * params["batch_size"]
+    context = torch.randn(num_samples, params["context_len"])
+    dataset = TensorDataset(
+        context,
+        torch.zeros_like(context),
+        torch.zeros(num_samples, 1, dtype=torch.long),
+        torch.randn(num_samples, tfm_config.horizon_len),
+    )
+    return DataLoader(dataset, batch_size=config.batch_size)
+
+  model_rss_mb = _peak_rss_mb()
+  finetuner._train_epoch(loader(1), optimizer)  # pylint: disable=protected-access
+  start = time.perf_counter()
+  loss = finetuner._train_epoch(loader(params["num_steps"]), optimizer)  # pylint: disable=protected-access
+  seconds = time.perf_counter() - start
+  return {
+      "option": option,
+      "micro_batch_size": config.batch_size,
+      "accumulation_steps": accumulation_steps,
+      "num_parameters": sum(p.numel() for p in model.parameters()),
+      "step_seconds": seconds / params["num_steps"],
+      "samples_per_second": params["num_steps"] * params["batch_size"] / seconds,
+      "model_rss_mb": model_rss_mb,
+      "peak_rss_mb": _peak_rss_mb(),
+      "loss": loss,
+  }
+
+
+def main():
+  params = {
+      "num_layers": _NUM_LAYERS.value,
+      "hidden_size": _HIDDEN_SIZE.value,
+      "context_len": _CONTEXT_LEN.value,
+      "batch_size": _BATCH_SIZE.value,
+      "accumulation_steps": _ACCUMULATION_STEPS.value,
+      "num_steps": _NUM_STEPS.value,
+      "num_threads": _NUM_THREADS.value,
+  }
+  results = []
+  context = multiprocessing.get_context("spawn")
+  for option in _OPTIONS.value:
+    with context.Pool(1) as pool:
+      result = pool.apply(run_option, (option, params))
+    print(json.dumps(result), flush=True)
+    results.append(result)
+  return results
+
+
+if __name__ == "__main__":
+  FLAGS = flags.FLAGS
+  FLAGS(sys.argv)
+  main()
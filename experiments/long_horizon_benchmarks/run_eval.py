@@ -165,8 +165,7 @@ def eval():
       holiday=False,
       permute=False,
   )
-  eval_itr = dtl.tf_dataset(mode="test",
-                            shift=_PRED_LEN.value).as_numpy_iterator()
+  eval_itr = dtl.sampler(mode="test", shift=_PRED_LEN.value)
   model_path = _MODEL_PATH.value
   if model_path.startswith("amazon"):
     model = chronos.ChronosPipeline.from_pretrained(
@@ -0,0 +1,145 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the in-context regression solvers on synthetic covariates."""
+
+import json
+import sys
+import time
+from typing import Any
+
+from absl import flags
+import numpy as np
+from timesfm import xreg_lib
+
+_NUM_SERIES = flags.DEFINE_integer("num_series", 256,
+                                   "Number of time series in the batch.")
+_CONTEXT_LEN = flags.DEFINE_integer("context_len", 512,
+                                    "Length of the in-context (train) part.")
+_HORIZON_LEN = flags.DEFINE_integer("horizon_len", 128,
+                                    "Length of the horizon (test) part.")
+_NUM_NUMERICAL = flags.DEFINE_integer("num_numerical", 8,
+                                      "Number of dynamic numerical covariates.")
+_CARDINALITIES = flags.DEFINE_list(
+    "cardinalities", ["7", "24", "64"],
+    "Cardinalities of the dynamic categorical covariates. The design width is"
+    " roughly the sum of these plus `num_numerical`.")
+_RIDGE = flags.DEFINE_list("ridge", ["0.0", "1.0"], "Ridge penalties to test.")
+_SOLVERS = flags.DEFINE_list("solvers",
+                             ["pinv", "cholesky", "qr", "lstsq", "cg", "auto"],
+                             "Solvers to benchmark.")
+_BACKEND = flags.DEFINE_enum("backend", "numpy", ["numpy", "jax", "torch"],
+                             "Backend of the dense solvers.")
+_SPARSE = flags.DEFINE_bool("sparse", False,
+                            "Whether to benchmark the sparse (CSR) path.")
+_NUM_RUNS = flags.DEFINE_integer("num_runs", 3,
+                                 "Timed runs per solver after a warm-up run.")
+_SEED = flags.DEFINE_integer("seed", 0, "Random seed.")
+
+
+def make_xreg() -> xreg_lib.BatchedInContextXRegLinear:
+  """Builds a batch with weekly / daily style categorical covariates."""
+  rng = np.random.default_rng(_SEED.value)
+  total_len = _CONTEXT_LEN.value + _HORIZON_LEN.value
+  numerical = {
+      f"num_{i}": [rng.normal(size=total_len) for _ in range(_NUM_SERIES.value)]
+      for i in range(_NUM_NUMERICAL.value)
+  }
+  categorical = {
+      f"cat_{i}": [
+          rng.integers(0, int(card), size=total_len)
+          for _ in range(_NUM_SERIES.value)
+      ] for i, card in enumerate(_CARDINALITIES.value)
+  }
+  split = lambda covs, sl: {k: [v[sl] for v in vs] for k, vs in covs.items()}
+  train, test = slice(0, _CONTEXT_LEN.value), slice(_CONTEXT_LEN.value, None)
+  return xreg_lib.BatchedInContextXRegLinear(
+      targets=[
+          rng.normal(size=_CONTEXT_LEN.value) for _ in range(_NUM_SERIES.value)
+      ],
+      train_lens=[_CONTEXT_LEN.value] * _NUM_SERIES.value,
+      test_lens=[_HORIZON_LEN.value] * _NUM_SERIES.value,
+      train_dynamic_numerical_covariates=split(numerical, train),
+      test_dynamic_numerical_covariates=split(numerical, test),
+      train_dynamic_categorical_covariates=split(categorical, train),
+      test_dynamic_categorical_covariates=split(categorical, test),
+  )
+
+
+def _time(fn, num_runs: int) -> tuple[float, float, Any]:
+  start = time.perf_counter()
+  out = fn()  # Warm-up, includes compilation for "jax".
+  first_call_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  for _ in range(num_runs):
+    out = fn()
+  return first_call_seconds, (time.perf_counter() - start) / num_runs, out
+
+
+def main():
+  xreg = make_xreg()
+  results = []
+  for ridge in map(float, _RIDGE.value):
+    drop = None if ridge > 0 else "first"
+    flat_targets, x_train, _ = xreg.create_covariate_matrix(
+        one_hot_encoder_drop=drop, sparse_output=_SPARSE.value)
+    num_cols = x_train.shape[1]
+    if _SPARSE.value:
+      solve = lambda solver: xreg_lib._solve_sparse(  # pylint: disable=protected-access
+          x_train, flat_targets, ridge, solver)
+    elif _BACKEND.value == "jax":
+      from timesfm import xreg_jax  # pylint: disable=g-import-not-at-top
+      x_train = xreg_jax.to_padded_array(x_train)
+      flat_targets = xreg_jax.to_padded_array(flat_targets)
+      solve = lambda solver: xreg_jax.solve(x_train, flat_targets, ridge,
+                                            num_cols, solver).block_until_ready()
+    else:
+      x_train = xreg_lib._to_backend(_BACKEND.value, False, x_train)  # pylint: disable=protected-access
+      flat_targets = xreg_lib._to_backend(_BACKEND.value, False, flat_targets)  # pylint: disable=protected-access
+      solve = lambda solver: xreg_lib._solve_dense(  # pylint: disable=protected-access
+          x_train, flat_targets, ridge, solver)
+    reference = None
+    for solver in _SOLVERS.value:
+      first_solve_seconds, solve_seconds, _ = _time(lambda: solve(solver),
+                                                    _NUM_RUNS.value)
+      _, fit_seconds, outputs = _time(
+          lambda: xreg.fit(ridge=ridge,
+                           one_hot_encoder_drop=drop,
+                           solver=solver,
+                           sparse_design=_SPARSE.value,
+                           backend=_BACKEND.value),
+          _NUM_RUNS.value,
+      )
+      outputs = np.concatenate(outputs)
+      if reference is None:
+        reference = outputs
+      result = {
+          "ridge": ridge,
+          "num_rows": int(sum(xreg.train_lens)),
+          "num_cols": num_cols,
+          "solver": solver,
+          "backend": _BACKEND.value,
+          "first_solve_seconds": first_solve_seconds,
+          "solve_seconds": solve_seconds,
+          "fit_seconds": fit_seconds,
+          "max_abs_diff": float(np.max(np.abs(outputs - reference))),
+      }
+      print(json.dumps(result), flush=True)
+      results.append(result)
+  return results
+
+
+if __name__ == "__main__":
+  FLAGS = flags.FLAGS
+  FLAGS(sys.argv)
+  main()
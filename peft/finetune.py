@@ -183,10 +183,10 @@ def finetune(
         permute=False,
     )
 
-    train_batches = dtl.tf_dataset(mode="train", shift=1).batch(batch_size)
-    val_batches = dtl.tf_dataset(mode="val", shift=horizon_len)
+    train_batches = dtl.sampler(mode="train", shift=1, batch_size=batch_size)
+    val_batches = dtl.sampler(mode="val", shift=horizon_len)
 
-    for tbatch in tqdm(train_batches.as_numpy_iterator()):
+    for tbatch in tqdm(train_batches):
         pass
 
     tfm = TimesFm(
@@ -335,9 +335,8 @@ def finetune(
             print("Early stopping.")
             break
         print(f"Epoch: {epoch + 1}")
-        train_its = train_batches.as_numpy_iterator()
         train_losses = []
-        for batch in tqdm(train_its):
+        for batch in tqdm(train_batches):
             tbatch = process_train_batch(batch)
             tbatch = reshape_batch_for_pmap(tbatch, num_devices)
             replicated_jax_states, step_fun_out = p_train_step(
@@ -349,9 +348,8 @@ def finetune(
         avg_train_loss = np.mean(train_losses)
 
         print("Starting eval.")
-        val_its = val_batches.as_numpy_iterator()
         eval_losses = []
-        for ev_batch in tqdm(val_its):
+        for ev_batch in tqdm(val_batches):
             ebatch = process_eval_batch(ev_batch)
             ebatch = reshape_batch_for_pmap(ebatch, num_devices)
             _, step_fun_out = p_eval_step(replicated_jax_states, eval_prng_seed, ebatch)
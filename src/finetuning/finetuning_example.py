@@ -8,16 +8,14 @@ For multiple GPUs:
 python script.py --training_mode=multi --gpu_ids=0,1,2
 """
 
-import os
 from dataclasses import asdict
 from os import path
-from typing import Optional, Tuple
+from typing import List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import torch
 import torch.multiprocessing as mp
-import yfinance as yf
 from absl import app, flags
 from huggingface_hub import snapshot_download
 from safetensors.torch import load_file
@@ -27,6 +25,7 @@ from finetuning.finetuning_torch import FinetuningConfig, TimesFMFinetuner
 from timesfm import TimesFm, TimesFmCheckpoint, TimesFmHparams
 from timesfm.pytorch_patched_decoder import (PatchedTimeSeriesDecoder,
                                              TimesFMConfig)
+from timesfm.xreg_lib import RaggedArray
 
 FLAGS = flags.FLAGS
 
@@ -49,10 +48,15 @@ flags.DEFINE_string(
 )
 
 class TimeSeriesDataset(Dataset):
-  """Dataset for time series data compatible with TimesFM."""
+  """Dataset for time series data compatible with TimesFM.
+
+  Only the series and an index of (series, start) pairs are stored, and the
+  windows are sliced on demand. Several series are stored as one buffer of
+  concatenated values, which can be memory-mapped.
+  """
 
   def __init__(self,
-               series: np.ndarray,
+               series: Union[np.ndarray, Sequence[np.ndarray], RaggedArray],
                context_length: int,
                horizon_length: int,
                freq_type: int = 0):
@@ -60,7 +64,9 @@ class TimeSeriesDataset(Dataset):
         Initialize dataset.
 
         Args:
-            series: Time series data
+            series: Time series data, with time on the first axis. Several
+              series are given as a list of arrays or as a `RaggedArray`, e.g.
+              of memory-mapped float32 values, which are then not copied.
             context_length: Number of past timesteps to use as input
             horizon_length: Number of future timesteps to predict
             freq_type: Frequency type (0, 1, or 2)
@@ -68,38 +74,62 @@ class TimeSeriesDataset(Dataset):
     if freq_type not in [0, 1, 2]:
       raise ValueError("freq_type must be 0, 1, or 2")
 
+    if isinstance(series, np.ndarray):
+      values, offsets = series, np.array([0, len(series)])
+    else:
+      if not isinstance(series, RaggedArray):
+        series = RaggedArray.from_sequences(series)
+      values, offsets = series.values, series.offsets
     self.series = series
     self.context_length = context_length
     self.horizon_length = horizon_length
     self.freq_type = freq_type
+    self._values = np.asarray(values, dtype=np.float32)
+    self._offsets = np.asarray(offsets)
+    self._freq = torch.tensor([self.freq_type], dtype=torch.long)
     self._prepare_samples()
 
   def _prepare_samples(self) -> None:
-    """Prepare sliding window samples from the time series."""
-    self.samples = []
+    """Prepare the (series, start) index of the sliding window samples."""
     total_length = self.context_length + self.horizon_length
-
-    for start_idx in range(0, len(self.series) - total_length + 1):
-      end_idx = start_idx + self.context_length
-      x_context = self.series[start_idx:end_idx]
-      x_future = self.series[end_idx:end_idx + self.horizon_length]
-      self.samples.append((x_context, x_future))
+    num_windows = np.maximum(
+        np.diff(self._offsets) - total_length + 1, 0)
+    self.sample_series = np.repeat(np.arange(len(num_windows)), num_windows)
+    self.sample_starts = (np.arange(num_windows.sum()) -
+                          np.repeat(np.cumsum(num_windows) - num_windows,
+                                    num_windows))
+    # Positions of the windows in the values buffer.
+    self._positions = self._offsets[self.sample_series] + self.sample_starts
 
   def __len__(self) -> int:
-    return len(self.samples)
+    return len(self._positions)
+
+  def _sample(
+      self, window: torch.Tensor
+  ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    x_context = window[:self.context_length]
+    x_future = window[self.context_length:]
+    return x_context, torch.zeros_like(x_context), self._freq, x_future
 
   def __getitem__(
       self, index: int
   ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
-    x_context, x_future = self.samples[index]
-
-    x_context = torch.tensor(x_context, dtype=torch.float32)
-    x_future = torch.tensor(x_future, dtype=torch.float32)
-
-    input_padding = torch.zeros_like(x_context)
-    freq = torch.tensor([self.freq_type], dtype=torch.long)
-
-    return x_context, input_padding, freq, x_future
+    position = self._positions[index]
+    window = self._values[position:position + self.context_length +
+                          self.horizon_length]
+    # Read-only buffers, e.g. memory-mapped ones, cannot back a tensor.
+    if not window.flags.writeable:
+      window = window.copy()
+    return self._sample(torch.from_numpy(window))
+
+  def __getitems__(
+      self, indices: Sequence[int]
+  ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """Gathers the windows of a batch at once, for the `DataLoader`."""
+    steps = np.arange(self.context_length + self.horizon_length)
+    windows = torch.from_numpy(
+        self._values[self._positions[indices][:, None] + steps])
+    return [self._sample(window) for window in windows]
 
 
 def prepare_datasets(series: np.ndarray,
@@ -248,6 +278,8 @@ def plot_predictions(
 def get_data(context_len: int,
              horizon_len: int,
              freq_type: int = 0) -> Tuple[Dataset, Dataset]:
+  import yfinance as yf
+
   df = yf.download("AAPL", start="2010-01-01", end="2019-01-01")
   time_series = df["Close"].values
 
@@ -304,13 +336,7 @@ def setup_process(rank, world_size, model, config, train_dataset, val_dataset,
     if torch.cuda.is_available():
       torch.cuda.set_device(rank)
 
-    os.environ["MASTER_ADDR"] = config.master_addr
-    os.environ["MASTER_PORT"] = config.master_port
-    if not torch.distributed.is_initialized():
-      torch.distributed.init_process_group(backend="nccl",
-                                           world_size=world_size,
-                                           rank=rank)
-
+    # The finetuner joins the process group, with nccl on GPU and gloo on CPU.
     finetuner = TimesFMFinetuner(model, config, rank=rank)
 
     results = finetuner.finetune(train_dataset=train_dataset,
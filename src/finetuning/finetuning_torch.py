@@ -2,20 +2,27 @@
 TimesFM Finetuner: A flexible framework for finetuning TimesFM models on custom datasets.
 """
 
+import contextlib
+import csv
+import json
 import logging
 import os
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 from typing import Any, Callable, Dict, List, Optional
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import torch.nn as nn
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, Dataset
-from timesfm.pytorch_patched_decoder import create_quantiles
-
-import wandb
+from torch.utils.data import DataLoader, Dataset, Subset
+from timesfm.pytorch_patched_decoder import (PatchedTimeSeriesDecoder,
+                                             StackedDecoder, create_quantiles)
+from finetuning.instrumentation import Instrumentation, StepTimer
+from finetuning.linear_probing import (FeatureCache, HorizonProbe,
+                                       cache_features, freeze_backbone)
+from finetuning.lora_torch import apply_lora
 
 
 class MetricsLogger(ABC):
@@ -53,7 +60,10 @@ class WandBLogger(MetricsLogger):
     """
 
   def __init__(self, project: str, config: Dict[str, Any], rank: int = 0):
+    import wandb  # pylint: disable=g-import-not-at-top
+
     self.rank = rank
+    self._wandb = wandb
     if rank == 0:
       wandb.init(project=project, config=config)
 
@@ -67,23 +77,81 @@ class WandBLogger(MetricsLogger):
           step: Current training step or epoch.
         """
     if self.rank == 0:
-      wandb.log(metrics, step=step)
+      self._wandb.log(metrics, step=step)
 
   def close(self) -> None:
     """Finish the W&B run if on the main process."""
     if self.rank == 0:
-      wandb.finish()
+      self._wandb.finish()
+
+
+class LocalLogger(MetricsLogger):
+  """Appends metrics to a local JSON lines or CSV file.
+
+    A JSON lines file gets one object with the step and the metrics per
+    call. As the metrics differ between calls, a CSV file gets one
+    `step,metric,value` row per metric.
+
+    Args:
+      path: Path of the file, whose extension selects the format.
+      rank: Process rank in distributed training.
+    """
+
+  def __init__(self, path: str, rank: int = 0):
+    self.rank = rank
+    self.path = path
+    extension = os.path.splitext(path)[1]
+    if extension not in (".csv", ".jsonl"):
+      raise ValueError(f"Metrics files are .jsonl or .csv files, got: {path}")
+    self._csv = extension == ".csv"
+    self._file = None
+    if rank == 0:
+      os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+      is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+      self._file = open(path, "a", newline="" if self._csv else None)
+      if self._csv:
+        self._writer = csv.writer(self._file)
+        if is_new:
+          self._writer.writerow(["step", "metric", "value"])
+
+  def log_metrics(self,
+                  metrics: Dict[str, Any],
+                  step: Optional[int] = None) -> None:
+    """Appends metrics to the file if on the main process.
+
+        Args:
+          metrics: Dictionary of metrics to log.
+          step: Current training step or epoch.
+        """
+    if self._file is None:
+      return
+    if self._csv:
+      self._writer.writerows([step, k, v] for k, v in metrics.items())
+    else:
+      self._file.write(json.dumps({"step": step, **metrics}) + "\n")
+    self._file.flush()
+
+  def close(self) -> None:
+    """Closes the file if on the main process."""
+    if self._file is not None:
+      self._file.close()
+      self._file = None
 
 
 class DistributedManager:
   """Manages distributed training setup and cleanup.
 
+    With the gloo backend, the processes train on CPU and each one is pinned
+    to its own share of the cores of the machine.
+
     Args:
       world_size: Total number of processes.
       rank: Process rank.
       master_addr: Address of the master process.
       master_port: Port for distributed communication.
       backend: PyTorch distributed backend to use.
+      num_threads: Number of cores, and torch threads, of each gloo process.
+        The available cores are split evenly between the processes if None.
     """
 
   def __init__(
@@ -93,17 +161,41 @@ class DistributedManager:
       master_addr: str = "localhost",
       master_port: str = "12358",
       backend: str = "nccl",
+      num_threads: Optional[int] = None,
   ):
     self.world_size = world_size
     self.rank = rank
     self.master_addr = master_addr
     self.master_port = master_port
     self.backend = backend
+    self.num_threads = num_threads
+
+  def _pin_threads(self) -> None:
+    """Pins this process to its cores and sizes its torch thread pool."""
+    if hasattr(os, "sched_getaffinity"):
+      cores = sorted(os.sched_getaffinity(0))
+    else:
+      cores = list(range(os.cpu_count() or 1))
+    # Processes of the same machine get disjoint, contiguous cores, and share
+    # them if there are more processes than cores. torchrun sets the local
+    # rank and size; without them, all the processes are on this machine.
+    local_rank = int(os.environ.get("LOCAL_RANK", self.rank))
+    local_world_size = int(
+        os.environ.get("LOCAL_WORLD_SIZE", self.world_size))
+    shares = np.array_split(cores, local_world_size)
+    share = shares[local_rank].tolist() or [cores[local_rank % len(cores)]]
+    if self.num_threads:
+      share = share[:self.num_threads]
+    if hasattr(os, "sched_setaffinity"):
+      os.sched_setaffinity(0, share)
+    torch.set_num_threads(len(share))
 
   def setup(self) -> None:
     """Initialize the distributed environment."""
     os.environ["MASTER_ADDR"] = self.master_addr
     os.environ["MASTER_PORT"] = self.master_port
+    if self.backend == "gloo":
+      self._pin_threads()
 
     if not dist.is_initialized():
       dist.init_process_group(backend=self.backend,
@@ -116,6 +208,17 @@ class DistributedManager:
       dist.destroy_process_group()
 
 
+# Gradient bucket size of DDP on CPU, where the DDP default of 25MB splits the
+# 500M model into ~80 gloo all-reduces per step.
+_CPU_BUCKET_CAP_MB = 100
+
+
+def _seed_worker(worker_id: int) -> None:
+  """Seeds NumPy in a DataLoader worker from its per-worker torch seed."""
+  del worker_id  # The torch seed already differs between workers.
+  np.random.seed(torch.initial_seed() % 2**32)
+
+
 @dataclass
 class FinetuningConfig:
   """Configuration for model training.
@@ -131,6 +234,10 @@ class FinetuningConfig:
       device: Device to train on ('cuda' or 'cpu').
       distributed: Whether to use distributed training.
       gpu_ids: List of GPU IDs to use.
+      world_size: Number of distributed processes, len(gpu_ids) if None. Set it to train with several processes on CPU.
+      distributed_backend: Backend of torch.distributed, "nccl" on GPU and "gloo" on CPU if None.
+      num_threads_per_process: Number of cores each CPU process is pinned to. The cores are split evenly between the local processes if None.
+      ddp_bucket_cap_mb: Size of the gradient buckets all-reduced together by DDP. If None, the DDP default on GPU and larger buckets on CPU, where gloo all-reduces are dominated by per-call latency.
       master_port: Port for distributed training.
       master_addr: Address for distributed training.
       use_wandb: Whether to use Weights & Biases logging.
@@ -139,6 +246,20 @@ class FinetuningConfig:
       val_check_interval: How often within one training epoch to check val metrics. (also from Pytorch Lightning)
         Can be: float (0.0-1.0): fraction of epoch (e.g., 0.5 = validate twice per epoch)
                 int: validate every N batches
+      num_workers: Number of DataLoader worker processes assembling batches in shared memory. 0 loads them in the training process.
+      prefetch_factor: Number of batches prefetched by each worker.
+      use_bf16_autocast: Run the forward passes under bfloat16 autocast, on CPU or GPU. The weights, gradients and losses stay in float32.
+      gradient_accumulation_steps: Number of micro-batches of `batch_size` whose gradients are accumulated before each optimizer step.
+      use_activation_checkpointing: Recompute the activations of the transformer layers in the backward pass instead of storing them.
+      use_lora: Train low rank adapters of the transformer layers only, with all the other weights frozen.
+      lora_rank: Rank of the adapters.
+      lora_target_modules: Linear layers of the transformer layers to adapt, one of [all, attention, mlp].
+      use_dora: Use DoRA adapters, which also learn the norm of the adapted weights.
+      use_linear_probing: Train only `horizon_ff_layer`, from transformer outputs computed once before the first epoch.
+      feature_cache_dir: Directory where the transformer outputs of linear probing are memory-mapped. They are kept in memory if None.
+      feature_cache_dtype: Storage dtype of the cached transformer outputs.
+      instrument_steps: Time the data loading, forward, backward and optimizer phases of the training steps, and log them with the throughput and peak memory every `log_every_n_steps` steps. On GPU, this synchronizes the device between the phases.
+      metrics_path: Local .jsonl or .csv file the metrics are appended to, in addition to W&B.
     """
 
   batch_size: int = 32
@@ -151,12 +272,30 @@ class FinetuningConfig:
   device: str = "cuda" if torch.cuda.is_available() else "cpu"
   distributed: bool = False
   gpu_ids: List[int] = field(default_factory=lambda: [0])
+  world_size: Optional[int] = None
+  distributed_backend: Optional[str] = None
+  num_threads_per_process: Optional[int] = None
+  ddp_bucket_cap_mb: Optional[int] = None
   master_port: str = "12358"
   master_addr: str = "localhost"
   use_wandb: bool = False
   wandb_project: str = "timesfm-finetuning"
   log_every_n_steps: int = 50
   val_check_interval: float = 0.5
+  num_workers: int = 0
+  prefetch_factor: int = 2
+  use_bf16_autocast: bool = False
+  gradient_accumulation_steps: int = 1
+  use_activation_checkpointing: bool = False
+  use_lora: bool = False
+  lora_rank: int = 8
+  lora_target_modules: str = "all"
+  use_dora: bool = False
+  use_linear_probing: bool = False
+  feature_cache_dir: Optional[str] = None
+  feature_cache_dtype: str = "float16"
+  instrument_steps: bool = False
+  metrics_path: Optional[str] = None
 
 
 class TimesFMFinetuner:
@@ -168,6 +307,8 @@ class TimesFMFinetuner:
       rank: Process rank for distributed training.
       loss_fn: Loss function (defaults to MSE).
       logger: Optional logging.Logger instance.
+      instrumentation: Optional instrumentation of the training steps, by
+        default a `StepTimer` if `config.instrument_steps` is set.
     """
 
   def __init__(
@@ -177,25 +318,58 @@ class TimesFMFinetuner:
       rank: int = 0,
       loss_fn: Optional[Callable] = None,
       logger: Optional[logging.Logger] = None,
+      instrumentation: Optional[Instrumentation] = None,
   ):
     self.model = model
     self.config = config
     self.rank = rank
     self.logger = logger or logging.getLogger(__name__)
-    self.device = torch.device(
-        f"cuda:{rank}" if torch.cuda.is_available() else "cpu")
+    use_cuda = config.device.startswith("cuda") and torch.cuda.is_available()
+    self.device = torch.device(f"cuda:{rank}" if use_cuda else "cpu")
     self.loss_fn = loss_fn or (lambda x, y: torch.mean((x - y.squeeze(-1))**2))
 
+    if config.gradient_accumulation_steps < 1:
+      raise ValueError("gradient_accumulation_steps must be positive, got "
+                       f"{config.gradient_accumulation_steps}.")
+    if config.use_lora and config.use_linear_probing:
+      raise ValueError("use_lora and use_linear_probing are exclusive.")
+    if config.use_lora:
+      apply_lora(self.model,
+                 config.lora_rank,
+                 target_modules=config.lora_target_modules,
+                 use_dora=config.use_dora)
+    if config.use_linear_probing:
+      freeze_backbone(self.model)
+      self.decoder = self.model
+      self.model = HorizonProbe(self.model)
+
+    decoders = [
+        m for m in self.model.modules()
+        if isinstance(m, PatchedTimeSeriesDecoder)
+    ]
+    self._patch_len = decoders[0].config.patch_len if decoders else None
+    if instrumentation is None:
+      instrumentation = (StepTimer(self.device)
+                         if config.instrument_steps else Instrumentation())
+    self.instrumentation = instrumentation
+    self.global_step = 0
+
+    self.metrics_loggers: List[MetricsLogger] = []
     if config.use_wandb:
-      self.metrics_logger = WandBLogger(config.wandb_project, config.__dict__,
-                                        rank)
+      self.metrics_loggers.append(
+          WandBLogger(config.wandb_project, config.__dict__, rank))
+    if config.metrics_path:
+      self.metrics_loggers.append(LocalLogger(config.metrics_path, rank))
 
     if config.distributed:
       self.dist_manager = DistributedManager(
-          world_size=len(config.gpu_ids),
+          world_size=config.world_size or len(config.gpu_ids),
           rank=rank,
           master_addr=config.master_addr,
           master_port=config.master_port,
+          backend=config.distributed_backend or
+          ("nccl" if use_cuda else "gloo"),
+          num_threads=config.num_threads_per_process,
       )
       self.dist_manager.setup()
       self.model = self._setup_distributed_model()
@@ -203,34 +377,57 @@ class TimesFMFinetuner:
   def _setup_distributed_model(self) -> nn.Module:
     """Configure model for distributed training."""
     self.model = self.model.to(self.device)
+    if self.device.type == "cuda":
+      kwargs = dict(device_ids=[self.config.gpu_ids[self.rank]],
+                    output_device=self.config.gpu_ids[self.rank])
+      if self.config.ddp_bucket_cap_mb:
+        kwargs["bucket_cap_mb"] = self.config.ddp_bucket_cap_mb
+      return DDP(self.model, **kwargs)
+    # On CPU, fewer all-reduce calls of larger buckets, into which the
+    # gradients are directly written.
     return DDP(self.model,
-               device_ids=[self.config.gpu_ids[self.rank]],
-               output_device=self.config.gpu_ids[self.rank])
-
-  def _create_dataloader(self, dataset: Dataset, is_train: bool) -> DataLoader:
+               bucket_cap_mb=self.config.ddp_bucket_cap_mb or
+               _CPU_BUCKET_CAP_MB,
+               gradient_as_bucket_view=True)
+
+  def _create_dataloader(self,
+                         dataset: Dataset,
+                         is_train: bool,
+                         sharded: bool = False) -> DataLoader:
     """Create appropriate DataLoader based on training configuration.
 
         Args:
           dataset: Dataset to create loader for.
           is_train: Whether this is for training (affects shuffling).
+          sharded: Whether the dataset only holds the samples of this rank.
 
         Returns:
           DataLoader instance.
         """
-    if self.config.distributed:
+    if self.config.distributed and not sharded:
       sampler = torch.utils.data.distributed.DistributedSampler(
           dataset,
-          num_replicas=len(self.config.gpu_ids),
+          num_replicas=dist.get_world_size(),
           rank=dist.get_rank(),
           shuffle=is_train)
     else:
       sampler = None
 
+    workers_kwargs = {}
+    if self.config.num_workers > 0:
+      workers_kwargs = dict(
+          prefetch_factor=self.config.prefetch_factor,
+          persistent_workers=True,
+          worker_init_fn=_seed_worker,
+      )
     return DataLoader(
         dataset,
         batch_size=self.config.batch_size,
-        shuffle=(is_train and not self.config.distributed),
+        shuffle=(is_train and sampler is None),
         sampler=sampler,
+        num_workers=self.config.num_workers,
+        pin_memory=self.device.type == "cuda",
+        **workers_kwargs,
     )
 
   def _quantile_loss(self, pred: torch.Tensor, actual: torch.Tensor,
@@ -257,11 +454,18 @@ class TimesFMFinetuner:
         Returns:
           Tuple of (loss, predictions).
         """
-    x_context, x_padding, freq, x_future = [
-        t.to(self.device, non_blocking=True) for t in batch
-    ]
-
-    predictions = self.model(x_context, x_padding.float(), freq)
+    *inputs, x_future = [t.to(self.device, non_blocking=True) for t in batch]
+
+    with torch.autocast(device_type=self.device.type,
+                        dtype=torch.bfloat16,
+                        enabled=self.config.use_bf16_autocast):
+      if self.config.use_linear_probing:
+        # The features, mu and sigma of a `FeatureCache`.
+        predictions = self.model(*inputs)
+      else:
+        x_context, x_padding, freq = inputs
+        predictions = self.model(x_context, x_padding.float(), freq)
+    predictions = predictions.float()
     predictions_mean = predictions[..., 0]
     last_patch_pred = predictions_mean[:, -1, :]
 
@@ -276,6 +480,19 @@ class TimesFMFinetuner:
 
     return loss, predictions
 
+  def _num_patches(self, batch: List[torch.Tensor]) -> Optional[int]:
+    """Returns the number of input patches of a batch, if known."""
+    if self.config.use_linear_probing:
+      return batch[0].shape[0] * batch[0].shape[1]
+    if self._patch_len is None:
+      return None
+    return batch[0].numel() // self._patch_len
+
+  def _log_metrics(self, metrics: Dict[str, Any]) -> None:
+    """Logs metrics at the current step to all the metrics loggers."""
+    for metrics_logger in self.metrics_loggers:
+      metrics_logger.log_metrics(metrics, step=self.global_step)
+
   def _train_epoch(self, train_loader: DataLoader,
                    optimizer: torch.optim.Optimizer) -> float:
     """Train for one epoch in a distributed setting.
@@ -288,19 +505,52 @@ class TimesFMFinetuner:
             Average training loss for the epoch.
         """
     self.model.train()
-    total_loss = 0.0
     num_batches = len(train_loader)
-
-    for batch in train_loader:
-      loss, _ = self._process_batch(batch)
-
-      optimizer.zero_grad()
-      loss.backward()
-      optimizer.step()
-
-      total_loss += loss.item()
-
-    avg_loss = total_loss / num_batches
+    accumulation_steps = self.config.gradient_accumulation_steps
+    instrumentation = self.instrumentation
+    # The losses are summed on the device, and only read back when logged.
+    total_loss = torch.zeros((), device=self.device)
+    interval_loss = torch.zeros((), device=self.device)
+    interval_batches = 0
+
+    optimizer.zero_grad()
+    instrumentation.reset()
+    batches = iter(train_loader)
+    for i in range(num_batches):
+      with instrumentation.phase("data"):
+        batch = next(batches)
+      # The last group of micro-batches may be shorter.
+      group_start = i - i % accumulation_steps
+      group_size = min(accumulation_steps, num_batches - group_start)
+      step = i + 1 == group_start + group_size
+      # Gradients are only all-reduced on the micro-batch of the step.
+      sync = (contextlib.nullcontext() if step or not self.config.distributed
+              else self.model.no_sync())
+      with sync:
+        with instrumentation.phase("forward"):
+          loss, _ = self._process_batch(batch)
+        with instrumentation.phase("backward"):
+          (loss / group_size).backward()
+      if step:
+        with instrumentation.phase("optimizer"):
+          optimizer.step()
+          optimizer.zero_grad()
+      instrumentation.end_step(len(batch[0]), self._num_patches(batch))
+
+      loss = loss.detach()
+      total_loss += loss
+      interval_loss += loss
+      interval_batches += 1
+      self.global_step += 1
+      if self.global_step % self.config.log_every_n_steps == 0:
+        self._log_metrics({
+            "train/loss": interval_loss.item() / interval_batches,
+            **instrumentation.summary(),
+        })
+        interval_loss.zero_()
+        interval_batches = 0
+
+    avg_loss = total_loss.item() / num_batches
 
     if self.config.distributed:
       avg_loss_tensor = torch.tensor(avg_loss, device=self.device)
@@ -319,15 +569,15 @@ class TimesFMFinetuner:
             Average validation loss.
         """
     self.model.eval()
-    total_loss = 0.0
+    total_loss = torch.zeros((), device=self.device)
     num_batches = len(val_loader)
 
     with torch.no_grad():
       for batch in val_loader:
         loss, _ = self._process_batch(batch)
-        total_loss += loss.item()
+        total_loss += loss
 
-    avg_loss = total_loss / num_batches
+    avg_loss = total_loss.item() / num_batches
 
     if self.config.distributed:
       avg_loss_tensor = torch.tensor(avg_loss, device=self.device)
@@ -336,6 +586,37 @@ class TimesFMFinetuner:
 
     return avg_loss
 
+  def _cache_features(self, dataset: Dataset, split: str) -> FeatureCache:
+    """Caches the transformer outputs of the samples of this rank.
+
+        Args:
+          dataset: Dataset of windows.
+          split: Name of the cache subdirectory.
+
+        Returns:
+          The `FeatureCache` of the samples.
+        """
+    cache_dir = None
+    if self.config.distributed:
+      # Every rank runs the backbone on its own shard once, and then shuffles
+      # within it. The shards are padded to the same number of batches.
+      shard = torch.utils.data.distributed.DistributedSampler(
+          dataset,
+          num_replicas=dist.get_world_size(),
+          rank=self.rank,
+          shuffle=False)
+      dataset = Subset(dataset, list(shard))
+      split = f"{split}_rank{self.rank}"
+    if self.config.feature_cache_dir:
+      cache_dir = os.path.join(self.config.feature_cache_dir, split)
+    return cache_features(self.decoder,
+                          dataset,
+                          batch_size=self.config.batch_size,
+                          device=self.device,
+                          cache_dir=cache_dir,
+                          dtype=np.dtype(self.config.feature_cache_dtype),
+                          use_bf16_autocast=self.config.use_bf16_autocast)
+
   def finetune(self, train_dataset: Dataset,
                val_dataset: Dataset) -> Dict[str, Any]:
     """Train the model.
@@ -348,10 +629,23 @@ class TimesFMFinetuner:
           Dictionary containing training history.
         """
     self.model = self.model.to(self.device)
-    train_loader = self._create_dataloader(train_dataset, is_train=True)
-    val_loader = self._create_dataloader(val_dataset, is_train=False)
-
-    optimizer = torch.optim.Adam(self.model.parameters(),
+    for module in self.model.modules():
+      if isinstance(module, StackedDecoder):
+        module.gradient_checkpointing = self.config.use_activation_checkpointing
+    if self.config.use_linear_probing:
+      train_dataset = self._cache_features(train_dataset, "train")
+      val_dataset = self._cache_features(val_dataset, "val")
+    sharded = self.config.use_linear_probing
+    train_loader = self._create_dataloader(train_dataset,
+                                           is_train=True,
+                                           sharded=sharded)
+    val_loader = self._create_dataloader(val_dataset,
+                                         is_train=False,
+                                         sharded=sharded)
+
+    # Frozen weights get no optimizer state.
+    params = [p for p in self.model.parameters() if p.requires_grad]
+    optimizer = torch.optim.Adam(params,
                                  lr=self.config.learning_rate,
                                  weight_decay=self.config.weight_decay)
 
@@ -375,8 +669,7 @@ class TimesFMFinetuner:
             "epoch": epoch + 1,
         }
 
-        if self.config.use_wandb:
-          self.metrics_logger.log_metrics(metrics)
+        self._log_metrics(metrics)
 
         history["train_loss"].append(train_loss)
         history["val_loss"].append(val_loss)
@@ -393,7 +686,7 @@ class TimesFMFinetuner:
     if self.config.distributed:
       self.dist_manager.cleanup()
 
-    if self.config.use_wandb:
-      self.metrics_logger.close()
+    for metrics_logger in self.metrics_loggers:
+      metrics_logger.close()
 
     return {"history": history}
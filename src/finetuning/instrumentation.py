@@ -0,0 +1,116 @@
+"""
+Instrumentation of the training steps of TimesFMFinetuner.
+
+The finetuner reports the phases of every step (data, forward, backward,
+optimizer) and the size of its batch to an `Instrumentation`, and logs its
+`summary` every `log_every_n_steps` steps. The base class records nothing;
+`StepTimer` records where the time of the steps goes.
+"""
+
+import contextlib
+import sys
+import time
+from collections import defaultdict
+from typing import ContextManager, Dict, Optional
+
+import torch
+
+try:
+  import resource  # pylint: disable=g-import-not-at-top
+except ImportError:  # Not available on Windows.
+  resource = None
+
+PHASES = ("data", "forward", "backward", "optimizer")
+
+
+class Instrumentation:
+  """Interface of the step instrumentation, which does nothing."""
+
+  def reset(self) -> None:
+    """Starts a new interval of steps."""
+
+  def phase(self, name: str) -> ContextManager[None]:
+    """Returns a context manager around one of the `PHASES` of a step."""
+    del name
+    return contextlib.nullcontext()
+
+  def end_step(self, num_samples: int, num_tokens: Optional[int]) -> None:
+    """Records the end of a step over `num_samples` windows.
+
+        Args:
+          num_samples: Number of windows of the batch.
+          num_tokens: Number of patches of the batch, if known.
+        """
+
+  def summary(self) -> Dict[str, float]:
+    """Returns the metrics of the steps since the last `reset` and resets."""
+    return {}
+
+
+class StepTimer(Instrumentation):
+  """Times the phases of the training steps.
+
+    CUDA kernels run asynchronously, so on GPU every phase synchronizes the
+    device for its time to be its own, which costs some throughput.
+
+    Args:
+      device: Device of the training.
+    """
+
+  def __init__(self, device: torch.device):
+    self.device = device
+    self._synchronize = device.type == "cuda"
+    self.reset()
+
+  def reset(self) -> None:
+    self._phase_times = defaultdict(float)
+    self._num_steps = 0
+    self._num_samples = 0
+    self._num_tokens = 0
+    if self._synchronize:
+      torch.cuda.reset_peak_memory_stats(self.device)
+    self._start = time.perf_counter()
+
+  @contextlib.contextmanager
+  def phase(self, name: str):
+    if self._synchronize:
+      torch.cuda.synchronize(self.device)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      if self._synchronize:
+        torch.cuda.synchronize(self.device)
+      self._phase_times[name] += time.perf_counter() - start
+
+  def end_step(self, num_samples: int, num_tokens: Optional[int]) -> None:
+    self._num_steps += 1
+    self._num_samples += num_samples
+    if num_tokens is not None:
+      self._num_tokens += num_tokens
+
+  def _peak_memory_mb(self) -> Optional[float]:
+    """Peak allocated GPU memory, or peak resident memory of the process."""
+    if self._synchronize:
+      return torch.cuda.max_memory_allocated(self.device) / 2**20
+    if resource is None:
+      return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return max_rss / (2**20 if sys.platform == "darwin" else 2**10)
+
+  def summary(self) -> Dict[str, float]:
+    elapsed = time.perf_counter() - self._start
+    metrics = {}
+    if self._num_steps:
+      for name in PHASES:
+        metrics[f"time/{name}_ms"] = (1000 * self._phase_times[name] /
+                                      self._num_steps)
+      metrics["throughput/samples_per_sec"] = self._num_samples / elapsed
+      if self._num_tokens:
+        metrics["throughput/patches_per_sec"] = self._num_tokens / elapsed
+    peak_memory = self._peak_memory_mb()
+    if peak_memory is not None:
+      metrics["memory/peak_mb"] = peak_memory
+    self.reset()
+    return metrics
@@ -0,0 +1,167 @@
+"""
+Linear probing of TimesFM from cached backbone features.
+
+With everything but `horizon_ff_layer` frozen, the transformer outputs of a
+window never change during finetuning. They are computed once by
+`cache_features`, optionally into memory-mapped files, and the output block
+is then trained for any number of epochs from the `FeatureCache` only.
+"""
+
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+from timesfm.pytorch_patched_decoder import PatchedTimeSeriesDecoder
+
+_ARRAYS = ("features", "mu", "sigma", "x_future")
+
+
+class FeatureCache(Dataset):
+  """Cached transformer outputs of a dataset of windows.
+
+    The samples are (features, mu, sigma, x_future), where features are the
+    N x D per-patch outputs of the stacked transformer and mu, sigma the
+    statistics used to normalize the context.
+
+    Args:
+      features: Array of shape [num_samples, N, D], e.g. memory-mapped float16.
+      mu: Array of shape [num_samples].
+      sigma: Array of shape [num_samples].
+      x_future: Array of shape [num_samples, horizon_length].
+    """
+
+  def __init__(self, features: np.ndarray, mu: np.ndarray, sigma: np.ndarray,
+               x_future: np.ndarray):
+    self.features = features
+    self.mu = mu
+    self.sigma = sigma
+    self.x_future = x_future
+
+  @classmethod
+  def load(cls, cache_dir: str) -> "FeatureCache":
+    """Memory-maps a cache written by `cache_features`."""
+    return cls(*[
+        np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r")
+        for name in _ARRAYS
+    ])
+
+  def __len__(self) -> int:
+    return len(self.features)
+
+  def __getitem__(
+      self, index: int
+  ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    return self.__getitems__([index])[0]
+
+  def __getitems__(
+      self, indices: Sequence[int]
+  ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """Gathers the samples of a batch at once, for the `DataLoader`."""
+    indices = np.asarray(indices)
+    # The fancy indexing copies, also out of read-only memory maps.
+    arrays = [
+        torch.from_numpy(np.asarray(x[indices], dtype=np.float32))
+        for x in (self.features, self.mu, self.sigma, self.x_future)
+    ]
+    return list(zip(*arrays))
+
+
+class HorizonProbe(nn.Module):
+  """The output block of a decoder, applied to cached features.
+
+    The decoder is kept as a submodule, so that the trained `horizon_ff_layer`
+    is the one of the decoder.
+
+    Args:
+      decoder: The decoder to probe.
+    """
+
+  def __init__(self, decoder: PatchedTimeSeriesDecoder):
+    super().__init__()
+    self.decoder = decoder
+
+  def forward(self, features: torch.Tensor, mu: torch.Tensor,
+              sigma: torch.Tensor) -> torch.Tensor:
+    num_outputs = len(self.decoder.config.quantiles) + 1
+    return self.decoder._postprocess_output(features, num_outputs, (mu, sigma))
+
+
+def freeze_backbone(model: PatchedTimeSeriesDecoder) -> None:
+  """Freezes all the parameters of `model` but the `horizon_ff_layer` ones."""
+  model.requires_grad_(False)
+  model.horizon_ff_layer.requires_grad_(True)
+
+
+def cache_features(model: PatchedTimeSeriesDecoder,
+                   dataset: Dataset,
+                   batch_size: int = 256,
+                   device: Optional[torch.device] = None,
+                   cache_dir: Optional[str] = None,
+                   dtype: np.dtype = np.float16,
+                   use_bf16_autocast: bool = False) -> FeatureCache:
+  """Runs the backbone of `model` once over a dataset of windows.
+
+    Args:
+      model: The decoder whose transformer outputs are cached.
+      dataset: Dataset of (x_context, x_padding, freq, x_future) samples.
+      batch_size: Batch size of the forward passes.
+      device: Device of the forward passes, by default the one of `model`.
+      cache_dir: If given, the features are written to `.npy` files in this
+        directory and memory-mapped, and can be reloaded with
+        `FeatureCache.load`. They are kept in memory otherwise.
+      dtype: Storage dtype of the features. The statistics and targets are
+        stored as float32.
+      use_bf16_autocast: Run the forward passes under bfloat16 autocast.
+
+    Returns:
+      The `FeatureCache` of the dataset, in the same order.
+    """
+  device = device or next(model.parameters()).device
+  loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+  if cache_dir:
+    os.makedirs(cache_dir, exist_ok=True)
+
+  arrays = None
+  position = 0
+  model.eval()
+  with torch.no_grad():
+    for x_context, x_padding, freq, x_future in loader:
+      with torch.autocast(device_type=device.type,
+                          dtype=torch.bfloat16,
+                          enabled=use_bf16_autocast):
+        features, (mu, sigma) = model.encode(x_context.to(device),
+                                             x_padding.float().to(device),
+                                             freq.to(device))
+      batch = [features.float(), mu.float(), sigma.float(), x_future]
+      if arrays is None:
+        arrays = _allocate(cache_dir, [(len(dataset), *x.shape[1:])
+                                       for x in batch], dtype)
+      for array, x in zip(arrays, batch):
+        array[position:position + len(x)] = x.cpu().numpy()
+      position += len(x_context)
+
+  if arrays is None:
+    raise ValueError("Cannot cache the features of an empty dataset.")
+  if not cache_dir:
+    return FeatureCache(*arrays)
+  for array in arrays:
+    array.flush()
+  return FeatureCache.load(cache_dir)
+
+
+def _allocate(cache_dir: Optional[str], shapes: List[Tuple[int, ...]],
+              dtype: np.dtype) -> List[np.ndarray]:
+  """Allocates the arrays of a cache, in memory or as memory-mapped files."""
+  dtypes = [dtype] + [np.float32] * (len(_ARRAYS) - 1)
+  if not cache_dir:
+    return [np.empty(s, dtype=d) for s, d in zip(shapes, dtypes)]
+  return [
+      np.lib.format.open_memmap(os.path.join(cache_dir, f"{name}.npy"),
+                                mode="w+",
+                                dtype=d,
+                                shape=s)
+      for name, s, d in zip(_ARRAYS, shapes, dtypes)
+  ]
@@ -0,0 +1,174 @@
+"""
+LoRA and DoRA adapters for the PyTorch PatchedTimeSeriesDecoder.
+
+This mirrors `src/adapter` for the PAX model: the linear layers of the
+stacked transformer are wrapped with low rank adapters, all the original
+weights are frozen, and the adapters can be merged back into plain
+`nn.Linear` layers once finetuning is done. As the PAX model has separate
+query, key and value projections, the fused `qkv_proj` gets one adapter per
+projection.
+"""
+
+import math
+from typing import Dict, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from timesfm.pytorch_patched_decoder import (TimesFMAttention,
+                                             TimesFMDecoderLayer)
+
+# Same choices as `lora_target_modules` in `peft/finetune.py`.
+_TARGET_MODULES: Dict[str, Tuple[str, ...]] = {
+    "all": ("self_attn.qkv_proj", "self_attn.o_proj", "mlp.gate_proj",
+            "mlp.down_proj"),
+    "attention": ("self_attn.qkv_proj", "self_attn.o_proj"),
+    "mlp": ("mlp.gate_proj", "mlp.down_proj"),
+}
+
+
+class LoraLinear(nn.Module):
+  """A frozen `nn.Linear` with a trainable low rank update.
+
+    The effective weight is `w + lora_b @ lora_a`. With DoRA, each output row
+    of it is further rescaled to the norm `dora_m`, as in `DoraLinear`.
+
+    The output rows can be split into blocks with their own update, e.g. the
+    query, key and value of a fused projection. Block `i` is then updated by
+    its rows of `lora_b` times rows `[i * rank, (i + 1) * rank)` of `lora_a`.
+
+    Args:
+      base: The linear layer to adapt. Its parameters are frozen.
+      rank: Rank of the update of each block.
+      use_dora: Whether to also learn the magnitude of the weights.
+      splits: Number of output rows of each block, all of them by default.
+    """
+
+  def __init__(self,
+               base: nn.Linear,
+               rank: int,
+               use_dora: bool = False,
+               splits: Optional[Sequence[int]] = None):
+    super().__init__()
+    self.base = base.requires_grad_(False)
+    self.rank = rank
+    self.splits = tuple(splits or (base.out_features,))
+    if sum(self.splits) != base.out_features:
+      raise ValueError(f"splits {self.splits} do not add up to the "
+                       f"{base.out_features} output features.")
+    weight = base.weight
+    # lora_b starts at zero, so the adapted layer starts as the base one.
+    self.lora_a = nn.Parameter(
+        torch.randn(len(self.splits) * rank,
+                    base.in_features,
+                    dtype=weight.dtype,
+                    device=weight.device) / math.sqrt(rank))
+    self.lora_b = nn.Parameter(
+        torch.zeros(base.out_features, rank, dtype=weight.dtype,
+                    device=weight.device))
+    if use_dora:
+      self.dora_m = nn.Parameter(weight.detach().norm(dim=1).clone())
+    else:
+      self.dora_m = None
+
+  def merged_weight(self) -> torch.Tensor:
+    """Returns the weight of the equivalent `nn.Linear`."""
+    updates = [
+        b @ a for b, a in zip(self.lora_b.split(self.splits),
+                              self.lora_a.split(self.rank))
+    ]
+    weight = self.base.weight + torch.cat(updates)
+    if self.dora_m is not None:
+      weight = weight * (self.dora_m / weight.norm(dim=1))[:, None]
+    return weight
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    if self.dora_m is not None:
+      return F.linear(x, self.merged_weight(), self.base.bias)
+    # Thin matmuls instead of materializing the [out, in] update.
+    hidden = F.linear(x, self.lora_a)
+    if len(self.splits) == 1:
+      return self.base(x) + F.linear(hidden, self.lora_b)
+    updates = [
+        F.linear(h, b) for h, b in zip(hidden.split(self.rank, -1),
+                                       self.lora_b.split(self.splits))
+    ]
+    return self.base(x) + torch.cat(updates, -1)
+
+  def merge(self) -> nn.Linear:
+    """Returns a plain `nn.Linear` computing the same function."""
+    merged = nn.Linear(self.base.in_features,
+                       self.base.out_features,
+                       bias=self.base.bias is not None,
+                       device=self.base.weight.device,
+                       dtype=self.base.weight.dtype)
+    with torch.no_grad():
+      merged.weight.copy_(self.merged_weight())
+      if self.base.bias is not None:
+        merged.bias.copy_(self.base.bias)
+    return merged
+
+
+def _get_parent(module: nn.Module, name: str) -> Tuple[nn.Module, str]:
+  parent, _, child = name.rpartition(".")
+  return module.get_submodule(parent) if parent else module, child
+
+
+def apply_lora(model: nn.Module,
+               rank: int,
+               target_modules: str = "all",
+               use_dora: bool = False) -> nn.Module:
+  """Freezes `model` and adds adapters to its transformer layers in place.
+
+    Args:
+      model: A model containing `TimesFMDecoderLayer`s.
+      rank: Rank of the adapters.
+      target_modules: Which linear layers to adapt, one of [all, attention,
+        mlp].
+      use_dora: Whether to use DoRA adapters.
+
+    Returns:
+      The model, whose only trainable parameters are the adapters.
+    """
+  if target_modules not in _TARGET_MODULES:
+    raise ValueError(f"Unknown lora_target_modules: {target_modules}. "
+                     f"Allowed values: {list(_TARGET_MODULES)}")
+  model.requires_grad_(False)
+  layers = [m for m in model.modules() if isinstance(m, TimesFMDecoderLayer)]
+  for layer in layers:
+    for name in _TARGET_MODULES[target_modules]:
+      parent, child = _get_parent(layer, name)
+      splits = None
+      if isinstance(parent, TimesFMAttention) and child == "qkv_proj":
+        splits = (parent.q_size, parent.kv_size, parent.kv_size)
+      setattr(
+          parent, child,
+          LoraLinear(getattr(parent, child),
+                     rank,
+                     use_dora=use_dora,
+                     splits=splits))
+  return model
+
+
+def merge_lora(model: nn.Module) -> nn.Module:
+  """Replaces the adapters of `model` with merged `nn.Linear` layers in place.
+
+    The merged layers are frozen like the rest of the base model, and the
+    model then has the architecture and state dict keys of the original one.
+    """
+  adapters = [(name, m)
+              for name, m in model.named_modules()
+              if isinstance(m, LoraLinear)]
+  for name, adapter in adapters:
+    parent, child = _get_parent(model, name)
+    setattr(parent, child, adapter.merge().requires_grad_(False))
+  return model
+
+
+def lora_state_dict(model: nn.Module) -> Dict[str, torch.Tensor]:
+  """Returns only the adapter weights of `model`, to save them separately."""
+  return {
+      name: param.detach()
+      for name, param in model.named_parameters()
+      if name.rpartition(".")[2] in ("lora_a", "lora_b", "dora_m")
+  }
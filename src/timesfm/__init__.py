@@ -11,25 +11,94 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""TimesFM init file."""
+"""TimesFM init file.
+
+Backends are imported lazily on first access. `timesfm.TimesFm` resolves to
+the backend named by the `TIMESFM_BACKEND` environment variable ("jax" or
+"torch") if set, and otherwise to the JAX backend with a fallback to PyTorch.
+See https://github.com/google-research/timesfm/blob/master/README.md for
+updated APIs.
+"""
+
+import importlib
+import logging
+import os
+from typing import Any
 
-print(
-    " See https://github.com/google-research/timesfm/blob/master/README.md for updated APIs."
-)
 from timesfm.timesfm_base import (
     freq_map,
+    ForecastTimings,
     TimesFmCheckpoint,
     TimesFmHparams,
     TimesFmBase,
 )
-import sys
 
-try:
-    from timesfm.timesfm_jax import TimesFmJax as TimesFm
-    from timesfm import data_loader
+BACKEND_ENV_VAR = "TIMESFM_BACKEND"
+
+# Attributes resolved on first access, mapping to (module, attribute).
+_LAZY_ATTRS = {
+    "TimesFmJax": ("timesfm.timesfm_jax", "TimesFmJax"),
+    "TimesFmTorch": ("timesfm.timesfm_torch", "TimesFmTorch"),
+    "TimesFmTorchPool": ("timesfm.timesfm_torch", "TimesFmTorchPool"),
+}
+_LAZY_MODULES = (
+    "data_loader",
+    "patched_decoder",
+    "pytorch_patched_decoder",
+    "time_features",
+    "timesfm_jax",
+    "timesfm_torch",
+    "xreg_jax",
+    "xreg_lib",
+)
+_BACKENDS = {
+    "jax": "TimesFmJax",
+    "pax": "TimesFmJax",
+    "torch": "TimesFmTorch",
+    "pytorch": "TimesFmTorch",
+}
+
+
+def get_model(backend: str | None = None) -> type[TimesFmBase]:
+    """Returns the TimesFM inference class of the given backend.
+
+    Args:
+        backend: One of "jax" (alias "pax") or "torch" (alias "pytorch").
+            Defaults to the `TIMESFM_BACKEND` environment variable. If neither
+            is set, the JAX backend is tried first with a fallback to PyTorch.
+
+    Returns:
+        The TimesFM class, to be instantiated with `hparams` and `checkpoint`.
+    """
+    backend = backend or os.environ.get(BACKEND_ENV_VAR)
+    if backend:
+        if backend.lower() not in _BACKENDS:
+            raise ValueError(f"Unsupported backend: {backend}. Use one of"
+                             f" {sorted(_BACKENDS)}.")
+        return __getattr__(_BACKENDS[backend.lower()])
+    try:
+        model_cls = __getattr__("TimesFmJax")
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.info("Falling back to PyTorch TimesFM, JAX is unavailable: %s", e)
+        return __getattr__("TimesFmTorch")
+    logging.info("Loaded Jax TimesFM.")
+    return model_cls
+
+
+def __getattr__(name: str) -> Any:
+    if name == "TimesFm":
+        value = get_model()
+    elif name in _LAZY_ATTRS:
+        module_name, attr = _LAZY_ATTRS[name]
+        value = getattr(importlib.import_module(module_name), attr)
+    elif name in _LAZY_MODULES:
+        value = importlib.import_module(f"{__name__}.{name}")
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
-    print(f"Loaded Jax TimesFM, likely because python version is {sys.version}.")
-except Exception as _:
-    from timesfm.timesfm_torch import TimesFmTorch as TimesFm
 
-    print(f"Loaded PyTorch TimesFM, likely because python version is {sys.version}.")
+def __dir__() -> list[str]:
+    return sorted(
+        list(globals()) + ["TimesFm"] + list(_LAZY_ATTRS) + list(_LAZY_MODULES))
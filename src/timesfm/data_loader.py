@@ -11,18 +11,169 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""TF dataloaders for general timeseries datasets.
+"""Dataloaders for general timeseries datasets.
 
-The expected input format is csv file with a datetime index.
+The expected input format is csv file with a datetime index, or its
+memory-mapped columnar conversion by `convert_csv`. Batches are
+served by the framework neutral `WindowSampler`, or by `tf.data` through
+`TimeSeriesdata.tf_dataset` if TensorFlow is installed.
 """
 
+import dataclasses
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterator, Literal
+
 from absl import logging
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
-import tensorflow as tf
 from . import time_features
 
+Framework = Literal["numpy", "torch", "jax"]
+PrefetchMode = Literal["thread", "process"]
+
+# The dtypes of the elements of `TimeSeriesdata.tf_dataset`: the series,
+# numerical and categorical features of the history, then of the horizon,
+# then the series indices.
+_OUTPUT_DTYPES = (np.float32, np.float32, np.int32, np.float32, np.float32,
+                  np.int32, np.int32)
+# Outputs with an axis over the series, of size `lens` in unbatched tasks.
+_SERIES_OUTPUTS = (0, 3, 6)
+# Number of windows gathered at once by an unbatched `WindowSampler`.
+_UNBATCHED_BLOCK_SIZE = 64
+
+# Files of the columnar format written by `convert_csv`.
+_MANIFEST = 'manifest.json'
+_DATETIMES = 'datetimes.npy'
+_NUMERICAL = 'numerical.npy'
+_CATEGORICAL = 'categorical.npy'
+_FORMAT_VERSION = 1
+
+
+def _take_windows(mat, rows, steps, out=None):
+  """Gathers `mat[rows, steps]` for broadcastable `rows` and `steps`.
+
+  Args:
+    mat: C-contiguous matrix of shape [num_rows, num_steps].
+    rows: int array of row indices of shape [S or 1, R].
+    steps: int array of step indices of shape [S, 1, W].
+    out: optional output array of shape [S, R, W] and the dtype of `mat`.
+
+  Returns:
+    The gathered windows of shape [S, R, W].
+  """
+  return np.take(
+      mat.reshape(-1), rows[..., None] * mat.shape[1] + steps, out=out)
+
+
+def _read_csv(data_path):
+  """Reads a csv file with missing values replaced by 0."""
+  data_df = pd.read_csv(open(data_path, 'r'))
+  # The string columns of pandas 3 only hold strings, so they are filled as
+  # objects, as with earlier versions.
+  for col in data_df.columns[data_df.isna().any()]:
+    if not pd.api.types.is_numeric_dtype(data_df[col]):
+      data_df[col] = data_df[col].astype(object)
+  data_df.fillna(0, inplace=True)
+  return data_df
+
+
+def convert_csv(data_path, out_dir, datetime_col):
+  """Converts a csv file to the columnar format of `TimeSeriesdata`.
+
+  The conversion parses the csv once. The numerical columns are stored as a
+  [num_cols, num_rows] float64 matrix, and the other columns are factorized
+  into a matrix of int32 codes, with their categories in the order of
+  appearance listed in a json manifest. Missing values are replaced by 0, as
+  in `TimeSeriesdata`. The manifest is written last, so that an interrupted
+  conversion is not mistaken for a complete one.
+
+  Args:
+    data_path: path to csv file
+    out_dir: directory of the converted dataset
+    datetime_col: column name for datetime col
+
+  Returns:
+    out_dir, to be passed as `data_path` to `TimeSeriesdata`.
+  """
+  data_df = _read_csv(data_path)
+  datetimes = pd.DatetimeIndex(data_df.pop(datetime_col))
+  numerical_cols = [
+      col for col in data_df.columns
+      if pd.api.types.is_numeric_dtype(data_df[col])
+  ]
+  categorical_cols = [
+      col for col in data_df.columns if col not in set(numerical_cols)
+  ]
+  categories = {}
+  codes = np.empty((len(categorical_cols), len(data_df)), dtype=np.int32)
+  for i, col in enumerate(categorical_cols):
+    codes[i], uniques = pd.factorize(data_df[col])
+    categories[col] = uniques.tolist()
+
+  os.makedirs(out_dir, exist_ok=True)
+  np.save(os.path.join(out_dir, _DATETIMES), datetimes.as_unit('ns').asi8)
+  np.save(
+      os.path.join(out_dir, _NUMERICAL),
+      data_df[numerical_cols].to_numpy(dtype=np.float64).transpose(),
+  )
+  np.save(os.path.join(out_dir, _CATEGORICAL), codes)
+  manifest = {
+      'format_version': _FORMAT_VERSION,
+      'datetime_col': datetime_col,
+      'tz': None if datetimes.tz is None else str(datetimes.tz),
+      'numerical_cols': numerical_cols,
+      'categorical_cols': categorical_cols,
+      'categories': categories,
+  }
+  with open(os.path.join(out_dir, _MANIFEST), 'w') as f:
+    json.dump(manifest, f)
+  return out_dir
+
+
+def load_columnar(data_dir):
+  """Opens a dataset converted by `convert_csv` as a dataframe.
+
+  The numerical columns are views of the memory-mapped matrix, so opening is
+  independent of the size of the dataset, and processes loading the same
+  dataset share its pages. Categorical columns are `pd.Categorical`.
+
+  Args:
+    data_dir: directory of the converted dataset
+
+  Returns:
+    The dataframe of the csv file with missing values replaced by 0, indexed
+    by its datetime column.
+  """
+  with open(os.path.join(data_dir, _MANIFEST), 'r') as f:
+    manifest = json.load(f)
+  if manifest['format_version'] != _FORMAT_VERSION:
+    raise ValueError(
+        f'Unsupported format version {manifest["format_version"]} of'
+        f' {data_dir}.')
+  datetimes = pd.DatetimeIndex(
+      np.load(os.path.join(data_dir, _DATETIMES)).view('datetime64[ns]'))
+  if manifest['tz'] is not None:
+    datetimes = datetimes.tz_localize('UTC').tz_convert(manifest['tz'])
+  numerical = np.load(os.path.join(data_dir, _NUMERICAL), mmap_mode='r')
+  data_df = pd.DataFrame(
+      numerical.transpose(),
+      columns=manifest['numerical_cols'],
+      index=datetimes,
+      copy=False,
+  )
+  codes = np.load(os.path.join(data_dir, _CATEGORICAL), mmap_mode='r')
+  for col, col_codes in zip(manifest['categorical_cols'], codes):
+    data_df[col] = pd.Categorical.from_codes(
+        col_codes, categories=manifest['categories'][col])
+  data_df[manifest['datetime_col']] = datetimes
+  return data_df
+
 
 class TimeSeriesdata(object):
   """Data loader class."""
@@ -49,7 +200,7 @@ class TimeSeriesdata(object):
     """Initialize objects.
 
     Args:
-      data_path: path to csv file
+      data_path: path to csv file, or to its conversion by `convert_csv`
       datetime_col: column name for datetime col
       num_cov_cols: list of numerical global covariates
       cat_cov_cols: list of categorical global covariates
@@ -69,16 +220,20 @@ class TimeSeriesdata(object):
     Returns:
       None
     """
-    self.data_df = pd.read_csv(open(data_path, 'r'))
+    if os.path.isdir(data_path):
+      self.data_df = load_columnar(data_path)
+      if datetime_col not in self.data_df.columns:
+        raise ValueError(f'{data_path} has no datetime column {datetime_col}.')
+    else:
+      self.data_df = _read_csv(data_path)
+      self.data_df.set_index(
+          pd.DatetimeIndex(self.data_df[datetime_col]), inplace=True)
     if not num_cov_cols:
       self.data_df['ncol'] = np.zeros(self.data_df.shape[0])
       num_cov_cols = ['ncol']
     if not cat_cov_cols:
       self.data_df['ccol'] = np.zeros(self.data_df.shape[0])
       cat_cov_cols = ['ccol']
-    self.data_df.fillna(0, inplace=True)
-    self.data_df.set_index(pd.DatetimeIndex(self.data_df[datetime_col]),
-                           inplace=True)
     self.num_cov_cols = num_cov_cols
     self.cat_cov_cols = cat_cov_cols
     self.ts_cols = ts_cols
@@ -88,7 +243,7 @@ class TimeSeriesdata(object):
     data_df_idx = self.data_df.index
     date_index = data_df_idx.union(
         pd.date_range(
-            data_df_idx[-1] + pd.Timedelta(1, freq=freq),
+            data_df_idx[-1] + pd.Timedelta(1),
             periods=pred_len + 1,
             freq=freq,
         ))
@@ -116,16 +271,17 @@ class TimeSeriesdata(object):
     )
     self.epoch_len = epoch_len
     self.permute = permute
+    self._build_windows()
 
   def _get_cat_cols(self, cat_cov_cols):
     """Get categorical columns."""
     cat_vars = []
     cat_sizes = []
     for col in cat_cov_cols:
-      dct = {x: i for i, x in enumerate(self.data_df[col].unique())}
-      cat_sizes.append(len(dct))
-      mapped = self.data_df[col].map(lambda x: dct[x]).to_numpy().transpose()  # pylint: disable=cell-var-from-loop
-      cat_vars.append(mapped)
+      # Codes in the order of appearance of the values.
+      codes, uniques = pd.factorize(self.data_df[col])
+      cat_sizes.append(len(uniques))
+      cat_vars.append(codes)
     return np.vstack(cat_vars), cat_sizes
 
   def _normalize_data(self):
@@ -134,6 +290,75 @@ class TimeSeriesdata(object):
     self.scaler = self.scaler.fit(train_mat.transpose())
     self.data_mat = self.scaler.transform(self.data_mat.transpose()).transpose()
 
+  def _build_windows(self):
+    """Builds strided views of all windows of hist_len + pred_len steps.
+
+    The numerical and categorical features are padded past the end of
+    `data_mat` by repeating their last column, as in `_get_features_and_ts`,
+    and stacked under the time features, so that every window is a view.
+    """
+    self._window_len = self.hist_len + self.pred_len
+    data_len = self.data_mat.shape[1]
+    time_len = self.time_mat.shape[1]
+
+    def pad(mat):
+      mat = mat[:, :data_len]
+      return np.hstack(
+          [mat, np.repeat(mat[:, [-1]], time_len - data_len, axis=1)])
+
+    self._ts_mat = np.ascontiguousarray(self.data_mat)
+    self._feat_mat = np.ascontiguousarray(
+        np.vstack([self.time_mat, pad(self.num_feat_mat)]))
+    self._cat_mat = np.ascontiguousarray(pad(self.cat_feat_mat))
+    if data_len < self._window_len:
+      self._ts_windows = None
+      return
+    window_view = lambda mat: np.lib.stride_tricks.sliding_window_view(
+        mat, self._window_len, axis=1)
+    # Of shapes [rows, num_windows, window_len], where window i starts at i.
+    self._ts_windows = window_view(self._ts_mat)
+    self._feat_windows = window_view(self._feat_mat)
+    self._cat_windows = window_view(self._cat_mat)
+
+  def get_window_batch(self, starts, tsidx, out=None):
+    """Gathers the windows at `starts` for the series `tsidx` in one pass.
+
+    Windows must lie within `data_mat`, i.e. `starts` in
+    [0, data_mat.shape[1] - hist_len - pred_len].
+
+    Args:
+      starts: int array of window start indices, of shape [S].
+      tsidx: int array of series indices, of shape [B], or [S, B] to gather
+        different series for each window.
+      out: optional tuple of output arrays of a previous call with the same
+        shapes, which are reused instead of allocating new ones.
+
+    Returns:
+      A tuple of the time series of shape [S, B, window_len], the time and
+      numerical features of shape [S, num_feats, window_len] and the
+      categorical features of shape [S, num_cat_feats, window_len].
+    """
+    steps = np.asarray(starts)[:, None, None] + np.arange(self._window_len)
+    tsidx = np.asarray(tsidx)
+    out = out or (None, None, None)
+    return (
+        _take_windows(self._ts_mat, np.atleast_2d(tsidx), steps, out[0]),
+        _take_windows(self._feat_mat, np.arange(self._feat_mat.shape[0])[None],
+                      steps, out[1]),
+        _take_windows(self._cat_mat, np.arange(self._cat_mat.shape[0])[None],
+                      steps, out[2]),
+    )
+
+  def sampler(self, mode='train', shift=1, **kwargs):
+    """Returns a `WindowSampler` over the batches of `mode`.
+
+    Args:
+      mode: 'train', 'val' or 'test'.
+      shift: stride between the windows of the 'val' and 'test' modes.
+      **kwargs: other arguments of `WindowSampler`.
+    """
+    return WindowSampler(self, mode=mode, shift=shift, **kwargs)
+
   def train_gen(self):
     """Generator for training data."""
     num_ts = len(self.ts_cols)
@@ -221,6 +446,18 @@ class TimeSeriesdata(object):
     """Get features and ts in specified windows."""
     if hist_len is None:
       hist_len = self.hist_len
+    start = dtimes[0]
+    if (self._ts_windows is not None and len(dtimes) == self._window_len and
+        0 <= start < self._ts_windows.shape[1] and
+        dtimes[-1] - start == self._window_len - 1):
+      # Contiguous window within the data: only the series are copied, the
+      # features are views.
+      bts = self._ts_windows[tsidx, start]
+      bfeats = self._feat_windows[:, start]
+      bcf = self._cat_windows[:, start]
+      return (bts[:, :hist_len], bts[:, hist_len:], bfeats[:, :hist_len],
+              bfeats[:, hist_len:], bcf[:, :hist_len], bcf[:, hist_len:])
+
     data_times = dtimes[dtimes < self.data_mat.shape[1]]
     bdata = self.data_mat[:, data_times]
     bts = bdata[tsidx, :]
@@ -244,6 +481,7 @@ class TimeSeriesdata(object):
 
   def tf_dataset(self, mode='train', shift=1):
     """Tensorflow Dataset."""
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
     if mode == 'train':
       gen_fn = self.train_gen
     else:
@@ -253,3 +491,416 @@ class TimeSeriesdata(object):
     dataset = tf.data.Dataset.from_generator(gen_fn, output_types)
     dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
     return dataset
+
+
+@dataclasses.dataclass(frozen=True)
+class _Epoch:
+  """The window starts and series batch ids of the elements of an epoch."""
+
+  seed: int
+  starts: np.ndarray
+  batch_ids: np.ndarray
+
+
+def _produce(sampler, epoch, out_queue, stop):
+  """Puts the task outputs of `sampler` on `out_queue`, then None."""
+  try:
+    for task in range(sampler._num_tasks()):  # pylint: disable=protected-access
+      # pylint: disable-next=protected-access
+      outputs = sampler._run_task(epoch, task)
+      while not stop.is_set():
+        try:
+          out_queue.put(outputs, timeout=0.1)
+          break
+        except queue.Full:
+          continue
+      if stop.is_set():
+        return
+    out_queue.put(None)
+  except Exception as e:  # pylint: disable=broad-exception-caught
+    out_queue.put(e)
+
+
+def _slot_views(buf, layout, shapes=None):
+  """Returns the arrays of a shared memory slot, of their `shapes` if given."""
+  views = []
+  for i, (max_shape, dtype, offset) in enumerate(layout):
+    view = np.ndarray(max_shape, dtype=dtype, buffer=buf, offset=offset)
+    if shapes is not None:
+      view = view[tuple(slice(n) for n in shapes[i])]
+    views.append(view)
+  return views
+
+
+def _write_slot(buf, layout, outputs):
+  for view, x in zip(_slot_views(buf, layout, [x.shape for x in outputs]),
+                     outputs):
+    view[...] = x
+
+
+def _read_slot(buf, layout, shapes):
+  return tuple(
+      view.copy() for view in _slot_views(buf, layout, shapes))
+
+
+def _shared_memory_worker(sampler, epoch, layout, slot_names, tasks, results):
+  """Runs the tasks of `tasks` into the slots of the shared memory ring.
+
+  Args:
+    sampler: the `WindowSampler`.
+    epoch: the epoch of the tasks.
+    layout: (max_shape, dtype, offset) of the outputs in a slot.
+    slot_names: names of the shared memory blocks of the slots.
+    tasks: queue of (task, slot) to run, then None.
+    results: queue of (task, slot, output shapes or exception, lens).
+  """
+  slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+  try:
+    while (item := tasks.get()) is not None:
+      task, slot = item
+      try:
+        # pylint: disable-next=protected-access
+        outputs, lens = sampler._run_task(epoch, task)
+        _write_slot(slots[slot].buf, layout, outputs)
+        results.put((task, slot, [x.shape for x in outputs], lens))
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        results.put((task, slot, e, None))
+  finally:
+    for shm in slots:
+      shm.close()
+
+
+def _converter(framework: Framework) -> Callable[[np.ndarray], Any]:
+  """Returns the function converting numpy arrays to arrays of `framework`."""
+  if framework == 'numpy':
+    return lambda x: x
+  elif framework == 'torch':
+    import torch  # pylint: disable=g-import-not-at-top
+    return torch.from_numpy
+  elif framework == 'jax':
+    import jax  # pylint: disable=g-import-not-at-top
+    return jax.device_put
+  else:
+    raise ValueError(f'Unsupported framework: {framework}')
+
+
+class WindowSampler:
+  """Vectorized sampler of the batches of a `TimeSeriesdata`.
+
+  Serves the same elements as `TimeSeriesdata.tf_dataset` without TensorFlow:
+  tuples of the series, features and categorical features of the history and
+  of the horizon, then the series indices, in the dtypes of `tf_dataset`.
+  The epoch is an index of window starts and series batches, and the windows
+  of a batch are gathered at once from `TimeSeriesdata.get_window_batch`'s
+  matrices instead of one by one in a Python generator.
+
+  Train epochs draw series batches of `batch_size` series without replacement
+  if `permute` is set and take all the series otherwise, `num_ts //
+  batch_size + 1` times per window, over `epoch_len` window starts. Eval
+  epochs take every `shift`-th window of the range, each with the series
+  split in consecutive batches.
+  """
+
+  def __init__(
+      self,
+      data: TimeSeriesdata,
+      mode: str = 'train',
+      shift: int = 1,
+      batch_size: int | None = None,
+      shuffle: bool | None = None,
+      drop_remainder: bool = False,
+      seed: int | None = None,
+      framework: Framework = 'numpy',
+      prefetch: int = 2,
+      prefetch_mode: PrefetchMode = 'thread',
+      num_workers: int = 1,
+  ):
+    """Initializes the sampler.
+
+    Args:
+      data: the dataset.
+      mode: 'train', 'val' or 'test'.
+      shift: stride between the windows of the 'val' and 'test' modes.
+      batch_size: number of elements stacked in a batch, as with
+        `tf_dataset(...).batch(batch_size)`. If None, the elements are yielded
+        one by one.
+      shuffle: shuffle the window starts of every epoch. Defaults to True in
+        the 'train' mode.
+      drop_remainder: drop the last batch if it has less than `batch_size`
+        elements.
+      seed: seed of the shuffling and of the series batches.
+      framework: 'numpy', 'torch' or 'jax', the type of the yielded arrays.
+      prefetch: number of batches prepared ahead of the consumer. 0 prepares
+        them in the consuming thread.
+      prefetch_mode: prepare the batches in a background 'thread', or in
+        `num_workers` worker 'process'es, which write them into a ring of
+        `max(prefetch, num_workers)` shared memory buffers.
+      num_workers: number of worker processes of the 'process' mode.
+    """
+    # The windows are given by the first step of their horizons.
+    if mode == 'train':
+      windows = np.arange(data.train_range[0] + data.hist_len,
+                          data.train_range[1] - data.pred_len)
+    elif mode == 'val':
+      windows = np.arange(data.val_range[0],
+                          data.val_range[1] - data.pred_len + 1)
+    elif mode == 'test':
+      windows = np.arange(data.test_range[0],
+                          data.test_range[1] - data.pred_len + 1)
+    else:
+      raise NotImplementedError('Eval mode not implemented')
+    if prefetch_mode not in ('thread', 'process'):
+      raise ValueError(f'Unsupported prefetch mode: {prefetch_mode}')
+    if num_workers > 1 and prefetch_mode != 'process':
+      raise ValueError('Several workers require the process prefetch mode.')
+    num_ts = len(data.ts_cols)
+    self._forecast_starts = windows[:data.epoch_len or len(windows)]
+    if mode == 'train':
+      self._random_series = data.permute
+      if data.permute and data.batch_size > num_ts:
+        raise ValueError(f'batch_size ({data.batch_size}) is larger than the'
+                         f' number of series ({num_ts}).')
+      width = data.batch_size if data.permute else num_ts
+      self._series = np.arange(width)[None]
+      self._repeats = num_ts // data.batch_size + 1
+    else:
+      self._random_series = False
+      self._forecast_starts = self._forecast_starts[::shift]
+      firsts = np.arange(0, num_ts, data.batch_size)
+      self._series = firsts[:, None] + np.arange(data.batch_size)
+      self._repeats = len(firsts)
+    self._series_lens = np.minimum(num_ts - self._series[:, 0],
+                                   self._series.shape[1])
+    self._series = np.minimum(self._series, num_ts - 1)
+    if len(self._forecast_starts) and (
+        self._forecast_starts[0] < data.hist_len or
+        self._forecast_starts[-1] + data.pred_len > data.data_mat.shape[1]):
+      raise ValueError(f'The {mode} windows exceed the data.')
+    if batch_size and len(np.unique(self._series_lens)) > 1:
+      raise ValueError(
+          f'The {mode} elements have different numbers of series, as'
+          f' {num_ts} is not a multiple of {data.batch_size}, and cannot be'
+          ' batched.')
+
+    self.batch_size = batch_size
+    self.shuffle = mode == 'train' if shuffle is None else shuffle
+    self.drop_remainder = drop_remainder
+    self.framework = framework
+    self.prefetch = prefetch
+    self.prefetch_mode = prefetch_mode
+    self.num_workers = num_workers
+    self._num_ts = num_ts
+    self._hist_len = data.hist_len
+    self._window_len = data.hist_len + data.pred_len
+    self._seed_rng = np.random.default_rng(seed)
+    # Cast once to the output dtypes, so that windows are copied as they are.
+    self._mats = (
+        data._ts_mat.astype(np.float32),  # pylint: disable=protected-access
+        data._feat_mat.astype(np.float32),  # pylint: disable=protected-access
+        data._cat_mat.astype(np.int32),  # pylint: disable=protected-access
+    )
+    self._feat_rows = np.arange(self._mats[1].shape[0])[None]
+    self._cat_rows = np.arange(self._mats[2].shape[0])[None]
+    self._build_windows()
+
+  def _build_windows(self):
+    self._window_views = tuple(
+        np.lib.stride_tricks.sliding_window_view(
+            mat, self._window_len, axis=1) for mat in self._mats)
+
+  def __getstate__(self):
+    # The window views would be pickled as copies of all the windows.
+    state = self.__dict__.copy()
+    del state['_window_views']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._build_windows()
+
+  @property
+  def num_elements(self) -> int:
+    """Number of elements, i.e. windows and series batch, of an epoch."""
+    return len(self._forecast_starts) * self._repeats
+
+  def __len__(self) -> int:
+    if not self.batch_size:
+      return self.num_elements
+    if self.drop_remainder:
+      return self.num_elements // self.batch_size
+    return -(-self.num_elements // self.batch_size)
+
+  def _epoch(self) -> _Epoch:
+    """Draws the index of an epoch."""
+    seed = int(self._seed_rng.integers(2**63))
+    windows = self._forecast_starts
+    if self.shuffle:
+      windows = np.random.default_rng(seed).permutation(windows)
+    starts = np.repeat(windows - self._hist_len, self._repeats)
+    batch_ids = np.tile(np.arange(self._repeats) % len(self._series),
+                        len(windows))
+    return _Epoch(seed, starts, batch_ids)
+
+  def _num_tasks(self) -> int:
+    """Number of batches, or of blocks of elements if unbatched."""
+    if self.batch_size:
+      return len(self)
+    return -(-self.num_elements // _UNBATCHED_BLOCK_SIZE)
+
+  def _run_task(self, epoch: _Epoch,
+                task: int) -> tuple[tuple[np.ndarray, ...], np.ndarray]:
+    """Gathers the elements of a task.
+
+    The series batches of a task are padded to the longest one, and the
+    series draws of `permute` are seeded by the epoch and the task, so that
+    they do not depend on the worker running the task.
+
+    Args:
+      epoch: the index of the epoch.
+      task: the task, i.e. the batch or the block of unbatched elements.
+
+    Returns:
+      The outputs with a leading axis over the elements, and the number of
+      series of each element.
+    """
+    size = self.batch_size or _UNBATCHED_BLOCK_SIZE
+    block = slice(task * size, (task + 1) * size)
+    starts, batch_ids = epoch.starts[block], epoch.batch_ids[block]
+    lens = self._series_lens[batch_ids]
+    if self._random_series:
+      rng = np.random.default_rng((epoch.seed, task))
+      tsidx = rng.random((len(starts), self._num_ts)).argsort(axis=1)
+      tsidx = tsidx[:, :self._series.shape[1]]
+    else:
+      tsidx = self._series[batch_ids, :lens.max()]
+    ts_windows, feat_windows, cat_windows = self._window_views
+    starts = starts[:, None]
+    outputs = []
+    # The history and the horizon are gathered separately to be contiguous.
+    for part in (slice(None, self._hist_len), slice(self._hist_len, None)):
+      outputs += [
+          ts_windows[tsidx, starts, part],
+          feat_windows[self._feat_rows, starts, part],
+          cat_windows[self._cat_rows, starts, part],
+      ]
+    return tuple(outputs) + (tsidx.astype(np.int32),), lens
+
+  def _elements(self, outputs, lens, convert) -> Iterator[tuple[Any, ...]]:
+    """Yields the batch or the elements of the outputs of a task."""
+    if self.batch_size:
+      yield tuple(convert(x) for x in outputs)
+      return
+    for j, num_series in enumerate(lens):
+      yield tuple(
+          convert(x[j, :num_series] if i in _SERIES_OUTPUTS else x[j])
+          for i, x in enumerate(outputs))
+
+  def _slot_layout(self) -> tuple[list[tuple[Any, ...]], int]:
+    """Returns the layout of the outputs of a task and the size of a slot."""
+    size = self.batch_size or _UNBATCHED_BLOCK_SIZE
+    width = self._series.shape[1]
+    pred_len = self._window_len - self._hist_len
+    num_feats, num_cats = len(self._feat_rows[0]), len(self._cat_rows[0])
+    shapes = [(size, width, self._hist_len), (size, num_feats, self._hist_len),
+              (size, num_cats, self._hist_len), (size, width, pred_len),
+              (size, num_feats, pred_len), (size, num_cats, pred_len),
+              (size, width)]
+    layout, offset = [], 0
+    for shape, dtype in zip(shapes, _OUTPUT_DTYPES):
+      layout.append((shape, dtype, offset))
+      # Aligned to 64 bytes.
+      offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 64) * 64
+    return layout, offset
+
+  def __iter__(self) -> Iterator[tuple[Any, ...]]:
+    convert = _converter(self.framework)
+    epoch = self._epoch()
+    if not self.prefetch:
+      for task in range(self._num_tasks()):
+        yield from self._elements(*self._run_task(epoch, task), convert)
+    elif self.prefetch_mode == 'thread':
+      yield from self._iter_thread(epoch, convert)
+    else:
+      yield from self._iter_shared_memory(epoch, convert)
+
+  def _iter_thread(self, epoch, convert) -> Iterator[tuple[Any, ...]]:
+    out_queue, stop = queue.Queue(self.prefetch), threading.Event()
+    worker = threading.Thread(
+        target=_produce, args=(self, epoch, out_queue, stop), daemon=True)
+    worker.start()
+    try:
+      while (outputs := out_queue.get()) is not None:
+        if isinstance(outputs, Exception):
+          raise outputs
+        yield from self._elements(*outputs, convert)
+    finally:
+      stop.set()
+      # Unblocks the worker waiting for room in the queue.
+      while worker.is_alive():
+        try:
+          out_queue.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      worker.join()
+
+  def _iter_shared_memory(self, epoch, convert) -> Iterator[tuple[Any, ...]]:
+    """Runs the tasks in worker processes writing into shared memory.
+
+    Tasks are handed out in order with the index of a free slot, and their
+    outputs are yielded in order, so that the epoch does not depend on the
+    scheduling of the workers.
+    """
+    layout, slot_size = self._slot_layout()
+    slots = [
+        shared_memory.SharedMemory(create=True, size=slot_size)
+        for _ in range(max(self.prefetch, self.num_workers))
+    ]
+    context = multiprocessing.get_context()
+    tasks, results = context.Queue(), context.Queue()
+    workers = [
+        context.Process(
+            target=_shared_memory_worker,
+            args=(self, epoch, layout, [shm.name for shm in slots], tasks,
+                  results),
+            daemon=True,
+        ) for _ in range(self.num_workers)
+    ]
+    for worker in workers:
+      worker.start()
+    try:
+      num_tasks = self._num_tasks()
+      free_slots = list(range(len(slots)))
+      num_submitted = 0
+      done = {}
+      for task in range(num_tasks):
+        while free_slots and num_submitted < num_tasks:
+          tasks.put((num_submitted, free_slots.pop()))
+          num_submitted += 1
+        while task not in done:
+          try:
+            finished, slot, shapes, lens = results.get(timeout=1.0)
+          except queue.Empty:
+            if any(worker.exitcode for worker in workers):
+              raise RuntimeError('A data loader worker died.') from None
+            continue
+          done[finished] = (slot, shapes, lens)
+        slot, shapes, lens = done.pop(task)
+        if isinstance(shapes, Exception):
+          raise shapes
+        outputs = _read_slot(slots[slot].buf, layout, shapes)
+        free_slots.append(slot)
+        yield from self._elements(outputs, lens, convert)
+    finally:
+      for _ in workers:
+        tasks.put(None)
+      # Unblocks the workers flushing their results.
+      while any(worker.is_alive() for worker in workers):
+        try:
+          results.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      for worker in workers:
+        worker.join()
+      for shm in slots:
+        shm.close()
+        shm.unlink()
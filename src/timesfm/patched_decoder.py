@@ -20,7 +20,6 @@ import dataclasses
 from typing import Optional, Tuple
 
 import einshape as es
-from jax import lax
 import jax.numpy as jnp
 from praxis import base_layer
 from praxis import base_model
@@ -59,26 +58,26 @@ _TOLERANCE = 1e-7
 
 
 def _shift_padded_seq(mask: JTensor, seq: JTensor) -> JTensor:
-  """Shifts rows of seq based on the first 0 in each row of the mask."""
+  """Shifts rows of seq based on the first 0 in each row of the mask.
+
+  Args:
+    mask: mask tensor of shape [B, N].
+    seq: seq tensor of shape [B, N, D] or [1, N, D]. A leading dimension of 1
+      is broadcast against the batch of `mask` without being materialized.
+
+  Returns:
+    The shifted sequence of shape [B, N, D].
+  """
   num = seq.shape[1]
 
   # Find the index of the first 0 in each row of the mask
   first_zero_idx = jnp.argmin(mask, axis=1)
 
-  # Create a range array for indexing
-  idx_range = jnp.arange(num)
-
-  def shift_row(carry, x):
-    seq_row, shift = x
-    shifted_idx = (idx_range - shift) % num
-    shifted_row = seq_row[shifted_idx]
-    return carry, shifted_row
-
-  # Use lax.scan to shift each row of seq based on the corresponding
-  # first_zero_idx.
-  _, shifted_seq = lax.scan(shift_row, None, (seq, first_zero_idx))
-
-  return shifted_seq
+  # Gather all rows at once: row b reads seq[b, (i - shift_b) % num].
+  shifted_idx = (jnp.arange(num)[None, :] - first_zero_idx[:, None]) % num
+  if seq.shape[0] == 1:
+    return seq[0][shifted_idx]
+  return jnp.take_along_axis(seq, shifted_idx[:, :, None], axis=1)
 
 
 class ResidualBlock(base_layer.BaseLayer):
@@ -340,8 +339,6 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
       else:
         position_emb = pos_emb
       if self.do_eval:
-        if position_emb.shape[0] != model_input.shape[0]:
-          position_emb = jnp.repeat(position_emb, model_input.shape[0], axis=0)
         position_emb = _shift_padded_seq(patched_padding, position_emb)
       model_input += position_emb
 
@@ -362,13 +359,17 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
                                 h=self.horizon_len)
     return self._reverse_transform(output_ts, stats)
 
-  def __call__(self, inputs: NestedMap) -> NestedMap:
+  def __call__(self,
+               inputs: NestedMap,
+               pos_emb: Optional[JTensor] = None) -> NestedMap:
     """PatchTST call.
 
     Args:
       inputs: A NestedMap containing (1) input_ts: input sequence of shape [B,
         T] where T must be multiple of patch_length; (2) input_padding: that
         contains padding map.
+      pos_emb: Optional precomputed positional embedding of shape [1, N, D] or
+        [B, N, D]. Computed from the sequence length if not provided.
 
     Returns:
       A nested map with two keys:
@@ -381,6 +382,7 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
     model_input, patched_padding, stats, _ = self._preprocess_input(
         input_ts=input_ts,
         input_padding=input_padding,
+        pos_emb=pos_emb,
     )
     if self.use_freq:
       freq = inputs[_FREQ].astype(jnp.int32)
@@ -442,6 +444,10 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
       output_patch_len = self.horizon_len
     num_decode_patches = (horizon_len + output_patch_len -
                           1) // output_patch_len
+    # Positional embeddings only depend on the number of patches, which stays
+    # fixed once the context reaches `max_len`. Build each one once per decode
+    # call and let `_shift_padded_seq` broadcast it over the batch.
+    pos_embs = {}
     for step_index in range(num_decode_patches):
       current_padding = paddings[:, 0:final_out.shape[1]]
       input_ts = final_out[:, -max_len:]
@@ -451,7 +457,13 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
           input_padding=input_padding,
           freq=freq,
       )
-      fprop_outputs = self(model_input)[_OUTPUT_TS]
+      pos_emb = None
+      if self.use_pos_emb:
+        num_patches = input_ts.shape[1] // self.patch_len
+        if num_patches not in pos_embs:
+          pos_embs[num_patches] = self.position_emb(seq_length=num_patches)
+        pos_emb = pos_embs[num_patches]
+      fprop_outputs = self(model_input, pos_emb=pos_emb)[_OUTPUT_TS]
       if return_forecast_on_context and step_index == 0:
         # For the first decodings step, collect the model forecast on the
         # context except the unavailable first input batch forecast.
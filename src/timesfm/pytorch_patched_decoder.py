@@ -19,6 +19,7 @@ from typing import List, Tuple
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils import checkpoint
 
 
 def create_quantiles() -> list[float]:
@@ -124,12 +125,14 @@ def _shift_padded_seq(mask: torch.Tensor, seq: torch.Tensor) -> torch.Tensor:
 
   Args:
     mask: mask tensor of shape [B, N]
-    seq: seq tensor of shape [B, N, P]
+    seq: seq tensor of shape [B, N, P] or [1, N, P]. A leading dimension of 1
+      is broadcast against the batch of `mask` without being materialized.
 
   Returns:
-    Returns the shifted sequence.
+    Returns the shifted sequence of shape [B, N, P].
   """
-  batch_size, num_seq, feature_dim = seq.shape
+  batch_size = mask.shape[0]
+  num_seq = seq.shape[1]
 
   new_mask: torch.BoolTensor = mask == 0
 
@@ -137,20 +140,17 @@ def _shift_padded_seq(mask: torch.Tensor, seq: torch.Tensor) -> torch.Tensor:
   indices = new_mask.to(torch.int32).argmax(dim=1)
 
   # Handle rows with all zeros
-  indices[~new_mask.any(dim=1)] = -1
-
-  # Create index ranges for each sequence in the batch
-  idx_range = (torch.arange(num_seq).to(
-      seq.device).unsqueeze(0).unsqueeze(-1).expand(batch_size, -1,
-                                                    feature_dim))
+  indices = torch.where(new_mask.any(dim=1), indices, -1)
 
   # Calculate shifted indices for each element in each sequence
-  shifted_idx = (idx_range - indices[:, None, None]) % num_seq
+  idx_range = torch.arange(num_seq, device=seq.device)
+  shifted_idx = (idx_range[None, :] - indices[:, None]) % num_seq
 
   # Gather values from seq using shifted indices
-  shifted_seq = seq.gather(1, shifted_idx)
-
-  return shifted_seq
+  if seq.shape[0] == 1:
+    return seq[0][shifted_idx]
+  batch_idx = torch.arange(batch_size, device=seq.device)[:, None]
+  return seq[batch_idx, shifted_idx]
 
 
 def get_large_negative_number(dtype: torch.dtype) -> torch.Tensor:
@@ -351,7 +351,7 @@ class TimesFMAttention(nn.Module):
     self.q_size = self.num_heads * self.head_dim
     self.kv_size = self.num_kv_heads * self.head_dim
     self.scaling = nn.Parameter(
-        torch.empty((self.head_dim,), dtype=torch.float32),)
+        torch.zeros((self.head_dim,), dtype=torch.float32),)
 
     self.qkv_proj = nn.Linear(
         self.hidden_size,
@@ -476,7 +476,13 @@ class TimesFMDecoderLayer(nn.Module):
 
 
 class StackedDecoder(nn.Module):
-  """Stacked transformer layer."""
+  """Stacked transformer layer.
+
+  Attributes:
+    gradient_checkpointing: In training, recompute the activations of each
+      layer in the backward pass instead of storing them, which trades one
+      more forward pass for the memory of all but the layer inputs.
+  """
 
   def __init__(
       self,
@@ -501,6 +507,7 @@ class StackedDecoder(nn.Module):
               head_dim=head_dim,
               rms_norm_eps=rms_norm_eps,
           ))
+    self.gradient_checkpointing = False
 
   def forward(
       self,
@@ -512,9 +519,21 @@ class StackedDecoder(nn.Module):
     padding_mask = convert_paddings_to_mask(paddings, hidden_states.dtype)
     atten_mask = causal_mask(hidden_states)
     mask = merge_masks(padding_mask, atten_mask)
+    use_checkpoint = (self.gradient_checkpointing and self.training and
+                      torch.is_grad_enabled() and kv_caches is None)
     for i in range(len(self.layers)):
       layer = self.layers[i]
       kv_cache = kv_caches[i] if kv_caches is not None else None
+      if use_checkpoint:
+        _, hidden_states = checkpoint.checkpoint(
+            layer,
+            hidden_states,
+            mask,
+            paddings,
+            kv_write_indices,
+            use_reentrant=False,
+        )
+        continue
       _, hidden_states = layer(
           hidden_states=hidden_states,
           mask=mask,
@@ -546,8 +565,11 @@ class PositionalEmbedding(torch.nn.Module):
     self.min_timescale = min_timescale
     self.max_timescale = max_timescale
     self.embedding_dims = embedding_dims
+    # Sinusoids for unpacked sequences only depend on (seq_length, device), so
+    # they are memoized instead of being rebuilt on every decode step.
+    self._cache: dict[tuple[int, torch.device], torch.Tensor] = {}
 
-  def forward(self, seq_length=None, position=None):
+  def forward(self, seq_length=None, position=None, device=None):
     """Generates a Tensor of sinusoids with different frequencies.
 
     Args:
@@ -555,17 +577,26 @@ class PositionalEmbedding(torch.nn.Module):
           if the `position` argument is specified.
         position:   [B, seq_length], optional position for each token in the
           sequence, only required when the sequence is packed.
+        device: optional device of the output when `position` is not specified.
+          The result for a given (seq_length, device) is cached, so callers
+          must not modify it in place.
 
     Returns:
         [B, seqlen, D] if `position` is specified, else [1, seqlen, D]
     """
     if position is None:
       assert seq_length is not None
-      # [1, seqlen]
-      position = torch.arange(seq_length, dtype=torch.float32).unsqueeze(0)
-    else:
-      assert position.ndim == 2, position.shape
-
+      key = (seq_length, torch.device(device or "cpu"))
+      if key not in self._cache:
+        # [1, seqlen]
+        position = torch.arange(seq_length, dtype=torch.float32).unsqueeze(0)
+        self._cache[key] = self._sinusoids(position).to(key[1])
+      return self._cache[key]
+    assert position.ndim == 2, position.shape
+    return self._sinusoids(position)
+
+  def _sinusoids(self, position: torch.Tensor) -> torch.Tensor:
+    """Computes the [B, seqlen, D] sinusoids for the [B, seqlen] positions."""
     num_timescales = self.embedding_dims // 2
     log_timescale_increment = math.log(
         float(self.max_timescale) / float(self.min_timescale)) / max(
@@ -681,8 +712,8 @@ class PatchedTimeSeriesDecoder(nn.Module):
     patched_padding = torch.min(patched_pads,
                                 dim=-1)[0]  # Get the values from the min result
     if self.config.use_positional_embedding:
-      pos_emb = self.position_emb(model_input.shape[1]).to(model_input.device)
-      pos_emb = torch.concat([pos_emb] * model_input.shape[0], dim=0)
+      pos_emb = self.position_emb(model_input.shape[1],
+                                  device=model_input.device)
       pos_emb = _shift_padded_seq(patched_padding, pos_emb)
       model_input += pos_emb
 
@@ -705,13 +736,13 @@ class PatchedTimeSeriesDecoder(nn.Module):
 
     return self._reverse_transform(output_ts, stats)
 
-  def forward(
+  def encode(
       self,
       input_ts: torch.Tensor,
       input_padding: torch.LongTensor,
       freq: torch.Tensor,
-  ) -> torch.Tensor:
-    num_outputs = len(self.config.quantiles) + 1
+  ) -> tuple[torch.Tensor, tuple[torch.Tensor, torch.Tensor]]:
+    """Returns the B x N x D transformer outputs and the patch statistics."""
     model_input, patched_padding, stats, _ = self._preprocess_input(
         input_ts=input_ts,
         input_padding=input_padding,
@@ -719,7 +750,16 @@ class PatchedTimeSeriesDecoder(nn.Module):
     f_emb = self.freq_emb(freq)  # B x 1 x D
     model_input += f_emb
     model_output = self.stacked_transformer(model_input, patched_padding)
+    return model_output, stats
 
+  def forward(
+      self,
+      input_ts: torch.Tensor,
+      input_padding: torch.LongTensor,
+      freq: torch.Tensor,
+  ) -> torch.Tensor:
+    num_outputs = len(self.config.quantiles) + 1
+    model_output, stats = self.encode(input_ts, input_padding, freq)
     output_ts = self._postprocess_output(model_output, num_outputs, stats)
     return output_ts
 
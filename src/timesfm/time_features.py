@@ -17,6 +17,10 @@
 Extract time covariates from datetime.
 """
 
+import collections
+import os
+import threading
+
 import numpy as np
 import pandas as pd
 from pandas.tseries.holiday import EasterMonday
@@ -34,30 +38,51 @@ from pandas.tseries.offsets import DateOffset
 from pandas.tseries.offsets import Day
 from pandas.tseries.offsets import Easter
 from sklearn.preprocessing import StandardScaler
-from tqdm import tqdm
 
 
+# Environment variable of the directory where `DEFAULT_STORE` caches features.
+CACHE_DIR_ENV_VAR = "TIMESFM_CALENDAR_CACHE_DIR"
+
+# Bound of the memory used by the cached covariates of `DEFAULT_STORE`.
+DEFAULT_STORE_MAX_BYTES = 256 * 2**20
+
 # This is 183 to cover half a year (in both directions), also for leap years
 # + 17 as Eastern can be between March, 22 - April, 25
 MAX_WINDOW = 183 + 17
 
 
-def _distance_to_holiday(holiday):
-  """Return distance to given holiday."""
+def _distance_to_holiday(holiday, datetimes):
+  """Return distance in days of each datetime to given holiday.
 
-  def _distance_to_day(index):
-    holiday_date = holiday.dates(
-        index - pd.Timedelta(days=MAX_WINDOW),
-        index + pd.Timedelta(days=MAX_WINDOW),
-    )
-    assert (
-        len(holiday_date) != 0  # pylint: disable=g-explicit-length-test
-    ), f"No closest holiday for the date index {index} found."
-    # It sometimes returns two dates if it is exactly half a year after the
-    # holiday. In this case, the smaller distance (182 days) is returned.
-    return (index - holiday_date[0]).days
+  For each datetime this is the distance to the first holiday date within
+  MAX_WINDOW days of it. The holiday dates of the whole range are generated
+  once and matched to all datetimes by a binary search.
 
-  return _distance_to_day
+  Args:
+    holiday: pandas Holiday.
+    datetimes: pandas DatetimeIndex.
+
+  Returns:
+    Integer array of the distances, positive after the holiday.
+  """
+  if datetimes.empty:
+    return np.zeros(0, dtype=np.int64)
+  window = pd.Timedelta(days=MAX_WINDOW)
+  holiday_dates = holiday.dates(datetimes.min() - window,
+                                datetimes.max() + window)
+  as_ns = lambda x: np.sort(np.asarray(x, dtype="datetime64[ns]").view(
+      np.int64))
+  dates, index = as_ns(holiday_dates), np.asarray(
+      datetimes, dtype="datetime64[ns]").view(np.int64)
+  first = np.searchsorted(dates, index - window.value, side="left")
+  found = first < len(dates)
+  found[found] = dates[first[found]] <= index[found] + window.value
+  assert np.all(found), (
+      "No closest holiday for the date index"
+      f" {datetimes[np.argmin(found)]} found.")
+  # It sometimes finds two dates if it is exactly half a year after the
+  # holiday. In this case, the smaller distance (182 days) is returned.
+  return (index - dates[first]) // pd.Timedelta(days=1).value
 
 
 EasterSunday = Holiday(
@@ -117,6 +142,7 @@ class TimeCovariates(object):
       datetimes,
       normalized=True,
       holiday=False,
+      store=None,
   ):
     """Init function.
 
@@ -124,6 +150,8 @@ class TimeCovariates(object):
       datetimes: pandas DatetimeIndex (lowest granularity supported is min)
       normalized: whether to normalize features or not
       holiday: fetch holiday features or not
+      store: CalendarFeatureStore serving the features, `DEFAULT_STORE` if
+        None
 
     Returns:
       None
@@ -131,6 +159,7 @@ class TimeCovariates(object):
     self.normalized = normalized
     self.dti = datetimes
     self.holiday = holiday
+    self.store = store
 
   def _minute_of_hour(self):
     minutes = np.array(self.dti.minute, dtype=np.float32)
@@ -169,47 +198,230 @@ class TimeCovariates(object):
     return month_year
 
   def _week_of_year(self):
-    week_year = np.array(self.dti.strftime("%U").astype(int), dtype=np.float32)
+    # Same as strftime("%U"): weeks start on Sundays, and the days before the
+    # first Sunday of the year are in week 0.
+    sunday_based_weekday = (np.asarray(self.dti.dayofweek) + 1) % 7
+    week_year = np.array(
+        (np.asarray(self.dti.dayofyear) + 6 - sunday_based_weekday) // 7,
+        dtype=np.float32)
     if self.normalized:
       week_year = week_year / 51.0 - 0.5
     return week_year
 
   def _get_holidays(self):
-    dti_series = self.dti.to_series()
-    hol_variates = np.vstack([
-        dti_series.apply(_distance_to_holiday(h)).values for h in tqdm(HOLIDAYS)
-    ])
-    # hol_variates is (num_holiday, num_time_steps), the normalization should be
-    # performed in the num_time_steps dimension.
-    return StandardScaler().fit_transform(hol_variates.T).T
+    # Distances are standardized over the datetimes in `get_covariates`, so
+    # that the raw distances can be cached.
+    return np.vstack([_distance_to_holiday(h, self.dti) for h in HOLIDAYS])
+
+  def _get_raw_covariates(self):
+    """Get all time covariates before the standardization of holidays."""
+    all_covs = [
+        self._minute_of_hour(),
+        self._hour_of_day(),
+        self._day_of_month(),
+        self._day_of_week(),
+        self._day_of_year(),
+        self._month_of_year(),
+        self._week_of_year(),
+    ]
+    if self.holiday:
+      return np.vstack(all_covs + [self._get_holidays()])
+    return np.vstack(all_covs)
 
   def get_covariates(self):
     """Get all time covariates."""
-    moh = self._minute_of_hour().reshape(1, -1)
-    hod = self._hour_of_day().reshape(1, -1)
-    dom = self._day_of_month().reshape(1, -1)
-    dow = self._day_of_week().reshape(1, -1)
-    doy = self._day_of_year().reshape(1, -1)
-    moy = self._month_of_year().reshape(1, -1)
-    woy = self._week_of_year().reshape(1, -1)
+    store = self.store or DEFAULT_STORE
+    return store.get(self.dti, normalized=self.normalized, holiday=self.holiday)
 
-    all_covs = [
-        moh,
-        hod,
-        dom,
-        dow,
-        doy,
-        moy,
-        woy,
+
+def _covariates_frame(raw_covs, datetimes, holiday):
+  """Formats the outputs of `_get_raw_covariates` as `get_covariates`."""
+  columns = ["moh", "hod", "dom", "dow", "doy", "moy", "woy"]
+  if holiday:
+    # hol_variates is (num_holiday, num_time_steps), the normalization should
+    # be performed in the num_time_steps dimension.
+    hol_variates = raw_covs[len(columns):]
+    raw_covs = np.vstack([
+        raw_covs[:len(columns)],
+        StandardScaler().fit_transform(hol_variates.T).T,
+    ])
+    columns += [f"hol_{i}" for i in range(len(HOLIDAYS))]
+  return pd.DataFrame(
+      data=raw_covs.transpose(),
+      columns=columns,
+      index=datetimes,
+  )
+
+
+class CalendarFeatureStore(object):
+  """Memoizes time covariates on canonical timelines.
+
+  The covariates of a timestamp do not depend on the other timestamps, except
+  for the standardization of the holiday distances. A timeline is all
+  timestamps `phase + i * step` for a fixed step, e.g. an hour. Datetimes on
+  a timeline are served by indexing its cached covariates with their integer
+  offsets `i`. The cache of each (step, phase, normalized, holiday) is a set
+  of disjoint segments of offsets. A request that is not covered by a segment
+  is merged with the segments within its own length of it, and starts a new
+  segment otherwise, so that far apart requests do not cache the range between
+  them. The least recently used segments are evicted beyond `max_bytes`, and
+  the segments are optionally saved to `cache_dir` so that other processes
+  can reuse them. Holiday distances are cached raw and standardized over each
+  request. Datetimes that are not spaced by multiples of a fixed step, e.g.
+  monthly ones, that cover less than half of their range on the timeline, or
+  that are timezone aware are computed directly.
+  """
+
+  def __init__(self, cache_dir=None, max_bytes=None):
+    """Init function.
+
+    Args:
+      cache_dir: directory of the on-disk cache, in memory only if None
+      max_bytes: bound of the memory used by the cached covariates, unbounded
+        if None
+
+    Returns:
+      None
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    # The segments of each key as {key: {start: covariates}}, and the sizes of
+    # all segments from the least to the most recently used.
+    self._cache = {}
+    self._usage = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, datetimes, normalized=True, holiday=False):
+    """Get all time covariates of the datetimes, see `TimeCovariates`."""
+    timeline = self._timeline(datetimes)
+    if timeline is None:
+      raw_covs = TimeCovariates(datetimes, normalized,
+                                holiday)._get_raw_covariates()
+    else:
+      step, phase, offsets = timeline
+      key = (step, phase, normalized, holiday)
+      with self._lock:
+        start, cached = self._lookup(key, offsets.min(), offsets.max() + 1)
+      raw_covs = cached[:, offsets - start]
+    return _covariates_frame(raw_covs, datetimes, holiday)
+
+  def _timeline(self, datetimes):
+    """Returns the step, phase and offsets of the datetimes, if regular."""
+    if len(datetimes) < 2 or datetimes.tz is not None:
+      return None
+    index = np.asarray(datetimes, dtype="datetime64[ns]").view(np.int64)
+    step = int(np.min(np.abs(np.diff(index))))
+    if step <= 0:
+      return None
+    phase = int(index[0]) % step
+    if np.any((index - phase) % step):
+      return None
+    offsets = (index - phase) // step
+    # Sparse datetimes would cache mostly unused timestamps.
+    if offsets.max() - offsets.min() >= 2 * len(offsets):
+      return None
+    return step, phase, offsets
+
+  def _path(self, key):
+    step, phase, normalized, holiday = key
+    return os.path.join(
+        self.cache_dir,
+        f"calendar_segments_{step}_{phase}_"
+        f"{int(normalized)}_{int(holiday)}.npz")
+
+  def _segments(self, key):
+    """Returns the segments of `key`, loading them from disk if needed."""
+    if key in self._cache:
+      return self._cache[key]
+    segments = self._cache[key] = {}
+    if self.cache_dir and os.path.exists(path := self._path(key)):
+      with np.load(path) as saved:
+        bounds = np.cumsum(saved["lens"])[:-1]
+        for start, covariates in zip(
+            saved["starts"].tolist(),
+            np.split(saved["covariates"], bounds, axis=1)):
+          segments[start] = covariates
+          self._usage[(key, start)] = covariates.nbytes
+      self._evict(keep=None)
+    return segments
+
+  def _evict(self, keep):
+    """Evicts the least recently used segments beyond `max_bytes`."""
+    if self.max_bytes is None:
+      return
+    total = sum(self._usage.values())
+    for key, start in list(self._usage):
+      if total <= self.max_bytes:
+        return
+      if (key, start) != keep:
+        total -= self._usage.pop((key, start))
+        del self._cache[key][start]
+    # A segment larger than the bound is served but not kept.
+    if total > self.max_bytes and keep in self._usage:
+      del self._usage[keep]
+      del self._cache[keep[0]][keep[1]]
+
+  def _save(self, key):
+    """Writes the segments of `key` to `cache_dir`."""
+    segments = self._cache[key]
+    os.makedirs(self.cache_dir, exist_ok=True)
+    starts = sorted(segments)
+    # Written aside then renamed, as other processes may be reading it.
+    tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+      np.savez(
+          f,
+          starts=np.array(starts, dtype=np.int64),
+          lens=np.array([segments[s].shape[1] for s in starts], dtype=np.int64),
+          covariates=np.hstack([segments[s] for s in starts])
+          if starts else np.zeros((0, 0)),
+      )
+    os.replace(tmp_path, self._path(key))
+
+  def _lookup(self, key, lo, hi):
+    """Returns cached covariates of `key`, from `start`, covering [lo, hi)."""
+    segments = self._segments(key)
+    for start, cached in segments.items():
+      if start <= lo and hi <= start + cached.shape[1]:
+        self._usage.move_to_end((key, start))
+        return start, cached
+
+    step, phase, normalized, holiday = key
+    compute = lambda a, b: TimeCovariates(
+        pd.DatetimeIndex(
+            (phase + np.arange(a, b) * step).astype("datetime64[ns]")),
+        normalized,
+        holiday,
+    )._get_raw_covariates()
+    # Merging fills gaps of at most the length of the request.
+    margin = hi - lo
+    merged = [
+        s for s in sorted(segments)
+        if s <= hi + margin and lo - margin <= s + segments[s].shape[1]
     ]
-    columns = ["moh", "hod", "dom", "dow", "doy", "moy", "woy"]
-    if self.holiday:
-      hol_covs = self._get_holidays()
-      all_covs.append(hol_covs)
-      columns += [f"hol_{i}" for i in range(len(HOLIDAYS))]
-
-    return pd.DataFrame(
-        data=np.vstack(all_covs).transpose(),
-        columns=columns,
-        index=self.dti,
-    )
+    start = min([lo] + merged)
+    stop = max([hi] + [s + segments[s].shape[1] for s in merged])
+    pieces = []
+    position = start
+    for s in merged:
+      if position < s:
+        pieces.append(compute(position, s))
+      pieces.append(segments.pop(s))
+      del self._usage[(key, s)]
+      position = s + pieces[-1].shape[1]
+    if position < stop:
+      pieces.append(compute(position, stop))
+    cached = np.hstack(pieces)
+    segments[start] = cached
+    self._usage[(key, start)] = cached.nbytes
+    self._evict(keep=(key, start))
+    if self.cache_dir:
+      self._save(key)
+    return start, cached
+
+
+# Store used by `TimeCovariates` by default, caching on disk in the directory
+# named by the `TIMESFM_CALENDAR_CACHE_DIR` environment variable if set.
+DEFAULT_STORE = CalendarFeatureStore(
+    cache_dir=os.environ.get(CACHE_DIR_ENV_VAR),
+    max_bytes=DEFAULT_STORE_MAX_BYTES)
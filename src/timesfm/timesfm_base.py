@@ -14,9 +14,11 @@
 """Base class for TimesFM inference. This will be common to PAX and Pytorch."""
 
 import collections
+from concurrent import futures
 import dataclasses
 import logging
 import multiprocessing
+import time
 from typing import Any, Literal, Sequence, TYPE_CHECKING
 
 import numpy as np
@@ -28,9 +30,13 @@ if TYPE_CHECKING:
     from . import xreg_lib
     Category = xreg_lib.Category
     XRegMode = xreg_lib.XRegMode
+    XRegSolver = xreg_lib.XRegSolver
+    XRegBackend = xreg_lib.XRegBackend
 else:
     Category = int | str
     XRegMode = str
+    XRegSolver = str
+    XRegBackend = str
 
 _TOL = 1e-6
 DEFAULT_QUANTILES = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
@@ -136,6 +142,23 @@ def _normalize(batch):
   return new_batch, stats
 
 
+# Per time series normalization of an `xreg_lib.RaggedArray`: forward.
+def _normalize_ragged(batch):
+  lens = batch.lens
+  segments = np.repeat(np.arange(len(lens)), lens)
+  values = batch.flat_values
+  counts = np.maximum(lens, 1)
+  mu = np.bincount(segments, weights=values, minlength=len(lens)) / counts
+  centered = values - mu[segments]
+  sigma = np.sqrt(
+      np.bincount(segments, weights=centered**2, minlength=len(lens)) / counts)
+  sigma = np.where(sigma > _TOL, sigma, 1.0)
+  new_batch = dataclasses.replace(batch,
+                                  values=centered / sigma[segments],
+                                  offsets=batch.offsets - batch.offsets[0])
+  return new_batch, np.stack([mu, sigma], axis=1)
+
+
 # Per time series normalization: inverse.
 def _renormalize(batch, stats):
   return [x * stat[1] + stat[0] for x, stat in zip(batch, stats)]
@@ -163,6 +186,8 @@ class TimesFmHparams:
     per_core_batch_size: Batch size on each core for data parallelism.
     backend: One of "cpu", "gpu" or "tpu".
     quantiles: Which quantiles are output by the model.
+    pipeline_depth: How many batches `forecast` prepares ahead of, and fetches
+      behind, the batch running on the model. 0 runs every stage sequentially.
   """
 
   context_len: int = 512
@@ -178,6 +203,7 @@ class TimesFmHparams:
   use_positional_embedding: bool = True
   # Hparams beyond the model.
   point_forecast_mode: Literal["mean", "median"] = "median"
+  pipeline_depth: int = 2
 
 
 @dataclasses.dataclass(kw_only=True)
@@ -202,6 +228,29 @@ class TimesFmCheckpoint:
   local_dir: str | None = None
 
 
+@dataclasses.dataclass
+class ForecastTimings:
+  """Wall-clock seconds spent in each stage of the last `forecast` call.
+
+  Stages overlap when `pipeline_depth` > 0, so their sum can exceed
+  `total_seconds`. With asynchronous backends `decode_seconds` only covers
+  dispatch, and waiting for the results is accounted in `fetch_seconds`.
+
+  Attributes:
+    num_batches: Number of global batches decoded.
+    prepare_seconds: Slicing and converting host inputs into backend inputs.
+    decode_seconds: Running the model.
+    fetch_seconds: Copying outputs back to host and into the output arrays.
+    total_seconds: End-to-end time of the pipeline.
+  """
+
+  num_batches: int = 0
+  prepare_seconds: float = 0.0
+  decode_seconds: float = 0.0
+  fetch_seconds: float = 0.0
+  total_seconds: float = 0.0
+
+
 class TimesFmBase:
   """Base TimesFM forecast API for inference.
 
@@ -211,6 +260,10 @@ class TimesFmBase:
     3. Call `forecast` for inference.
   """
 
+  # Default backend of the linear model in `forecast_with_covariates`, set by
+  # subclasses to match their own framework.
+  xreg_backend: XRegBackend = "numpy"
+
   def _logging(self, s):
     print(s)
 
@@ -240,6 +293,8 @@ class TimesFmBase:
     self.quantiles = hparams.quantiles
     self.num_heads = hparams.num_heads
     self.use_pos_emb = hparams.use_positional_embedding
+    self.pipeline_depth = hparams.pipeline_depth
+    self.last_forecast_timings: ForecastTimings | None = None
 
     # Rewrite these values in __post_init__ for SPMD.
     self.num_cores = 1
@@ -311,6 +366,113 @@ class TimesFmBase:
         pmap_pad,
     )
 
+  def _prepare_batch(
+      self,
+      input_ts: np.ndarray,
+      input_padding: np.ndarray,
+      inp_freq: np.ndarray,
+  ) -> Any:
+    """Converts one global batch of host arrays into model inputs."""
+    raise NotImplementedError("`_prepare_batch` is not implemented.")
+
+  def _decode_batch(self, batch: Any) -> Any:
+    """Runs the model on the output of `_prepare_batch`."""
+    raise NotImplementedError("`_decode_batch` is not implemented.")
+
+  def _fetch_batch(
+      self,
+      outputs: Any,
+      return_forecast_on_context: bool,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the mean and full forecasts of `_decode_batch` as np.array."""
+    raise NotImplementedError("`_fetch_batch` is not implemented.")
+
+  def _pipelined_decode(
+      self,
+      input_ts: np.ndarray,
+      input_padding: np.ndarray,
+      inp_freq: np.ndarray,
+      return_forecast_on_context: bool = False,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Decodes the outputs of `_preprocess` batch by batch.
+
+    With `pipeline_depth` > 0, a producer thread runs `_prepare_batch` on up to
+    `pipeline_depth` batches ahead of the one running in `_decode_batch`, and a
+    consumer thread runs `_fetch_batch` on up to `pipeline_depth` finished
+    batches, writing them into preallocated output arrays. The model itself
+    always runs on the calling thread. Stage timings are recorded in
+    `self.last_forecast_timings`.
+
+    Args:
+      input_ts: padded input time series, a multiple of `global_batch_size`.
+      input_padding: the padding indicator.
+      inp_freq: the frequency of each input time series.
+      return_forecast_on_context: True to return the forecast on the context.
+
+    Returns:
+      A tuple of the mean and the full forecasts for all rows of `input_ts`.
+    """
+    batch_size = self.global_batch_size
+    num_batches = input_ts.shape[0] // batch_size
+    depth = max(self.pipeline_depth, 0)
+    timings = ForecastTimings(num_batches=num_batches)
+    outputs = []
+
+    def prepare(i):
+      start = time.perf_counter()
+      batch = self._prepare_batch(
+          input_ts[i * batch_size:(i + 1) * batch_size],
+          input_padding[i * batch_size:(i + 1) * batch_size],
+          inp_freq[i * batch_size:(i + 1) * batch_size, :],
+      )
+      timings.prepare_seconds += time.perf_counter() - start
+      return batch
+
+    def decode(batch):
+      start = time.perf_counter()
+      decoded = self._decode_batch(batch)
+      timings.decode_seconds += time.perf_counter() - start
+      return decoded
+
+    def fetch(i, decoded):
+      start = time.perf_counter()
+      batch_outputs = self._fetch_batch(decoded, return_forecast_on_context)
+      if not outputs:
+        outputs.extend(
+            np.empty((input_ts.shape[0],) + x.shape[1:], dtype=x.dtype)
+            for x in batch_outputs)
+      for output, batch_output in zip(outputs, batch_outputs):
+        output[i * batch_size:(i + 1) * batch_size] = batch_output
+      timings.fetch_seconds += time.perf_counter() - start
+
+    start_time = time.perf_counter()
+    if depth == 0:
+      for i in range(num_batches):
+        fetch(i, decode(prepare(i)))
+    else:
+      with futures.ThreadPoolExecutor(
+          max_workers=1) as producer, futures.ThreadPoolExecutor(
+              max_workers=1) as consumer:
+        prepared = collections.deque(
+            producer.submit(prepare, i) for i in range(min(depth, num_batches)))
+        fetched = collections.deque()
+        for i in range(num_batches):
+          batch = prepared.popleft().result()
+          if i + depth < num_batches:
+            prepared.append(producer.submit(prepare, i + depth))
+          fetched.append(consumer.submit(fetch, i, decode(batch)))
+          # Bounds the number of finished batches held on the device.
+          if len(fetched) > depth:
+            fetched.popleft().result()
+        while fetched:
+          fetched.popleft().result()
+    timings.total_seconds = time.perf_counter() - start_time
+    self.last_forecast_timings = timings
+    logging.info("Forecast pipeline timings: %s", timings)
+
+    mean_outputs, full_outputs = outputs
+    return mean_outputs, full_outputs
+
   def _forecast(
       self,
       inputs: Sequence[Any],
@@ -444,6 +606,11 @@ class TimesFmBase:
       ridge: float = 0.0,
       max_rows_per_col: int = 0,
       force_on_cpu: bool = False,
+      solver: XRegSolver = "auto",
+      sparse_xreg: bool = False,
+      xreg_per_input: bool = False,
+      xreg_chunk_size: int = 0,
+      xreg_backend: XRegBackend | None = None,
   ):
     """Forecasts on a list of time series with covariates.
 
@@ -454,6 +621,9 @@ class TimesFmBase:
         should be in a format convertible to JTensor by `jnp.array`.
       dynamic_numerical_covariates: A dict of dynamic numerical covariates.
       dynamic_categorical_covariates: A dict of dynamic categorical covariates.
+        The inputs and the dynamic covariates can also be given as 2-D arrays
+        or `xreg_lib.RaggedArray`s, which are split into context and horizon
+        without a Python loop over the inputs.
       static_numerical_covariates: A dict of static numerical covariates.
       static_categorical_covariates: A dict of static categorical covariates.
       freq: frequency of each context time series. 0 for high frequency
@@ -465,11 +635,24 @@ class TimesFmBase:
       xreg_mode: one of "xreg + timesfm" or "timesfm + xreg". "xreg + timesfm"
         fits a model on the residuals of the TimesFM forecast. "timesfm + xreg"
         fits a model on the targets then forecasts on the residuals via TimesFM.
+        When fitting on the residuals of the forecast, the covariate matrices
+        are built on a worker thread while the model runs.
       normalize_xreg_target_per_input: whether to normalize the xreg target per
         input in the given batch.
       ridge: ridge penalty for the linear model.
       max_rows_per_col: max number of rows per column for the linear model.
       force_on_cpu: whether to force running on cpu for the linear model.
+      solver: the linear solver, see `BatchedInContextXRegLinear.fit`.
+      sparse_xreg: whether to fit the linear model on sparse covariate
+        matrices, for high cardinality categorical covariates.
+      xreg_per_input: whether to fit a separate linear model for each input
+        instead of one model shared by the whole batch.
+      xreg_chunk_size: if positive, the linear model is fit by accumulating
+        its normal equations over chunks of this many inputs, which bounds the
+        memory used by the covariate matrix.
+      xreg_backend: the library that solves the linear model, one of "numpy",
+        "jax" or "torch". Defaults to `self.xreg_backend`, which matches the
+        forecasting backend.
 
     Returns:
       A tuple of two lists. The first is the outputs of the model. The second is
@@ -488,40 +671,43 @@ class TimesFmBase:
 
     # Track the lengths of (1) each input, (2) the part that can be used in the
     # linear model, and (3) the horizon.
-    input_lens, train_lens, test_lens = [], [], []
-
-    for i, input_ts in enumerate(inputs):
-      input_len = len(input_ts)
-      input_lens.append(input_len)
-
-      if xreg_mode == "timesfm + xreg":
-        # For fitting residuals, no TimesFM forecast on the first patch.
-        train_lens.append(max(0, input_len - self.input_patch_len))
-      elif xreg_mode == "xreg + timesfm":
-        train_lens.append(input_len)
-      else:
-        raise ValueError(f"Unsupported mode: {xreg_mode}")
-
-      if dynamic_numerical_covariates:
-        test_lens.append(
-            len(list(dynamic_numerical_covariates.values())[0][i]) - input_len)
-      elif dynamic_categorical_covariates:
-        test_lens.append(
-            len(list(dynamic_categorical_covariates.values())[0][i]) -
-            input_len)
-      else:
-        test_lens.append(self.horizon_len)
-
-      if test_lens[-1] > self.horizon_len:
-        raise ValueError(
-            "Forecast requested longer horizon than the model definition "
-            f"supports: {test_lens[-1]} vs {self.horizon_len}.")
+    contexts = xreg_lib.RaggedArray.from_sequences(inputs)
+    input_lens = contexts.lens
+    if xreg_mode == "timesfm + xreg":
+      # For fitting residuals, no TimesFM forecast on the first patch, and
+      # none before the last `context_len` points of longer inputs.
+      train_lens = np.clip(input_lens - self.input_patch_len, 0,
+                           self._horizon_start)
+    elif xreg_mode == "xreg + timesfm":
+      train_lens = input_lens
+    else:
+      raise ValueError(f"Unsupported mode: {xreg_mode}")
+
+    # Flatten the dynamic covariates once, so that they are split into train
+    # and test by two gathers instead of one slice per input.
+    dynamic_numerical_covariates = {
+        name: xreg_lib.RaggedArray.from_sequences(values)
+        for name, values in (dynamic_numerical_covariates or {}).items()
+    }
+    dynamic_categorical_covariates = {
+        name: xreg_lib.RaggedArray.from_sequences(values)
+        for name, values in (dynamic_categorical_covariates or {}).items()
+    }
+    if dynamic_covariates := (dynamic_numerical_covariates or
+                              dynamic_categorical_covariates):
+      test_lens = next(iter(dynamic_covariates.values())).lens - input_lens
+    else:
+      test_lens = np.full(len(input_lens), self.horizon_len)
+    if np.any(test_lens > self.horizon_len):
+      raise ValueError(
+          "Forecast requested longer horizon than the model definition "
+          f"supports: {np.max(test_lens)} vs {self.horizon_len}.")
 
     # Prepare the covariates into train and test.
-    train_dynamic_numerical_covariates = collections.defaultdict(list)
-    test_dynamic_numerical_covariates = collections.defaultdict(list)
-    train_dynamic_categorical_covariates = collections.defaultdict(list)
-    test_dynamic_categorical_covariates = collections.defaultdict(list)
+    train_dynamic_numerical_covariates = {}
+    test_dynamic_numerical_covariates = {}
+    train_dynamic_categorical_covariates = {}
+    test_dynamic_categorical_covariates = {}
     for covariates, train_covariates, test_covariates in (
         (
             dynamic_numerical_covariates,
@@ -534,38 +720,19 @@ class TimesFmBase:
             test_dynamic_categorical_covariates,
         ),
     ):
-      if not covariates:
-        continue
       for covariate_name, covariate_values in covariates.items():
-        for input_len, train_len, covariate_value in zip(
-            input_lens, train_lens, covariate_values):
-          train_covariates[covariate_name].append(
-              covariate_value[(input_len - train_len):input_len])
-          test_covariates[covariate_name].append(covariate_value[input_len:])
+        train_covariates[covariate_name] = covariate_values.slice_each(
+            input_lens - train_lens, input_lens)
+        test_covariates[covariate_name] = covariate_values.slice_each(
+            input_lens, covariate_values.lens)
 
     # Fit models.
     if xreg_mode == "timesfm + xreg":
       # Forecast via TimesFM then fit a model on the residuals.
-      mean_outputs, _ = self.forecast(
-          inputs,
-          freq,
-          window_size,
-          forecast_context_len,
-          return_forecast_on_context=True,
-      )
-      targets = [
-          (np.array(input_ts)[-train_len:] -
-           mean_output[(self._horizon_start - train_len):self._horizon_start])
-          for input_ts, mean_output, train_len in zip(inputs, mean_outputs,
-                                                      train_lens)
-      ]
-      per_instance_stats = None
-      if normalize_xreg_target_per_input:
-        targets, per_instance_stats = _normalize(targets)
-      xregs = xreg_lib.BatchedInContextXRegLinear(
-          targets=targets,
-          train_lens=train_lens,
-          test_lens=test_lens,
+      xreg_model = xreg_lib.BatchedInContextXRegLinear(
+          targets=None,
+          train_lens=train_lens.tolist(),
+          test_lens=test_lens.tolist(),
           train_dynamic_numerical_covariates=train_dynamic_numerical_covariates,
           test_dynamic_numerical_covariates=test_dynamic_numerical_covariates,
           train_dynamic_categorical_covariates=
@@ -574,11 +741,49 @@ class TimesFmBase:
           test_dynamic_categorical_covariates,
           static_numerical_covariates=static_numerical_covariates,
           static_categorical_covariates=static_categorical_covariates,
-      ).fit(
+      )
+      one_hot_encoder_drop = None if ridge > 0 else "first"
+      # The covariate matrices do not depend on the residuals, so they are
+      # built on a worker thread while the model forecasts.
+      with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        design = executor.submit(
+            xreg_model.prepare,
+            one_hot_encoder_drop=one_hot_encoder_drop,
+            sparse_output=sparse_xreg,
+            chunk_size=xreg_chunk_size,
+            assert_covariates=True,
+            assert_covariate_shapes=True,
+        )
+        mean_outputs, _ = self.forecast(
+            inputs,
+            freq,
+            window_size,
+            forecast_context_len,
+            return_forecast_on_context=True,
+        )
+        design = design.result()
+      context_outputs = xreg_lib.RaggedArray.from_sequences(
+          mean_outputs).slice_each(self._horizon_start - train_lens,
+                                   self._horizon_start)
+      targets = contexts.slice_each(input_lens - train_lens, input_lens)
+      targets = dataclasses.replace(targets,
+                                    values=targets.values -
+                                    context_outputs.values)
+      per_instance_stats = None
+      if normalize_xreg_target_per_input:
+        targets, per_instance_stats = _normalize_ragged(targets)
+      xreg_model.targets = targets
+      xregs = xreg_model.fit(
           ridge=ridge,
-          one_hot_encoder_drop=None if ridge > 0 else "first",
+          one_hot_encoder_drop=one_hot_encoder_drop,
           max_rows_per_col=max_rows_per_col,
           force_on_cpu=force_on_cpu,
+          solver=solver,
+          sparse_design=sparse_xreg,
+          per_input=xreg_per_input,
+          chunk_size=xreg_chunk_size,
+          backend=xreg_backend or self.xreg_backend,
+          design=design,
           debug_info=False,
           assert_covariates=True,
           assert_covariate_shapes=True,
@@ -593,17 +798,14 @@ class TimesFmBase:
 
     else:
       # Fit a model on the targets then forecast on the residuals via TimesFM.
-      targets = [
-          np.array(input_ts)[-train_len:]
-          for input_ts, train_len in zip(inputs, train_lens)
-      ]
+      targets = contexts.slice_each(input_lens - train_lens, input_lens)
       per_instance_stats = None
       if normalize_xreg_target_per_input:
-        targets, per_instance_stats = _normalize(targets)
+        targets, per_instance_stats = _normalize_ragged(targets)
       xregs, xregs_on_context, _, _, _ = xreg_lib.BatchedInContextXRegLinear(
           targets=targets,
-          train_lens=train_lens,
-          test_lens=test_lens,
+          train_lens=train_lens.tolist(),
+          test_lens=test_lens.tolist(),
           train_dynamic_numerical_covariates=train_dynamic_numerical_covariates,
           test_dynamic_numerical_covariates=test_dynamic_numerical_covariates,
           train_dynamic_categorical_covariates=
@@ -617,6 +819,11 @@ class TimesFmBase:
           one_hot_encoder_drop=None if ridge > 0 else "first",
           max_rows_per_col=max_rows_per_col,
           force_on_cpu=force_on_cpu,
+          solver=solver,
+          sparse_design=sparse_xreg,
+          per_input=xreg_per_input,
+          chunk_size=xreg_chunk_size,
+          backend=xreg_backend or self.xreg_backend,
           debug_info=True,
           assert_covariates=True,
           assert_covariate_shapes=True,
@@ -734,3 +941,170 @@ class TimesFmBase:
         fcst_df[model_name] = fcst_df[q_col]
     logging.info("Finished creating output dataframe.")
     return fcst_df
+
+  def forecast_with_covariates_on_df(
+      self,
+      inputs: pd.DataFrame,
+      freq: str,
+      future_df: pd.DataFrame | None = None,
+      dynamic_numerical_covariates: Sequence[str] = (),
+      dynamic_categorical_covariates: Sequence[str] = (),
+      static_numerical_covariates: Sequence[str] = (),
+      static_categorical_covariates: Sequence[str] = (),
+      forecast_context_len: int = 0,
+      value_name: str = "values",
+      model_name: str = "timesfm",
+      window_size: int | None = None,
+      xreg_mode: XRegMode = "xreg + timesfm",
+      normalize_xreg_target_per_input: bool = True,
+      ridge: float = 0.0,
+      max_rows_per_col: int = 0,
+      force_on_cpu: bool = False,
+      solver: XRegSolver = "auto",
+      sparse_xreg: bool = False,
+      xreg_per_input: bool = False,
+      xreg_chunk_size: int = 0,
+      xreg_backend: XRegBackend | None = None,
+  ) -> pd.DataFrame:
+    """Forecasts on all time series of a dataframe with covariates.
+
+    The dataframes are converted to the flat buffers of `xreg_lib.RaggedArray`
+    with vectorized group boundaries, without any per series pandas objects,
+    and forecasted by `forecast_with_covariates`.
+
+    Args:
+      inputs: A pd.DataFrame of the history of all time series. The dataframe
+        should have a `unique_id` column for identifying the time series, a
+        `ds` column for timestamps, a value column for the time series values
+        and the covariate columns.
+      freq: string valued `freq` of data. Notice this is different from the
+        `freq` required by `forecast`. See `freq_map` for allowed values.
+      future_df: A pd.DataFrame with the `unique_id` and `ds` columns of the
+        time points to forecast, at most `horizon_len` per series, and the
+        dynamic covariate columns. Every series of `inputs` must be in it. If
+        None, which requires no dynamic covariates, the next `horizon_len`
+        time points of each series are forecasted.
+      dynamic_numerical_covariates: Names of the dynamic numerical covariate
+        columns, present in both `inputs` and `future_df`.
+      dynamic_categorical_covariates: Names of the dynamic categorical covariate
+        columns, present in both `inputs` and `future_df`.
+      static_numerical_covariates: Names of the static numerical covariate
+        columns of `inputs`, whose last value in each series is used.
+      static_categorical_covariates: Names of the static categorical covariate
+        columns of `inputs`, whose last value in each series is used.
+      forecast_context_len: If provided none zero, we take the last
+        `forecast_context_len` time-points from each series as the forecast
+        context instead of the `context_len` set by the model.
+      value_name: The name of the value column.
+      model_name: name of the model to be written into future df.
+      window_size: window size of trend + residual decomposition. If None then
+        we do not do decomposition.
+      xreg_mode: See `forecast_with_covariates`.
+      normalize_xreg_target_per_input: See `forecast_with_covariates`.
+      ridge: See `forecast_with_covariates`.
+      max_rows_per_col: See `forecast_with_covariates`.
+      force_on_cpu: See `forecast_with_covariates`.
+      solver: See `forecast_with_covariates`.
+      sparse_xreg: See `forecast_with_covariates`.
+      xreg_per_input: See `forecast_with_covariates`.
+      xreg_chunk_size: See `forecast_with_covariates`.
+      xreg_backend: See `forecast_with_covariates`.
+
+    Returns:
+      Future forecasts dataframe with the `unique_id` and `ds` columns, the
+      forecasts in the `model_name` column and the part of them due to the
+      covariates in the `f"{model_name}-xreg"` column.
+    """
+    from . import xreg_lib
+
+    dynamic_covariates = (list(dynamic_numerical_covariates) +
+                          list(dynamic_categorical_covariates))
+    static_covariates = (list(static_numerical_covariates) +
+                         list(static_categorical_covariates))
+    if missing := {"unique_id", "ds", value_name, *dynamic_covariates, *
+                   static_covariates} - set(inputs.columns):
+      raise ValueError(f"inputs is missing columns: {sorted(missing)}.")
+    if future_df is None and dynamic_covariates:
+      raise ValueError("future_df is required with dynamic covariates.")
+    if future_df is not None and (missing := {
+        "unique_id", "ds", *dynamic_covariates
+    } - set(future_df.columns)):
+      raise ValueError(f"future_df is missing columns: {sorted(missing)}.")
+    if not forecast_context_len:
+      forecast_context_len = self.context_len
+
+    # Series boundaries of the sorted history, trimmed to the context length.
+    history = inputs.sort_values(by=["unique_id", "ds"])
+    history = history[history.groupby("unique_id").cumcount(
+        ascending=False).to_numpy() < forecast_context_len]
+    history_codes, uids = pd.factorize(history["unique_id"])
+    history_lens = np.bincount(history_codes, minlength=len(uids))
+    history_offsets = np.concatenate([[0], np.cumsum(history_lens)])
+    last_rows = history_offsets[1:] - 1
+
+    if future_df is None:
+      future_df = make_future_dataframe(
+          uids=pd.Series(uids),
+          last_times=history["ds"].iloc[last_rows],
+          h=self.horizon_len,
+          freq=freq,
+      )
+    future = future_df.sort_values(by=["unique_id", "ds"])
+    future_codes = uids.get_indexer(future["unique_id"])
+    future_lens = np.bincount(future_codes[future_codes >= 0],
+                              minlength=len(uids))
+    if np.any(future_codes < 0) or np.any(future_lens == 0):
+      raise ValueError("inputs and future_df must have the same unique_ids.")
+    if np.any(future_lens > self.horizon_len):
+      raise ValueError(
+          "Forecast requested longer horizon than the model definition "
+          f"supports: {np.max(future_lens)} vs {self.horizon_len}.")
+
+    # A stable sort of the codes puts the horizon of each series right after
+    # its context.
+    order = np.argsort(np.concatenate([history_codes, future_codes]),
+                       kind="stable")
+    dynamic_offsets = np.concatenate(
+        [[0], np.cumsum(history_lens + future_lens)])
+
+    def dynamic(names):
+      return {
+          name: xreg_lib.RaggedArray(
+              np.concatenate([
+                  history[name].to_numpy(), future[name].to_numpy()
+              ])[order], dynamic_offsets) for name in names
+      }
+
+    def static(names):
+      return {name: history[name].to_numpy()[last_rows] for name in names}
+
+    outputs, xregs = self.forecast_with_covariates(
+        inputs=xreg_lib.RaggedArray(
+            history[value_name].to_numpy(dtype=np.float64), history_offsets),
+        dynamic_numerical_covariates=dynamic(dynamic_numerical_covariates),
+        dynamic_categorical_covariates=dynamic(dynamic_categorical_covariates),
+        static_numerical_covariates=static(static_numerical_covariates),
+        static_categorical_covariates=static(static_categorical_covariates),
+        freq=[freq_map(freq)] * len(uids),
+        window_size=window_size,
+        forecast_context_len=forecast_context_len,
+        xreg_mode=xreg_mode,
+        normalize_xreg_target_per_input=normalize_xreg_target_per_input,
+        ridge=ridge,
+        max_rows_per_col=max_rows_per_col,
+        force_on_cpu=force_on_cpu,
+        solver=solver,
+        sparse_xreg=sparse_xreg,
+        xreg_per_input=xreg_per_input,
+        xreg_chunk_size=xreg_chunk_size,
+        xreg_backend=xreg_backend,
+    )
+
+    # Without dynamic covariates, the outputs span the full model horizon.
+    fcst_df = future[["unique_id", "ds"]].reset_index(drop=True)
+    for column, values in ((model_name, outputs),
+                           (f"{model_name}-xreg", xregs)):
+      fcst_df[column] = xreg_lib.RaggedArray.from_sequences(values).slice_each(
+          0, future_lens).values
+    logging.info("Finished creating output dataframe.")
+    return fcst_df
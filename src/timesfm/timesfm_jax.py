@@ -54,6 +54,8 @@ class TimesFmJax(timesfm_base.TimesFmBase):
   to `forecast` reflect the actual inference latency.
   """
 
+  xreg_backend = "jax"
+
   def _get_sample_inputs(self):
     return {
         "input_ts":
@@ -236,6 +238,58 @@ class TimesFmJax(timesfm_base.TimesFmBase):
           }))
     self._logging(f"Jitted decoding in {time.time() - start_time:.2f} seconds.")
 
+  def _prepare_batch(
+      self,
+      input_ts: np.ndarray,
+      input_padding: np.ndarray,
+      inp_freq: np.ndarray,
+  ) -> NestedMap:
+    return NestedMap({
+        "input_ts":
+            es.jax_einshape(
+                "(db)...->db...",
+                jnp.array(input_ts),
+                d=self.num_cores,
+            ),
+        "input_padding":
+            es.jax_einshape(
+                "(db)...->db...",
+                jnp.array(input_padding),
+                d=self.num_cores,
+            ),
+        "date_features":
+            None,
+        "freq":
+            es.jax_einshape(
+                "(db)...->db...",
+                jnp.array(inp_freq, dtype=jnp.int32),
+                d=self.num_cores,
+            ),
+    })
+
+  def _decode_batch(self, batch: NestedMap) -> tuple[JTensor, JTensor]:
+    # Dispatch is asynchronous, so this returns before the decode finishes and
+    # the next batch can be dispatched while `_fetch_batch` waits on this one.
+    with base_layer.JaxContext.new_context(hparams=self._eval_context):
+      return self._pmapped_decode(batch)
+
+  def _fetch_batch(
+      self,
+      outputs: tuple[JTensor, JTensor],
+      return_forecast_on_context: bool,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    mean_output, full_output = outputs
+    if not return_forecast_on_context:
+      mean_output = mean_output[:, :, self._horizon_start:, ...]
+      full_output = full_output[:, :, self._horizon_start:, ...]
+    mean_output = es.jax_einshape("db...->(db)...",
+                                  mean_output,
+                                  d=self.num_cores)
+    full_output = es.jax_einshape("db...->(db)...",
+                                  full_output,
+                                  d=self.num_cores)
+    return np.array(mean_output), np.array(full_output)
+
   def _forecast(
       self,
       inputs: Sequence[Any],
@@ -288,60 +342,13 @@ class TimesFmJax(timesfm_base.TimesFmBase):
       freq = [0] * len(inputs)
 
     input_ts, input_padding, inp_freq, pmap_pad = self._preprocess(inputs, freq)
-    with base_layer.JaxContext.new_context(hparams=self._eval_context):
-      mean_outputs = []
-      full_outputs = []
-      assert input_ts.shape[0] % self.global_batch_size == 0
-      for i in range(input_ts.shape[0] // self.global_batch_size):
-        input_ts_in = jnp.array(input_ts[i * self.global_batch_size:(i + 1) *
-                                         self.global_batch_size])
-        input_padding_in = jnp.array(
-            input_padding[i * self.global_batch_size:(i + 1) *
-                          self.global_batch_size],)
-        inp_freq_in = jnp.array(
-            inp_freq[i * self.global_batch_size:(i + 1) *
-                     self.global_batch_size, :],
-            dtype=jnp.int32,
-        )
-        pmapped_inputs = NestedMap({
-            "input_ts":
-                es.jax_einshape(
-                    "(db)...->db...",
-                    input_ts_in,
-                    d=self.num_cores,
-                ),
-            "input_padding":
-                es.jax_einshape(
-                    "(db)...->db...",
-                    input_padding_in,
-                    d=self.num_cores,
-                ),
-            "date_features":
-                None,
-            "freq":
-                es.jax_einshape(
-                    "(db)...->db...",
-                    inp_freq_in,
-                    d=self.num_cores,
-                ),
-        })
-        mean_output, full_output = self._pmapped_decode(pmapped_inputs)
-        if not return_forecast_on_context:
-          mean_output = mean_output[:, :, self._horizon_start:, ...]
-          full_output = full_output[:, :, self._horizon_start:, ...]
-        mean_output = es.jax_einshape("db...->(db)...",
-                                      mean_output,
-                                      d=self.num_cores)
-        full_output = es.jax_einshape("db...->(db)...",
-                                      full_output,
-                                      d=self.num_cores)
-        mean_output = np.array(mean_output)
-        full_output = np.array(full_output)
-        mean_outputs.append(mean_output)
-        full_outputs.append(full_output)
-
-    mean_outputs = np.concatenate(mean_outputs, axis=0)
-    full_outputs = np.concatenate(full_outputs, axis=0)
+    assert input_ts.shape[0] % self.global_batch_size == 0
+    mean_outputs, full_outputs = self._pipelined_decode(
+        input_ts,
+        input_padding,
+        inp_freq,
+        return_forecast_on_context,
+    )
 
     if pmap_pad > 0:
       mean_outputs = mean_outputs[:-pmap_pad, ...]
@@ -14,22 +14,71 @@
 """TimesFM pytorch forecast API for inference."""
 
 import logging
+import os
+import queue
 from os import path
 from typing import Any, Sequence
 
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from huggingface_hub import snapshot_download
+from safetensors import torch as safetensors_torch
 from timesfm import timesfm_base
 
 from . import pytorch_patched_decoder as ppd
 
 _TOL = 1e-6
+_TORCH_CHECKPOINT = "torch_model.ckpt"
+_SAFETENSORS_CHECKPOINT = "torch_model.safetensors"
+
+
+def _load_state_dict(checkpoint_path: str,
+                     device: torch.device) -> dict[str, torch.Tensor]:
+  """Loads a state dict backed by a memory map of `checkpoint_path`.
+
+  Tensors read from the map are paged in on first access and the pages are
+  shared through the page cache by every process loading the same file.
+  """
+  if checkpoint_path.endswith(".safetensors"):
+    return safetensors_torch.load_file(checkpoint_path, device=str(device))
+  return torch.load(checkpoint_path,
+                    map_location=device,
+                    weights_only=True,
+                    mmap=True)
+
+
+def convert_checkpoint_to_safetensors(checkpoint_path: str,
+                                      output_path: str | None = None) -> str:
+  """Converts a `torch_model.ckpt` checkpoint into the safetensors format.
+
+  `TimesFmTorch.load_from_checkpoint` prefers a `torch_model.safetensors` file
+  next to `torch_model.ckpt` when loading from a Hugging Face snapshot.
+
+  Args:
+    checkpoint_path: Path to the checkpoint saved by `torch.save`.
+    output_path: Where to write the converted checkpoint. Defaults to
+      `checkpoint_path` with a `.safetensors` extension.
+
+  Returns:
+    The path of the converted checkpoint.
+  """
+  if output_path is None:
+    output_path = path.splitext(checkpoint_path)[0] + ".safetensors"
+  state_dict = torch.load(checkpoint_path,
+                          map_location="cpu",
+                          weights_only=True,
+                          mmap=True)
+  safetensors_torch.save_file(
+      {k: v.contiguous() for k, v in state_dict.items()}, output_path)
+  return output_path
 
 
 class TimesFmTorch(timesfm_base.TimesFmBase):
   """TimesFM forecast API for inference."""
 
+  xreg_backend = "torch"
+
   def __post_init__(self):
     self._model_config = ppd.TimesFMConfig(
         num_layers=self.num_layers,
@@ -57,18 +106,70 @@ class TimesFmTorch(timesfm_base.TimesFmBase):
     checkpoint_path = checkpoint.path
     repo_id = checkpoint.huggingface_repo_id
     if checkpoint_path is None:
-      checkpoint_path = path.join(
-          snapshot_download(repo_id, local_dir=checkpoint.local_dir),
-          "torch_model.ckpt")
-    self._model = ppd.PatchedTimeSeriesDecoder(self._model_config)
-    loaded_checkpoint = torch.load(checkpoint_path, weights_only=True)
-    logging.info("Loading checkpoint from %s", checkpoint_path)
-    self._model.load_state_dict(loaded_checkpoint)
-    logging.info("Sending checkpoint to device %s", f"{self._device}")
-    self._model.to(self._device)
+      snapshot_dir = snapshot_download(repo_id, local_dir=checkpoint.local_dir)
+      checkpoint_path = path.join(snapshot_dir, _SAFETENSORS_CHECKPOINT)
+      if not path.exists(checkpoint_path):
+        checkpoint_path = path.join(snapshot_dir, _TORCH_CHECKPOINT)
+    # Build the model without allocating its weights and adopt the memory
+    # mapped tensors as parameters, so no second copy is materialized.
+    with torch.device("meta"):
+      self._model = ppd.PatchedTimeSeriesDecoder(self._model_config)
+    logging.info("Loading checkpoint from %s to device %s", checkpoint_path,
+                 f"{self._device}")
+    loaded_checkpoint = _load_state_dict(checkpoint_path, self._device)
+    self._model.load_state_dict(loaded_checkpoint, assign=True)
     self._model.eval()
     # TODO: add compilation.
 
+  def _to_device(self, x: np.ndarray, dtype: np.dtype) -> torch.Tensor:
+    t = torch.from_numpy(np.ascontiguousarray(x, dtype=dtype))
+    if self._device.type == "cuda":
+      # Pinned host buffers let the copy overlap with the running batch.
+      return t.pin_memory().to(self._device, non_blocking=True)
+    return t
+
+  def _prepare_batch(
+      self,
+      input_ts: np.ndarray,
+      input_padding: np.ndarray,
+      inp_freq: np.ndarray,
+  ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    return (
+        self._to_device(input_ts, np.float32),
+        self._to_device(input_padding, np.float32),
+        self._to_device(inp_freq, np.int64),
+    )
+
+  def _decode_batch(
+      self,
+      batch: tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+  ) -> tuple[torch.Tensor, torch.Tensor]:
+    t_input_ts, t_input_padding, t_inp_freq = batch
+    with torch.no_grad():
+      return self._model.decode(
+          input_ts=t_input_ts,
+          paddings=t_input_padding,
+          freq=t_inp_freq,
+          horizon_len=self.horizon_len,
+          output_patch_len=self.output_patch_len,
+          # Returns forecasts on context for parity with the Jax version.
+          return_forecast_on_context=True,
+      )
+
+  def _fetch_batch(
+      self,
+      outputs: tuple[torch.Tensor, torch.Tensor],
+      return_forecast_on_context: bool,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    mean_output, full_output = outputs
+    if not return_forecast_on_context:
+      mean_output = mean_output[:, self._horizon_start:, ...]
+      full_output = full_output[:, self._horizon_start:, ...]
+    return (
+        mean_output.detach().cpu().numpy(),
+        full_output.detach().cpu().numpy(),
+    )
+
   def _forecast(
       self,
       inputs: Sequence[Any],
@@ -118,44 +219,12 @@ class TimesFmTorch(timesfm_base.TimesFmBase):
       freq = [0] * len(inputs)
 
     input_ts, input_padding, inp_freq, pmap_pad = self._preprocess(inputs, freq)
-
-    with torch.no_grad():
-      mean_outputs = []
-      full_outputs = []
-      for i in range(input_ts.shape[0] // self.global_batch_size):
-        t_input_ts = torch.Tensor(input_ts[i * self.global_batch_size:(i + 1) *
-                                           self.global_batch_size]).to(
-                                               self._device)
-        t_input_padding = torch.Tensor(
-            input_padding[i * self.global_batch_size:(i + 1) *
-                          self.global_batch_size]).to(self._device)
-        t_inp_freq = torch.LongTensor(
-            inp_freq[i * self.global_batch_size:(i + 1) *
-                     self.global_batch_size, :]).to(self._device)
-
-        mean_output, full_output = self._model.decode(
-            input_ts=t_input_ts,
-            paddings=t_input_padding,
-            freq=t_inp_freq,
-            horizon_len=self.horizon_len,
-            output_patch_len=self.output_patch_len,
-            # Returns forecasts on context for parity with the Jax version.
-            return_forecast_on_context=True,
-        )
-        if not return_forecast_on_context:
-          mean_output = mean_output[:, self._horizon_start:, ...]
-          full_output = full_output[:, self._horizon_start:, ...]
-
-        if self.backend == "gpu":
-          mean_output = mean_output.cpu()
-          full_output = full_output.cpu()
-        mean_output = mean_output.detach().numpy()
-        full_output = full_output.detach().numpy()
-        mean_outputs.append(mean_output)
-        full_outputs.append(full_output)
-
-    mean_outputs = np.concatenate(mean_outputs, axis=0)
-    full_outputs = np.concatenate(full_outputs, axis=0)
+    mean_outputs, full_outputs = self._pipelined_decode(
+        input_ts,
+        input_padding,
+        inp_freq,
+        return_forecast_on_context,
+    )
 
     if pmap_pad > 0:
       mean_outputs = mean_outputs[:-pmap_pad, ...]
@@ -166,3 +235,191 @@ class TimesFmTorch(timesfm_base.TimesFmBase):
       full_outputs = full_outputs[0::2, ...] + full_outputs[1::2, ...]
 
     return mean_outputs, full_outputs
+
+
+def _pool_worker(
+    tfm: TimesFmTorch,
+    cpus: Sequence[int],
+    num_threads: int,
+    task_queue: Any,
+    result_queue: Any,
+) -> None:
+  """Serves `forecast` requests from `task_queue` until it reads None."""
+  if cpus and hasattr(os, "sched_setaffinity"):
+    os.sched_setaffinity(0, cpus)
+  torch.set_num_threads(num_threads)
+  while (task := task_queue.get()) is not None:
+    task_id, kwargs = task
+    try:
+      result_queue.put((task_id, tfm.forecast(**kwargs), None))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      result_queue.put((task_id, None, e))
+
+
+class TimesFmTorchPool:
+  """Shards `forecast` calls of a CPU `TimesFmTorch` across worker processes.
+
+  Torch only scales a single process through intra-op threads, which stops
+  paying off beyond a handful of cores at small batch sizes. The pool instead
+  runs `num_workers` processes, each pinned to its own subset of the available
+  cores and running its own intra-op threads. The model weights are moved into
+  shared memory once and mapped read-only by every worker, so resident memory
+  stays at about one copy of the weights regardless of `num_workers`.
+
+  Example:
+    ```
+    tfm = TimesFmTorch(hparams=..., checkpoint=...)
+    with TimesFmTorchPool(tfm, num_workers=4) as pool:
+      point_forecast, full_forecast = pool.forecast(inputs, freq)
+    ```
+  """
+
+  def __init__(
+      self,
+      tfm: TimesFmTorch,
+      num_workers: int,
+      threads_per_worker: int | None = None,
+      pin_cpus: bool = True,
+      start_method: str = "spawn",
+  ) -> None:
+    """Starts the worker processes.
+
+    Args:
+      tfm: A `TimesFmTorch` with a loaded checkpoint on cpu.
+      num_workers: Number of worker processes.
+      threads_per_worker: Intra-op threads of each worker. Defaults to the
+        number of cores assigned to the worker.
+      pin_cpus: Whether to pin each worker to a disjoint subset of the cores
+        available to this process. Only supported on Linux.
+      start_method: Multiprocessing start method of the workers. "fork" starts
+        faster but is unsafe once torch has started its own threads.
+    """
+    if tfm._model is None:
+      raise ValueError("Checkpoint is not properly loaded.")
+    if tfm._device.type != "cpu":
+      raise ValueError(
+          f"TimesFmTorchPool only supports cpu, got device {tfm._device}.")
+    if num_workers < 1:
+      raise ValueError(f"num_workers must be positive, got {num_workers}.")
+
+    if hasattr(os, "sched_getaffinity"):
+      cpus = sorted(os.sched_getaffinity(0))
+    else:
+      cpus = list(range(os.cpu_count() or 1))
+    cpu_groups = [
+        [int(c) for c in group]
+        for group in np.array_split(np.array(cpus), num_workers)
+    ]
+
+    # Shared storages are passed to the workers by handle instead of by value.
+    tfm._model.share_memory()
+    self._tfm = tfm
+    self._num_workers = num_workers
+    ctx = mp.get_context(start_method)
+    self._task_queue = ctx.Queue()
+    self._result_queue = ctx.Queue()
+    self._workers = []
+    for group in cpu_groups:
+      worker = ctx.Process(
+          target=_pool_worker,
+          args=(
+              tfm,
+              group if pin_cpus else [],
+              threads_per_worker or max(len(group), 1),
+              self._task_queue,
+              self._result_queue,
+          ),
+          daemon=True,
+      )
+      worker.start()
+      self._workers.append(worker)
+
+  def forecast(
+      self,
+      inputs: Sequence[Any],
+      freq: Sequence[int] | None = None,
+      window_size: int | None = None,
+      forecast_context_len: int | None = None,
+      return_forecast_on_context: bool = False,
+      normalize: bool = False,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Forecasts on a list of time series. See `TimesFmBase.forecast`.
+
+    The inputs are split into contiguous shards of whole batches, forecast in
+    parallel by the workers and gathered back in the order of `inputs`.
+
+    Raises:
+      RuntimeError: If a worker process died. The other workers are then
+        stopped and the pool is closed, as results of the failed call could
+        still be in flight.
+    """
+    if not self._workers:
+      raise ValueError("The pool is closed.")
+    self._raise_if_a_worker_died()
+    if len(inputs) == 0:
+      horizon_len = self._tfm.horizon_len
+      if return_forecast_on_context:
+        horizon_len += self._tfm._horizon_start
+      num_outputs = 1 + len(self._tfm.quantiles or [])
+      return (np.zeros((0, horizon_len), dtype=np.float32),
+              np.zeros((0, horizon_len, num_outputs), dtype=np.float32))
+    batch_size = self._tfm.global_batch_size
+    num_batches = max((len(inputs) - 1) // batch_size + 1, 1)
+    bounds = [
+        min(int(b) * batch_size, len(inputs)) for b in np.linspace(
+            0, num_batches, min(self._num_workers, num_batches) + 1).round()
+    ]
+    shards = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+    for task_id, (lo, hi) in enumerate(shards):
+      self._task_queue.put((task_id, {
+          "inputs": list(inputs[lo:hi]),
+          "freq": None if freq is None else list(freq[lo:hi]),
+          "window_size": window_size,
+          "forecast_context_len": forecast_context_len,
+          "return_forecast_on_context": return_forecast_on_context,
+          "normalize": normalize,
+      }))
+
+    results, errors = [None] * len(shards), []
+    for _ in shards:
+      while True:
+        try:
+          task_id, result, error = self._result_queue.get(timeout=1.0)
+          break
+        except queue.Empty:
+          # A killed worker never answers, e.g. when it runs out of memory.
+          self._raise_if_a_worker_died()
+      results[task_id] = result
+      if error is not None:
+        errors.append(error)
+    if errors:
+      raise errors[0]
+    return (
+        np.concatenate([r[0] for r in results], axis=0),
+        np.concatenate([r[1] for r in results], axis=0),
+    )
+
+  def _raise_if_a_worker_died(self) -> None:
+    """Terminates all the workers if one of them died, and raises."""
+    if all(worker.exitcode is None for worker in self._workers):
+      return
+    for worker in self._workers:
+      worker.terminate()
+    for worker in self._workers:
+      worker.join()
+    self._workers = []
+    raise RuntimeError("A TimesFmTorchPool worker died.")
+
+  def close(self) -> None:
+    """Stops the worker processes."""
+    for _ in self._workers:
+      self._task_queue.put(None)
+    for worker in self._workers:
+      worker.join()
+    self._workers = []
+
+  def __enter__(self) -> "TimesFmTorchPool":
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
@@ -0,0 +1,247 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""JAX solvers for in-context regression.
+
+Solvers are jitted, and inputs are padded to powers of 2 to limit re-jitting.
+This module is imported by `xreg_lib` only for the "jax" backend.
+"""
+# pylint: disable=protected-access
+
+import functools
+import logging
+import math
+from typing import Any
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from timesfm import xreg_lib
+
+
+def to_padded_array(x: np.ndarray) -> jax.Array:
+  """Pads all dimensions of `x` with zeros to the next power of 2."""
+  if x.ndim == 1:
+    (i,) = x.shape
+    di = 2**math.ceil(math.log2(i)) - i
+    return jnp.pad(x, ((0, di),), mode="constant", constant_values=0.0)
+  elif x.ndim == 2:
+    i, j = x.shape
+    di = 2**math.ceil(math.log2(i)) - i
+    dj = 2**math.ceil(math.log2(j)) - j
+    return jnp.pad(x, ((0, di), (0, dj)), mode="constant", constant_values=0.0)
+  else:
+    raise ValueError(f"Unsupported array shape: {x.shape}")
+
+
+def _ridge_diag(ridge: float, col_mask: jax.Array) -> jax.Array:
+  # Padded (all-zero) columns get a unit diagonal so they decouple from the
+  # rest of the system and solve to exactly zero.
+  return jnp.where(col_mask, ridge, 1.0)
+
+
+def _augment(x: jax.Array, y: jax.Array, ridge: float,
+             col_mask: jax.Array) -> tuple[jax.Array, jax.Array]:
+  # Ridge regression as ordinary least squares on [x; sqrt(D)] and [y; 0].
+  x_aug = jnp.concatenate(
+      [x, jnp.diag(jnp.sqrt(_ridge_diag(ridge, col_mask)))], axis=0)
+  y_aug = jnp.concatenate([y, jnp.zeros((x.shape[1],), dtype=y.dtype)])
+  return x_aug, y_aug
+
+
+@jax.jit
+def _solve_pinv(x: jax.Array, y: jax.Array, ridge: float,
+                col_mask: jax.Array) -> tuple[jax.Array, jax.Array]:
+  del col_mask  # Unused.
+  beta = (jnp.linalg.pinv(
+      x.T @ x + ridge * jnp.eye(x.shape[1]),
+      hermitian=True,
+  ) @ x.T @ y)
+  return beta, jnp.array(1.0)
+
+
+@jax.jit
+def _solve_cholesky(x: jax.Array, y: jax.Array, ridge: float,
+                    col_mask: jax.Array) -> tuple[jax.Array, jax.Array]:
+  gram = x.T @ x + jnp.diag(_ridge_diag(ridge, col_mask))
+  chol = jnp.linalg.cholesky(gram)
+  beta = jax.scipy.linalg.cho_solve((chol, True), x.T @ y)
+  pivots = jnp.diag(chol)**2 / jnp.diag(gram)
+  return beta, jnp.min(jnp.where(col_mask, pivots, 1.0))
+
+
+@jax.jit
+def _solve_qr(x: jax.Array, y: jax.Array, ridge: float,
+              col_mask: jax.Array) -> tuple[jax.Array, jax.Array]:
+  x_aug, y_aug = _augment(x, y, ridge, col_mask)
+  q, r = jnp.linalg.qr(x_aug)
+  beta = jax.scipy.linalg.solve_triangular(r, q.T @ y_aug)
+  pivots = jnp.diag(r)**2 / jnp.maximum(jnp.sum(x_aug**2, axis=0),
+                                        xreg_lib._TOL)
+  return beta, jnp.min(jnp.where(col_mask, pivots, 1.0))
+
+
+@jax.jit
+def _solve_lstsq(x: jax.Array, y: jax.Array, ridge: float,
+                 col_mask: jax.Array) -> tuple[jax.Array, jax.Array]:
+  x_aug, y_aug = _augment(x, y, ridge, col_mask)
+  return jnp.linalg.lstsq(x_aug, y_aug)[0], jnp.array(1.0)
+
+
+@functools.partial(jax.jit, static_argnames=("tol", "maxiter"))
+def _solve_cg(
+    x: jax.Array,
+    y: jax.Array,
+    ridge: float,
+    col_mask: jax.Array,
+    tol: float = 1e-5,
+    maxiter: int | None = None,
+) -> tuple[jax.Array, jax.Array]:
+  """Solves the normal equations by Jacobi preconditioned CG.
+
+  The Gram matrix is never formed, which keeps each iteration at O(rows x
+  cols) for wide designs.
+
+  Returns:
+    The coefficients and the relative residual of the normal equations.
+  """
+  diag = _ridge_diag(ridge, col_mask)
+  precond = 1.0 / (jnp.sum(x**2, axis=0) + diag)
+  matvec = lambda v: x.T @ (x @ v) + diag * v
+  xty = x.T @ y
+  beta, _ = jax.scipy.sparse.linalg.cg(matvec,
+                                       xty,
+                                       tol=tol,
+                                       maxiter=maxiter,
+                                       M=lambda v: precond * v)
+  residual = jnp.linalg.norm(matvec(beta) - xty) / jnp.maximum(
+      jnp.linalg.norm(xty), xreg_lib._TOL)
+  return beta, residual
+
+
+_SOLVERS = {
+    "pinv": _solve_pinv,
+    "cholesky": _solve_cholesky,
+    "qr": _solve_qr,
+    "lstsq": _solve_lstsq,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _checked_solver(
+    solver: str,
+    cg_tol: float = 1e-5,
+    cg_max_iters: int | None = None,
+    grouped: bool = False,
+) -> Any:
+  """Returns a jitted fn(x, y, ridge, col_mask) -> (beta, ok).
+
+  `ok` is False if the solve is deemed inaccurate. If `grouped`, the function
+  is vmapped over a leading group dimension of `x`, `y` and `col_mask`.
+  """
+  if solver == "cg":
+    solve_fn = functools.partial(_solve_cg, tol=cg_tol, maxiter=cg_max_iters)
+  elif solver in _SOLVERS:
+    solve_fn = _SOLVERS[solver]
+  else:
+    raise ValueError(f"Unsupported solver: {solver}")
+
+  def checked(x, y, ridge, col_mask):
+    beta, quality = solve_fn(x, y, ridge, col_mask)
+    if solver == "pinv":
+      return beta, jnp.array(True)
+    if solver == "cg":
+      ok = quality <= 100 * cg_tol
+    elif solver in ("cholesky", "qr"):
+      ok = quality >= xreg_lib._SOLVER_RCOND
+    else:
+      ok = jnp.array(True)
+    return beta, ok & jnp.all(jnp.isfinite(beta))
+
+  if grouped:
+    checked = jax.vmap(checked, in_axes=(0, 0, None, 0))
+  return jax.jit(checked)
+
+
+def solve(
+    x: jax.Array,
+    y: jax.Array,
+    ridge: float,
+    num_cols: int,
+    solver: xreg_lib.XRegSolver = "auto",
+    cg_tol: float = 1e-5,
+    cg_max_iters: int | None = None,
+) -> jax.Array:
+  """Solves min_beta |y - x beta|^2 + ridge * |beta|^2.
+
+  Args:
+    x: The (padded) covariate matrix.
+    y: The (padded) target vector.
+    ridge: The ridge penalty.
+    num_cols: Number of columns of `x` before padding.
+    solver: One of "auto", "pinv", "cholesky", "qr", "lstsq" or "cg", see
+      `BatchedInContextXRegLinear.fit`.
+    cg_tol: Relative tolerance of the "cg" solver.
+    cg_max_iters: Max number of iterations of the "cg" solver.
+
+  Returns:
+    The coefficients. If the chosen solver finds the design ill-conditioned
+    or fails to converge, the result of "pinv" is returned instead.
+  """
+  solver = xreg_lib._select_solver(solver, ridge, x.shape[0], num_cols)
+  col_mask = jnp.arange(x.shape[1]) < num_cols
+  beta, ok = _checked_solver(solver, cg_tol, cg_max_iters)(x, y, ridge,
+                                                           col_mask)
+  if not ok:
+    logging.info("The %s solver is inaccurate on this design, falling back to"
+                 " pinv.", solver)
+    beta, _ = _checked_solver("pinv")(x, y, ridge, col_mask)
+  return beta
+
+
+def solve_grouped(
+    x: jax.Array,
+    y: jax.Array,
+    ridge: float,
+    col_mask: jax.Array,
+    solver: xreg_lib.XRegSolver = "auto",
+    cg_tol: float = 1e-5,
+    cg_max_iters: int | None = None,
+) -> jax.Array:
+  """Solves one ridge regression per group in a single vmapped call.
+
+  Args:
+    x: The (padded) covariate matrices of shape [groups, rows, cols].
+    y: The (padded) target vectors of shape [groups, rows].
+    ridge: The ridge penalty, shared by all groups.
+    col_mask: Boolean mask of shape [groups, cols] of the columns used by each
+      group. Masked out columns get zero coefficients.
+    solver: See `solve`.
+    cg_tol: Relative tolerance of the "cg" solver.
+    cg_max_iters: Max number of iterations of the "cg" solver.
+
+  Returns:
+    The coefficients of shape [groups, cols]. Groups for which the chosen
+    solver is inaccurate get the result of "pinv" instead.
+  """
+  solver = xreg_lib._select_solver(solver, ridge, x.shape[1],
+                                   int(jnp.max(jnp.sum(col_mask, axis=-1))))
+  beta, ok = _checked_solver(solver, cg_tol, cg_max_iters,
+                             grouped=True)(x, y, ridge, col_mask)
+  if not jnp.all(ok):
+    logging.info(
+        "The %s solver is inaccurate on %d of %d designs, falling back to"
+        " pinv for them.", solver, int(jnp.sum(~ok)), len(ok))
+    beta_pinv, _ = _checked_solver("pinv", grouped=True)(x, y, ridge, col_mask)
+    beta = jnp.where(ok[:, None], beta, beta_pinv)
+  return beta
@@ -13,44 +13,690 @@
 # limitations under the License.
 """Helper functions for in-context covariates and regression."""
 
-import itertools
+import copy
+import dataclasses
+import functools
+import logging
 import math
-from typing import Any, Iterable, Literal, Mapping, Sequence
+from typing import Any, Iterable, Iterator, Literal, Mapping, Sequence
 
-import jax
-import jax.numpy as jnp
 import numpy as np
+import scipy.linalg
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
 from sklearn import preprocessing
 
 Category = int | str
 
 _TOL = 1e-6
 XRegMode = Literal["timesfm + xreg", "xreg + timesfm"]
+XRegSolver = Literal["auto", "pinv", "cholesky", "qr", "lstsq", "cg"]
+XRegBackend = Literal["numpy", "jax", "torch"]
 
+# Designs at least this wide are solved by conjugate gradient under "auto".
+_CG_MIN_COLS = 4096
+# OLS designs with fewer rows per column than this are solved by QR under
+# "auto", and by Cholesky otherwise.
+_QR_MAX_ROWS_PER_COL = 4
+# Smallest accepted ratio between a factorization pivot and the corresponding
+# diagonal entry, i.e. 1 - R^2 of a column regressed on the previous columns.
+# Below it the design is treated as ill-conditioned and the pinv solver is
+# used instead.
+_SOLVER_RCOND = 1e-5
+# Stopping tolerance of the sparse LSQR solver.
+_LSQR_TOL = 1e-10
 
-def _unnest(nested: Sequence[Sequence[Any]]) -> np.ndarray:
-  return np.array(list(itertools.chain.from_iterable(nested)))
+
+@dataclasses.dataclass(frozen=True)
+class RaggedArray:
+  """A batch of variable length sequences stored in one contiguous buffer.
+
+  Sequence `i` is `values[offsets[i]:offsets[i + 1]]`. Covariates, targets and
+  contexts can be passed in this form, or as 2-D arrays when all sequences
+  have the same length, to avoid building one Python object per sequence.
+
+  Attributes:
+    values: The concatenated sequences.
+    offsets: Nondecreasing integer array with one more element than there are
+      sequences. It does not have to start at 0, so slicing a batch never
+      copies `values`.
+  """
+
+  values: np.ndarray
+  offsets: np.ndarray
+
+  @classmethod
+  def from_sequences(cls, sequences: "Nested") -> "RaggedArray":
+    """Creates a ragged array from a list of sequences or a 2-D array."""
+    if isinstance(sequences, RaggedArray):
+      return sequences
+    if isinstance(sequences, np.ndarray) and sequences.ndim == 2:
+      num_sequences, length = sequences.shape
+      return cls(sequences.reshape(-1), np.arange(num_sequences + 1) * length)
+    sequences = [np.asarray(x) for x in sequences]
+    lens = np.fromiter(map(len, sequences), dtype=np.int64,
+                       count=len(sequences))
+    values = np.concatenate(sequences) if sequences else np.zeros(0)
+    return cls(values, np.concatenate([[0], np.cumsum(lens)]))
+
+  @property
+  def lens(self) -> np.ndarray:
+    return np.diff(self.offsets)
+
+  @property
+  def flat_values(self) -> np.ndarray:
+    """The concatenation of all sequences in the batch."""
+    return self.values[self.offsets[0]:self.offsets[-1]]
+
+  def slice_each(self, starts: np.ndarray | int,
+                 stops: np.ndarray | int) -> "RaggedArray":
+    """Returns `x[starts[i]:stops[i]]` of each sequence `x`, in one gather.
+
+    Unlike Python slicing, `starts` and `stops` must be within
+    [0, len(x)] and negative values are not supported.
+    """
+    starts = np.broadcast_to(starts, (len(self),)).astype(np.int64)
+    stops = np.broadcast_to(stops, (len(self),))
+    if np.any(starts < 0) or np.any(stops < starts) or np.any(
+        stops > self.lens):
+      raise ValueError(
+          "slice_each requires 0 <= starts <= stops <= len of each sequence.")
+    lens = stops - starts
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+    index = (np.repeat(self.offsets[:-1] + starts - offsets[:-1], lens) +
+             np.arange(offsets[-1]))
+    return RaggedArray(self.values[index], offsets)
+
+  def __len__(self) -> int:
+    return len(self.offsets) - 1
+
+  def __getitem__(self, index: int | slice) -> "np.ndarray | RaggedArray":
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self))
+      if step != 1:
+        raise ValueError("Only contiguous slices of a RaggedArray are"
+                         " supported.")
+      return RaggedArray(self.values, self.offsets[start:max(start, stop) + 1])
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError(f"Index {index} out of range for {len(self)} sequences.")
+    return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+  def __iter__(self) -> Iterator[np.ndarray]:
+    return (self.values[start:stop]
+            for start, stop in zip(self.offsets[:-1], self.offsets[1:]))
+
+
+# A batch of sequences, as a list of sequences, a 2-D array or a RaggedArray.
+Nested = Sequence[Sequence[Any]] | np.ndarray | RaggedArray
+
+
+def _lens(nested: "Nested") -> np.ndarray:
+  """Returns the length of each sequence of a batch."""
+  if isinstance(nested, np.ndarray) and nested.ndim == 2:
+    return np.full(nested.shape[0], nested.shape[1])
+  return RaggedArray.from_sequences(nested).lens
+
+
+def _unnest(nested: "Nested") -> np.ndarray:
+  return RaggedArray.from_sequences(nested).flat_values
 
 
 def _repeat(elements: Iterable[Any], counts: Iterable[int]) -> np.ndarray:
-  return np.array(
-      list(
-          itertools.chain.from_iterable(map(itertools.repeat, elements,
-                                            counts))))
-
-
-def _to_padded_jax_array(x: np.ndarray) -> jax.Array:
-  if x.ndim == 1:
-    (i,) = x.shape
-    di = 2**math.ceil(math.log2(i)) - i
-    return jnp.pad(x, ((0, di),), mode="constant", constant_values=0.0)
-  elif x.ndim == 2:
-    i, j = x.shape
-    di = 2**math.ceil(math.log2(i)) - i
-    dj = 2**math.ceil(math.log2(j)) - j
-    return jnp.pad(x, ((0, di), (0, dj)), mode="constant", constant_values=0.0)
+  return np.repeat(np.asarray(elements), np.asarray(counts, dtype=np.int64),
+                   axis=0)
+
+
+def _select_solver(solver: XRegSolver, ridge: float, num_rows: int,
+                   num_cols: int) -> str:
+  if solver != "auto":
+    return solver
+  if num_cols >= _CG_MIN_COLS:
+    return "cg"
+  # QR works on the design itself rather than the Gram matrix, which matters
+  # for OLS, but costs O(rows x cols^2) on tall designs.
+  if ridge > 0 or num_rows >= _QR_MAX_ROWS_PER_COL * num_cols:
+    return "cholesky"
+  return "qr"
+
+
+def _array_namespace(x: Any) -> Any:
+  """Returns `numpy` or `torch` depending on the type of `x`."""
+  if isinstance(x, np.ndarray):
+    return np
+  import torch  # pylint: disable=g-import-not-at-top
+  return torch
+
+
+def _cholesky_solve(chol: Any, b: Any) -> Any:
+  """Solves `gram @ beta = b` given the lower Cholesky factor of `gram`.
+
+  The two triangular solves take O(cols^2) each, where a general solve would
+  factorize the already triangular factors again in O(cols^3).
+
+  Args:
+    chol: Lower Cholesky factors of shape [..., cols, cols], as a numpy array
+      or a torch tensor.
+    b: Right-hand sides of shape [..., cols], of the same type.
+
+  Returns:
+    The solutions, of the same shape and type as `b`.
+  """
+  if isinstance(chol, np.ndarray):
+    # Batches are looped over, as older SciPy versions do not broadcast.
+    flat_chol = chol.reshape(-1, *chol.shape[-2:])
+    flat_b = b.reshape(-1, b.shape[-1])
+    return np.array([
+        scipy.linalg.cho_solve((c, True), v, check_finite=False)
+        for c, v in zip(flat_chol, flat_b)
+    ], dtype=b.dtype).reshape(b.shape)
+  import torch  # pylint: disable=g-import-not-at-top
+  return torch.cholesky_solve(b[..., None], chol)[..., 0]
+
+
+def _solve_dense(
+    x: Any,
+    y: Any,
+    ridge: float,
+    solver: XRegSolver = "auto",
+    cg_tol: float = 1e-5,
+    cg_max_iters: int | None = None,
+) -> Any:
+  """Solves min_beta |y - x beta|^2 + ridge * |beta|^2 with NumPy or PyTorch.
+
+  Unlike the "jax" backend, there is no padding and no jitting, so the first
+  call is as fast as the following ones. `x` can also be a batch of designs,
+  which are then solved independently.
+
+  Args:
+    x: The covariate matrix of shape [rows, cols] or [groups, rows, cols], as a
+      numpy array or a torch tensor.
+    y: The target vector of shape [rows] or [groups, rows], of the same type.
+    ridge: The ridge penalty.
+    solver: One of "auto", "pinv", "cholesky", "qr", "lstsq" or "cg", see
+      `BatchedInContextXRegLinear.fit`.
+    cg_tol: Relative tolerance of the "cg" solver.
+    cg_max_iters: Max number of iterations of the "cg" solver.
+
+  Returns:
+    The coefficients, of the same type as `x`. All-zero columns get zero
+    coefficients. Designs for which the chosen solver is inaccurate get the
+    result of "pinv" instead.
+  """
+  xp = _array_namespace(x)
+  cast = lambda a: a.astype(x.dtype) if xp is np else a.to(x.dtype)
+  zeros = lambda shape: (np.zeros(shape, x.dtype)
+                         if xp is np else x.new_zeros(shape))
+  num_cols = x.shape[-1]
+  col_mask = xp.any(x != 0, -2)
+  solver = _select_solver(solver, ridge, x.shape[-2],
+                          int(xp.sum(col_mask, -1).max()))
+  # All-zero columns get a unit diagonal so they decouple from the rest of the
+  # system and solve to exactly zero.
+  diag = ridge + (1.0 - ridge) * cast(~col_mask)
+  diag_index = xp.arange(num_cols)
+  x_t = x.swapaxes(-1, -2)
+  xty = (x_t @ y[..., None])[..., 0]
+  min_pivot = lambda pivots: xp.amin(xp.where(col_mask, pivots, 1.0), -1)
+
+  @functools.cache
+  def gram():
+    # Only formed by the solvers that need it, as it takes O(rows x cols^2)
+    # time and O(cols^2) memory.
+    g = x_t @ x
+    g[..., diag_index, diag_index] += diag
+    return g
+
+  def augmented():
+    # Ridge regression as ordinary least squares on [x; sqrt(D)] and [y; 0].
+    sqrt_diag = zeros((*x.shape[:-2], num_cols, num_cols))
+    sqrt_diag[..., diag_index, diag_index] = xp.sqrt(diag)
+    return (xp.concatenate([x, sqrt_diag], -2),
+            xp.concatenate([y, xp.zeros_like(xty)], -1))
+
+  def pinv():
+    return (xp.linalg.pinv(gram(), hermitian=True) @ xty[..., None])[..., 0]
+
+  if solver == "pinv":
+    return pinv()
+  elif solver == "cholesky":
+    try:
+      chol = xp.linalg.cholesky(gram())
+    except (np.linalg.LinAlgError, RuntimeError):
+      logging.info("The Gram matrix is not positive definite, falling back to"
+                   " pinv.")
+      return pinv()
+    beta = _cholesky_solve(chol, xty)
+    ok = min_pivot(
+        xp.diagonal(chol, 0, -2, -1)**2 /
+        xp.diagonal(gram(), 0, -2, -1)) >= _SOLVER_RCOND
+  elif solver == "qr":
+    x_aug, y_aug = augmented()
+    q, r = xp.linalg.qr(x_aug)
+    beta = xp.linalg.solve(r, q.swapaxes(-1, -2) @ y_aug[..., None])[..., 0]
+    ok = min_pivot(
+        xp.diagonal(r, 0, -2, -1)**2 /
+        xp.clip(xp.sum(x_aug**2, -2), _TOL, None)) >= _SOLVER_RCOND
+  elif solver == "lstsq":
+    x_aug, y_aug = augmented()
+    beta = (xp.linalg.pinv(x_aug) @ y_aug[..., None])[..., 0]
+    ok = True
+  elif solver == "cg":
+    # Jacobi preconditioned CG on the normal equations, without the Gram
+    # matrix in the iterations.
+    precond = 1.0 / (xp.sum(x**2, -2) + diag)
+    matvec = lambda v: (x_t @ (x @ v[..., None]))[..., 0] + diag * v
+    dot = lambda a, b: xp.sum(a * b, -1)
+    xty_norm = xp.clip(xp.sqrt(dot(xty, xty)), _TOL, None)
+    beta = xp.zeros_like(xty)
+    r = xty - matvec(beta)
+    p = z = precond * r
+    rz = dot(r, z)
+    for _ in range(cg_max_iters or 10 * num_cols):
+      if float((xp.sqrt(dot(r, r)) / xty_norm).max()) <= cg_tol:
+        break
+      ap = matvec(p)
+      alpha = rz / xp.clip(dot(p, ap), _TOL * _TOL, None)
+      beta = beta + alpha[..., None] * p
+      r = r - alpha[..., None] * ap
+      z = precond * r
+      rz_new = dot(r, z)
+      p = z + (rz_new / xp.where(rz > 0, rz, 1.0))[..., None] * p
+      rz = rz_new
+    residual = matvec(beta) - xty
+    ok = xp.sqrt(dot(residual, residual)) / xty_norm <= 100 * cg_tol
+  else:
+    raise ValueError(f"Unsupported solver: {solver}")
+
+  ok = ok & xp.all(xp.isfinite(beta), -1)
+  if not bool(xp.all(ok)):
+    logging.info("The %s solver is inaccurate, falling back to pinv.", solver)
+    beta = xp.where(ok[..., None], beta, pinv())
+  return beta
+
+
+def _drop_constant_columns(xs_train: np.ndarray, xs_test: np.ndarray,
+                           train_lens: np.ndarray) -> None:
+  """Zeroes all but the first nonzero constant column of each group in place.
+
+  Within one input, static covariates are constant and so are collinear with
+  the intercept, or with each other without it, which makes the Gram matrix
+  of the input singular. Only the first of the columns constant on the
+  context of an input is kept, as it spans the same fits, and the others get
+  zero coefficients.
+
+  Args:
+    xs_train: Padded covariate matrices of shape [groups, rows, cols].
+    xs_test: Padded covariate matrices of shape [groups, test rows, cols].
+    train_lens: Number of context rows of each group, which may be fewer than
+      the groups of `xs_train`.
+  """
+  lens = np.zeros(len(xs_train), dtype=int)
+  lens[:len(train_lens)] = train_lens
+  rows = (np.arange(xs_train.shape[1]) < lens[:, None])[..., None]
+  col_max = np.where(rows, xs_train, -np.inf).max(1)
+  col_min = np.where(rows, xs_train, np.inf).min(1)
+  constant = (col_max == col_min) & (col_max != 0)
+  drop = constant & (np.arange(constant.shape[1]) > np.argmax(constant,
+                                                               1)[:, None])
+  xs_train *= ~drop[:, None, :]
+  xs_test *= ~drop[:, None, :]
+
+
+def _to_backend(backend: XRegBackend, force_on_cpu: bool, x: np.ndarray) -> Any:
+  """Converts `x` to an array of the "numpy" or "torch" backend."""
+  if backend == "numpy":
+    return x
+  elif backend == "torch":
+    import torch  # pylint: disable=g-import-not-at-top
+    if torch.cuda.is_available() and not force_on_cpu:
+      return torch.as_tensor(x, dtype=torch.float32, device="cuda")
+    return torch.as_tensor(x, dtype=torch.float64)
   else:
-    raise ValueError(f"Unsupported array shape: {x.shape}")
+    raise ValueError(f"Unsupported backend: {backend}")
+
+
+def _to_numpy(x: Any) -> np.ndarray:
+  return x if isinstance(x, np.ndarray) else x.cpu().numpy()
+
+
+def _solve_sparse(
+    x: sparse.csr_matrix,
+    y: np.ndarray,
+    ridge: float,
+    solver: XRegSolver = "auto",
+    cg_tol: float = 1e-5,
+    cg_max_iters: int | None = None,
+) -> np.ndarray:
+  """Sparse counterpart of `_solve` on a CSR covariate matrix.
+
+  "cg" runs conjugate gradient on the normal equations and "lstsq" runs LSQR
+  on the damped least squares problem, neither of which forms the Gram matrix.
+  All other solvers factorize the sparse Gram matrix with a sparse LU, which
+  only fills in along the co-occurring categories. Falls back to LSQR, which
+  converges to the minimum norm solution like pinv, if the factorization fails
+  or is inaccurate.
+
+  Args:
+    x: The covariate matrix.
+    y: The target vector.
+    ridge: The ridge penalty.
+    solver: One of "auto", "pinv", "cholesky", "qr", "lstsq" or "cg". "auto"
+      picks "cg", whose iterations only cost O(nnz) on one hot encodings.
+    cg_tol: Relative tolerance of the "cg" solver.
+    cg_max_iters: Max number of iterations of the "cg" solver.
+
+  Returns:
+    The coefficients.
+  """
+  if solver not in ("auto", "pinv", "cholesky", "qr", "lstsq", "cg"):
+    raise ValueError(f"Unsupported solver: {solver}")
+  if solver == "auto":
+    solver = "cg"
+  xty = x.T @ y
+
+  def lsqr() -> np.ndarray:
+    return sparse_linalg.lsqr(x,
+                              y,
+                              damp=math.sqrt(ridge),
+                              atol=_LSQR_TOL,
+                              btol=_LSQR_TOL,
+                              iter_lim=10 * x.shape[1])[0]
+
+  if solver == "lstsq":
+    return lsqr()
+  elif solver == "cg":
+    diag = np.asarray(x.multiply(x).sum(axis=0)).ravel() + ridge
+    op = sparse_linalg.LinearOperator(
+        (x.shape[1], x.shape[1]),
+        matvec=lambda v: x.T @ (x @ v) + ridge * v,
+        dtype=x.dtype)
+    precond = sparse_linalg.LinearOperator(
+        op.shape, matvec=lambda v: v / np.maximum(diag, _TOL), dtype=x.dtype)
+    beta, info = sparse_linalg.cg(op,
+                                  xty,
+                                  rtol=cg_tol,
+                                  maxiter=cg_max_iters,
+                                  M=precond)
+    residual = op @ beta - xty
+  else:
+    gram = (x.T @ x + ridge * sparse.eye(x.shape[1], format="csr")).tocsc()
+    try:
+      beta, info = sparse_linalg.splu(gram).solve(xty), 0
+    except RuntimeError:  # Exactly singular.
+      beta, info = np.full(x.shape[1], np.nan), 1
+    residual = gram @ beta - xty if info == 0 else None
+  if info != 0 or not np.all(np.isfinite(beta)) or np.linalg.norm(
+      residual) > 100 * cg_tol * max(np.linalg.norm(xty), _TOL):
+    logging.info("The sparse %s solver is inaccurate on this design, falling"
+                 " back to lsqr.", solver)
+    beta = lsqr()
+  return beta
+
+
+class GramAccumulator:
+  """Streaming accumulator of the normal equations of a linear regression.
+
+  Accumulates X^T X, X^T y and y^T y block by block, so the covariate matrix
+  never has to be materialized at once, and solves the (ridge) regression from
+  them. The state can be saved and loaded, so that rolling fits can add rows
+  for newly observed time steps, and downdate dropped ones, instead of
+  refitting from scratch. When passed to `BatchedInContextXRegLinear.fit`, it
+  also keeps the covariate encoding of its rows, i.e. the column layout and
+  normalization, and how many trailing context rows of each input it holds,
+  so that later fits encode with the same encoding and only add new rows.
+
+  Attributes:
+    xtx: The accumulated X^T X, of shape [cols, cols].
+    xty: The accumulated X^T y, of shape [cols].
+    yty: The accumulated y^T y.
+    num_rows: The number of accumulated rows.
+    encoding: The covariate encoding of the rows added by `fit`, if any.
+    use_intercept: Whether the rows added by `fit` have an intercept column.
+    input_rows: The number of rows of each input added by `fit`, if any.
+  """
+
+  def __init__(self, num_cols: int | None = None) -> None:
+    """Initializes an empty accumulator.
+
+    Args:
+      num_cols: Number of columns of the covariate matrix. If None, it is
+        inferred from the first update.
+    """
+    self.xtx = None
+    self.xty = None
+    self.yty = 0.0
+    self.num_rows = 0
+    self.encoding = None
+    self.use_intercept = None
+    self.input_rows = None
+    if num_cols is not None:
+      self._init_state(num_cols)
+
+  def _init_state(self, num_cols: int) -> None:
+    self.xtx = np.zeros((num_cols, num_cols))
+    self.xty = np.zeros((num_cols,))
+
+  @property
+  def num_cols(self) -> int | None:
+    return None if self.xtx is None else self.xtx.shape[0]
+
+  def update(
+      self,
+      x: np.ndarray | sparse.spmatrix,
+      y: np.ndarray,
+      weight: float = 1.0,
+  ) -> "GramAccumulator":
+    """Adds the rows `x` with targets `y`, scaled by `weight`."""
+    return self.update_gram(x, weight).update_targets(x, y, weight)
+
+  def update_gram(
+      self,
+      x: np.ndarray | sparse.spmatrix,
+      weight: float = 1.0,
+  ) -> "GramAccumulator":
+    """Adds the target independent part of `update`, i.e. X^T X."""
+    self._check_cols(x)
+    xtx = x.T @ x
+    self.xtx += weight * (xtx.toarray() if sparse.issparse(xtx) else xtx)
+    self.num_rows += int(math.copysign(x.shape[0], weight))
+    return self
+
+  def update_targets(
+      self,
+      x: np.ndarray | sparse.spmatrix,
+      y: np.ndarray,
+      weight: float = 1.0,
+  ) -> "GramAccumulator":
+    """Adds the target dependent part of `update`, i.e. X^T y and y^T y."""
+    self._check_cols(x)
+    y = np.asarray(y, dtype=np.float64)
+    self.xty += weight * np.asarray(x.T @ y).ravel()
+    self.yty += weight * float(y @ y)
+    return self
+
+  def merge(self, other: "GramAccumulator") -> "GramAccumulator":
+    """Adds the rows accumulated by `other`."""
+    if other.xtx is None:
+      return self
+    if self.xtx is None:
+      self._init_state(other.num_cols)
+    if other.num_cols != self.num_cols:
+      raise ValueError(
+          f"Expected {self.num_cols} columns, got {other.num_cols}.")
+    self.xtx += other.xtx
+    self.xty += other.xty
+    self.yty += other.yty
+    self.num_rows += other.num_rows
+    return self
+
+  def _check_cols(self, x: np.ndarray | sparse.spmatrix) -> None:
+    if self.xtx is None:
+      self._init_state(x.shape[1])
+    if x.shape[1] != self.num_cols:
+      raise ValueError(f"Expected {self.num_cols} columns, got {x.shape[1]}.")
+
+  def downdate(self, x: np.ndarray | sparse.spmatrix,
+               y: np.ndarray) -> "GramAccumulator":
+    """Removes previously added rows `x` with targets `y`."""
+    return self.update(x, y, weight=-1.0)
+
+  def solve(self,
+            ridge: float = 0.0,
+            solver: XRegSolver = "auto") -> np.ndarray:
+    """Solves the ridge regression on the accumulated rows.
+
+    Args:
+      ridge: The ridge penalty.
+      solver: "cholesky" factorizes the normal equations and falls back to
+        "pinv" on ill-conditioned designs. "pinv" is the pseudo-inverse. As
+        the design itself is not kept, "auto" and any other solver map to
+        "cholesky".
+
+    Returns:
+      The coefficients.
+    """
+    if self.xtx is None:
+      raise ValueError("Cannot solve an empty accumulator.")
+    gram = self.xtx + ridge * np.eye(self.num_cols)
+    if solver != "pinv":
+      try:
+        chol = scipy.linalg.cho_factor(gram, lower=True)
+        pivots = np.diag(chol[0])**2 / np.maximum(np.diag(gram), _TOL)
+        if np.min(pivots, initial=1.0) >= _SOLVER_RCOND:
+          return scipy.linalg.cho_solve(chol, self.xty)
+      except np.linalg.LinAlgError:
+        pass
+      logging.info("The Gram matrix is ill-conditioned, falling back to pinv.")
+    return np.linalg.pinv(gram, hermitian=True) @ self.xty
+
+  def state_dict(self) -> dict[str, np.ndarray]:
+    """Returns the state as a dict of arrays."""
+    if self.xtx is None:
+      raise ValueError("Cannot save an empty accumulator.")
+    state = {
+        "xtx": self.xtx,
+        "xty": self.xty,
+        "yty": np.array(self.yty),
+        "num_rows": np.array(self.num_rows),
+    }
+    if self.encoding is not None:
+      state["use_intercept"] = np.array(self.use_intercept)
+      state["input_rows"] = self.input_rows
+      for name, value in self.encoding.state_dict().items():
+        state[f"encoding/{name}"] = value
+    return state
+
+  @classmethod
+  def from_state_dict(cls,
+                      state: Mapping[str, np.ndarray]) -> "GramAccumulator":
+    """Restores an accumulator from `state_dict`."""
+    accumulator = cls()
+    accumulator.xtx = np.array(state["xtx"], dtype=np.float64)
+    accumulator.xty = np.array(state["xty"], dtype=np.float64)
+    accumulator.yty = float(state["yty"])
+    accumulator.num_rows = int(state["num_rows"])
+    if "input_rows" in state:
+      accumulator.use_intercept = bool(state["use_intercept"])
+      accumulator.input_rows = np.array(state["input_rows"], dtype=np.int64)
+      accumulator.encoding = _CovariateEncoding.from_state_dict({
+          name[len("encoding/"):]: state[name]
+          for name in state
+          if name.startswith("encoding/")
+      })
+    return accumulator
+
+  def save(self, path: str) -> None:
+    """Saves the state to an `.npz` file."""
+    with open(path, "wb") as f:
+      np.savez(f, **self.state_dict())
+
+  @classmethod
+  def load(cls, path: str) -> "GramAccumulator":
+    """Loads an accumulator saved by `save`."""
+    with np.load(path) as state:
+      return cls.from_state_dict(state)
+
+
+@dataclasses.dataclass
+class _CovariateEncoding:
+  """Feature normalization and one hot encoders fitted on a batch."""
+
+  x_mean: np.ndarray | None
+  x_std: np.ndarray | None
+  dynamic_encoders: dict[str, preprocessing.OneHotEncoder]
+  static_encoders: list[preprocessing.OneHotEncoder]
+  sparse_output: bool
+
+  def state_dict(self) -> dict[str, np.ndarray]:
+    """Returns the encoding as a dict of arrays, see `GramAccumulator`."""
+    state = {"sparse_output": np.array(self.sparse_output)}
+    if self.x_mean is not None:
+      state["x_mean"] = self.x_mean
+      state["x_std"] = self.x_std
+    encoders = [*self.dynamic_encoders.values(), *self.static_encoders]
+    if encoders:
+      state["drop"] = np.array(encoders[0].drop or "")
+    # Categories are saved as plain arrays, e.g. of strings, not of objects.
+    for name, encoder in self.dynamic_encoders.items():
+      state[f"dynamic/{name}"] = np.asarray(encoder.categories_[0].tolist())
+    for i, encoder in enumerate(self.static_encoders):
+      state[f"static/{i}"] = np.asarray(encoder.categories_[0].tolist())
+    return state
+
+  @classmethod
+  def from_state_dict(
+      cls, state: Mapping[str, np.ndarray]) -> "_CovariateEncoding":
+    """Restores an encoding from `state_dict`."""
+    sparse_output = bool(state["sparse_output"])
+    drop = str(state["drop"]) or None if "drop" in state else None
+
+    def encoder(categories):
+      return preprocessing.OneHotEncoder(
+          categories=[categories],
+          drop=drop,
+          sparse_output=sparse_output,
+          handle_unknown="ignore",
+      ).fit(categories[:, np.newaxis])
+
+    static_names = sorted((n for n in state if n.startswith("static/")),
+                          key=lambda n: int(n[len("static/"):]))
+    return cls(
+        x_mean=state.get("x_mean"),
+        x_std=state.get("x_std"),
+        dynamic_encoders={
+            name[len("dynamic/"):]: encoder(np.asarray(state[name]))
+            for name in sorted(state)
+            if name.startswith("dynamic/")
+        },
+        static_encoders=[encoder(np.asarray(state[n])) for n in static_names],
+        sparse_output=sparse_output,
+    )
+
+
+@dataclasses.dataclass
+class XRegDesign:
+  """Covariate matrices of an in-context regression, before its targets.
+
+  Returned by `BatchedInContextXRegLinear.prepare` and consumed by its `fit`.
+
+  Attributes:
+    encoding: The fitted feature normalization and one hot encoders.
+    use_intercept: Whether the matrices have an intercept column.
+    x_train: The covariate matrix for the context, None if chunked.
+    x_test: The covariate matrix for the horizon, or the list of its chunks.
+    chunk_size: Number of inputs per chunk, 0 if not chunked.
+    gram: If chunked, the accumulated X^T X of the context, with no targets.
+  """
+
+  encoding: _CovariateEncoding
+  use_intercept: bool
+  x_train: np.ndarray | sparse.csr_matrix | None
+  x_test: (np.ndarray | sparse.csr_matrix |
+           list[np.ndarray | sparse.csr_matrix])
+  chunk_size: int = 0
+  gram: GramAccumulator | None = None
 
 
 class BatchedInContextXRegBase:
@@ -80,7 +726,7 @@ class BatchedInContextXRegBase:
 
   def __init__(
       self,
-      targets: Sequence[Sequence[float]],
+      targets: Nested | None,
       train_lens: Sequence[int],
       test_lens: Sequence[int],
       train_dynamic_numerical_covariates: (
@@ -118,6 +764,10 @@ class BatchedInContextXRegBase:
 
      Pass an empty dict {} for a covariate type if it is not present.
 
+     Targets and dynamic covariates can be lists of sequences as below, 2-D
+     arrays when all lengths are equal, or `RaggedArray`s. The latter two are
+     flattened without a Python loop, which matters for large batches.
+
      Example:
        Here is a set of valid inputs whose schema can be used for reference.
        ```
@@ -156,7 +806,9 @@ class BatchedInContextXRegBase:
        ```
 
     Args:
-      targets: List of targets (responses) of the in-context regression.
+      targets: List of targets (responses) of the in-context regression. It
+        can be None until `fit` is called, e.g. to `prepare` the covariate
+        matrices while the targets are being computed.
       train_lens: List of lengths of each target vector from the context.
       test_lens: List of lengths of each forecast horizon.
       train_dynamic_numerical_covariates: Dict of covariate names mapping to the
@@ -236,7 +888,8 @@ class BatchedInContextXRegBase:
 
     # Check shapes.
     if assert_covariate_shapes:
-      if len(self.targets) != len(self.train_lens):
+      if (self.targets is not None and
+          len(self.targets) != len(self.train_lens)):
         raise ValueError(
             "targets and train_lens must have the same number of elements.")
 
@@ -244,11 +897,13 @@ class BatchedInContextXRegBase:
         raise ValueError(
             "train_lens and test_lens must have the same number of elements.")
 
-      for i, (target, train_len) in enumerate(zip(self.targets,
-                                                  self.train_lens)):
-        if len(target) != train_len:
-          raise ValueError(
-              f"targets[{i}] has length {len(target)} != expected {train_len}.")
+      # The targets may be set after the covariates are prepared.
+      target_lens = (self.train_lens
+                     if self.targets is None else _lens(self.targets))
+      if (mismatch := np.flatnonzero(target_lens != self.train_lens)).size:
+        i = mismatch[0]
+        raise ValueError(f"targets[{i}] has length {target_lens[i]} != expected"
+                         f" {self.train_lens[i]}.")
 
       for key, values in self.static_numerical_covariates.items():
         if len(values) != len(self.train_lens):
@@ -289,11 +944,12 @@ class BatchedInContextXRegBase:
             raise ValueError(
                 f"{dict_cov_name} has key {key} with number of examples"
                 f" {len(cov_values)} != expected {len(lens)}.")
-          for i, cov_value in enumerate(cov_values):
-            if len(cov_value) != lens[i]:
-              raise ValueError(
-                  f"{dict_cov_name} has key {key} with its {i}-th example"
-                  f" length {len(cov_value)} != expected {lens[i]}.")
+          cov_lens = _lens(cov_values)
+          if (mismatch := np.flatnonzero(cov_lens != lens)).size:
+            i = mismatch[0]
+            raise ValueError(
+                f"{dict_cov_name} has key {key} with its {i}-th example"
+                f" length {cov_lens[i]} != expected {lens[i]}.")
 
   def create_covariate_matrix(
       self,
@@ -301,7 +957,9 @@ class BatchedInContextXRegBase:
       use_intercept: bool = True,
       assert_covariates: bool = False,
       assert_covariate_shapes: bool = False,
-  ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+      sparse_output: bool = False,
+  ) -> tuple[np.ndarray, np.ndarray | sparse.csr_matrix,
+             np.ndarray | sparse.csr_matrix]:
     """Creates target vector and covariate matrices for in context regression.
 
     Here we use model fitting language to refer to the context as 'train' and
@@ -314,6 +972,9 @@ class BatchedInContextXRegBase:
       assert_covariates: Whether to assert the validity of the covariate inputs.
       assert_covariate_shapes: Whether to assert the shapes of the covariate
         inputs when `assert_covariates` is True.
+      sparse_output: Whether to return the covariate matrices in CSR format.
+        The one hot encodings are then never densified, which is needed for
+        high cardinality categorical covariates such as store or SKU ids.
 
     Returns:
       A tuple of the target vector, the covariate matrix for the context, and
@@ -322,57 +983,201 @@ class BatchedInContextXRegBase:
     if assert_covariates:
       self._assert_covariates(assert_covariate_shapes)
 
+    encoding = self._fit_encoding(one_hot_encoder_drop, sparse_output)
+    x_train, x_test = self._encode(encoding, 0, len(self.train_lens),
+                                   use_intercept)
+    return _unnest(self.targets), x_train, x_test
+
+  def iter_covariate_matrix(
+      self,
+      chunk_size: int,
+      one_hot_encoder_drop: str | None = "first",
+      use_intercept: bool = True,
+      assert_covariates: bool = False,
+      assert_covariate_shapes: bool = False,
+      sparse_output: bool = False,
+  ) -> Iterator[tuple[np.ndarray, np.ndarray | sparse.csr_matrix,
+                      np.ndarray | sparse.csr_matrix]]:
+    """Yields `create_covariate_matrix` outputs `chunk_size` inputs at a time.
+
+    The normalization and the one hot encoders are fitted on the whole batch
+    up front, so the chunks stacked together equal the full matrices, while
+    only one chunk is materialized at a time.
+
+    Args:
+      chunk_size: Number of inputs per chunk.
+      one_hot_encoder_drop: Which drop strategy to use for the one hot encoder.
+      use_intercept: Whether to prepare an intercept (all 1) column in the
+        matrices.
+      assert_covariates: Whether to assert the validity of the covariate inputs.
+      assert_covariate_shapes: Whether to assert the shapes of the covariate
+        inputs when `assert_covariates` is True.
+      sparse_output: Whether to yield the covariate matrices in CSR format.
+
+    Yields:
+      Tuples of the target vector, the covariate matrix for the context, and
+      the covariate matrix for the horizon of consecutive chunks of inputs.
+    """
+    if assert_covariates:
+      self._assert_covariates(assert_covariate_shapes)
+
+    encoding = self._fit_encoding(one_hot_encoder_drop, sparse_output)
+    for start in range(0, len(self.train_lens), chunk_size):
+      stop = min(start + chunk_size, len(self.train_lens))
+      x_train, x_test = self._encode(encoding, start, stop, use_intercept)
+      yield _unnest(self.targets[start:stop]), x_train, x_test
+
+  def prepare(
+      self,
+      one_hot_encoder_drop: str | None = "first",
+      use_intercept: bool = True,
+      sparse_output: bool = False,
+      chunk_size: int = 0,
+      assert_covariates: bool = False,
+      assert_covariate_shapes: bool = False,
+  ) -> XRegDesign:
+    """Builds the covariate matrices, which do not depend on the targets.
+
+    This is all the work of fitting besides the solve, so it can run while the
+    targets are still being computed, e.g. concurrently with the forecast whose
+    residuals they are. `self.targets` is not used and may be None.
+
+    Args:
+      one_hot_encoder_drop: Which drop strategy to use for the one hot encoder.
+      use_intercept: Whether to prepare an intercept (all 1) column in the
+        matrices.
+      sparse_output: Whether to build the covariate matrices in CSR format.
+      chunk_size: If positive, only the Gram matrix of the context and the
+        horizon matrices are kept, encoding `chunk_size` inputs at a time.
+      assert_covariates: Whether to assert the validity of the covariate inputs.
+      assert_covariate_shapes: Whether to assert the shapes of the covariate
+        inputs when `assert_covariates` is True.
+
+    Returns:
+      The covariate matrices, to be passed as `design` to `fit`.
+    """
+    if assert_covariates:
+      self._assert_covariates(assert_covariate_shapes)
+
+    encoding = self._fit_encoding(one_hot_encoder_drop, sparse_output)
+    num_inputs = len(self.train_lens)
+    if not chunk_size:
+      x_train, x_test = self._encode(encoding, 0, num_inputs, use_intercept)
+      return XRegDesign(encoding, use_intercept, x_train, x_test)
+
+    gram, x_tests = GramAccumulator(), []
+    for start in range(0, num_inputs, chunk_size):
+      x_train, x_test = self._encode(encoding, start,
+                                     min(start + chunk_size, num_inputs),
+                                     use_intercept)
+      gram.update_gram(x_train)
+      # The horizon is short, keep it rather than encoding it again.
+      x_tests.append(x_test)
+    return XRegDesign(encoding, use_intercept, None, x_tests, chunk_size, gram)
+
+  def _numerical_features(self, start: int,
+                          stop: int) -> tuple[np.ndarray, np.ndarray] | None:
+    """Returns the raw numerical features of inputs [start, stop)."""
     x_train, x_test = [], []
+    train_lens = self.train_lens[start:stop]
+    test_lens = self.test_lens[start:stop]
 
-    # Numerical features.
     for name in sorted(self.train_dynamic_numerical_covariates):
       x_train.append(
-          _unnest(self.train_dynamic_numerical_covariates[name])[:, np.newaxis])
+          _unnest(self.train_dynamic_numerical_covariates[name][start:stop])
+          [:, np.newaxis])
       x_test.append(
-          _unnest(self.test_dynamic_numerical_covariates[name])[:, np.newaxis])
+          _unnest(self.test_dynamic_numerical_covariates[name][start:stop])
+          [:, np.newaxis])
 
     for covs in self.static_numerical_covariates.values():
-      x_train.append(_repeat(covs, self.train_lens)[:, np.newaxis])
-      x_test.append(_repeat(covs, self.test_lens)[:, np.newaxis])
+      x_train.append(_repeat(covs[start:stop], train_lens)[:, np.newaxis])
+      x_test.append(_repeat(covs[start:stop], test_lens)[:, np.newaxis])
 
-    if x_train:
-      x_train = np.concatenate(x_train, axis=1)
-      x_test = np.concatenate(x_test, axis=1)
+    if not x_train:
+      return None
+    return np.concatenate(x_train, axis=1), np.concatenate(x_test, axis=1)
 
+  def _fit_encoding(
+      self,
+      one_hot_encoder_drop: str | None,
+      sparse_output: bool,
+  ) -> "_CovariateEncoding":
+    """Fits the feature normalization and the one hot encoders."""
+    x_mean, x_std = None, None
+    if numerical := self._numerical_features(0, len(self.train_lens)):
       # Normalize for robustness.
-      x_mean = np.mean(x_train, axis=0, keepdims=True)
-      x_std = np.where((w := np.std(x_train, axis=0, keepdims=True)) > _TOL, w,
-                       1.0)
-      x_train = [(x_train - x_mean) / x_std]
-      x_test = [(x_test - x_mean) / x_std]
+      x_mean = np.mean(numerical[0], axis=0, keepdims=True)
+      x_std = np.where((w := np.std(numerical[0], axis=0, keepdims=True)) >
+                       _TOL, w, 1.0)
 
     # Categorical features. Encode one by one.
-    one_hot_encoder = preprocessing.OneHotEncoder(
+    new_encoder = lambda: preprocessing.OneHotEncoder(
         drop=one_hot_encoder_drop,
-        sparse_output=False,
+        sparse_output=sparse_output,
         handle_unknown="ignore",
     )
-    for name in sorted(self.train_dynamic_categorical_covariates.keys()):
-      ohe_train = _unnest(
-          self.train_dynamic_categorical_covariates[name])[:, np.newaxis]
-      ohe_test = _unnest(
-          self.test_dynamic_categorical_covariates[name])[:, np.newaxis]
-      x_train.append(np.array(one_hot_encoder.fit_transform(ohe_train)))
-      x_test.append(np.array(one_hot_encoder.transform(ohe_test)))
-
-    for covs in self.static_categorical_covariates.values():
-      ohe = one_hot_encoder.fit_transform(np.array(covs)[:, np.newaxis])
-      x_train.append(_repeat(ohe, self.train_lens))
-      x_test.append(_repeat(ohe, self.test_lens))
-
-    x_train = np.concatenate(x_train, axis=1)
-    x_test = np.concatenate(x_test, axis=1)
+    dynamic_encoders = {
+        name:
+        new_encoder().fit(
+            _unnest(self.train_dynamic_categorical_covariates[name])
+            [:, np.newaxis])
+        for name in sorted(self.train_dynamic_categorical_covariates.keys())
+    }
+    static_encoders = [
+        new_encoder().fit(np.array(covs)[:, np.newaxis])
+        for covs in self.static_categorical_covariates.values()
+    ]
+    return _CovariateEncoding(x_mean, x_std, dynamic_encoders, static_encoders,
+                              sparse_output)
+
+  def _encode(
+      self,
+      encoding: "_CovariateEncoding",
+      start: int,
+      stop: int,
+      use_intercept: bool,
+  ) -> tuple[np.ndarray | sparse.csr_matrix, np.ndarray | sparse.csr_matrix]:
+    """Creates the covariate matrices of inputs [start, stop)."""
+    x_train, x_test = [], []
+    train_lens = self.train_lens[start:stop]
+    test_lens = self.test_lens[start:stop]
+
+    if numerical := self._numerical_features(start, stop):
+      x_train.append((numerical[0] - encoding.x_mean) / encoding.x_std)
+      x_test.append((numerical[1] - encoding.x_mean) / encoding.x_std)
+
+    for name, one_hot_encoder in encoding.dynamic_encoders.items():
+      ohe_train = _unnest(self.train_dynamic_categorical_covariates[name]
+                          [start:stop])[:, np.newaxis]
+      ohe_test = _unnest(self.test_dynamic_categorical_covariates[name]
+                         [start:stop])[:, np.newaxis]
+      x_train.append(one_hot_encoder.transform(ohe_train))
+      x_test.append(one_hot_encoder.transform(ohe_test))
+
+    for covs, one_hot_encoder in zip(
+        self.static_categorical_covariates.values(), encoding.static_encoders):
+      ohe = one_hot_encoder.transform(np.array(covs[start:stop])[:, np.newaxis])
+      if encoding.sparse_output:
+        # Row gathering keeps the static encodings sparse.
+        x_train.append(ohe[np.repeat(np.arange(stop - start), train_lens)])
+        x_test.append(ohe[np.repeat(np.arange(stop - start), test_lens)])
+      else:
+        x_train.append(_repeat(ohe, train_lens))
+        x_test.append(_repeat(ohe, test_lens))
 
     if use_intercept:
-      x_train = np.pad(x_train, ((0, 0), (1, 0)), constant_values=1.0)
-      x_test = np.pad(x_test, ((0, 0), (1, 0)), constant_values=1.0)
+      x_train.insert(0, np.ones((sum(train_lens), 1)))
+      x_test.insert(0, np.ones((sum(test_lens), 1)))
 
-    return _unnest(self.targets), x_train, x_test
+    if encoding.sparse_output:
+      x_train = sparse.hstack(x_train, format="csr")
+      x_test = sparse.hstack(x_test, format="csr")
+    else:
+      x_train = np.concatenate(x_train, axis=1)
+      x_test = np.concatenate(x_test, axis=1)
+
+    return x_train, x_test
 
   def fit(self) -> Any:
     raise NotImplementedError("Fit is not implemented.")
@@ -389,11 +1194,20 @@ class BatchedInContextXRegLinear(BatchedInContextXRegBase):
       force_on_cpu: bool = False,
       max_rows_per_col: int = 0,
       max_rows_per_col_sample_seed: int = 42,
+      solver: XRegSolver = "auto",
+      sparse_design: bool = False,
+      per_input: bool = False,
+      chunk_size: int = 0,
+      gram_accumulator: GramAccumulator | None = None,
+      new_rows: Sequence[int] | None = None,
+      window_rows: int = 0,
+      backend: XRegBackend = "numpy",
+      design: XRegDesign | None = None,
       debug_info: bool = False,
       assert_covariates: bool = False,
       assert_covariate_shapes: bool = False,
-  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray], jax.Array,
-                                 jax.Array, jax.Array]):
+  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray], Any, Any,
+                                 Any]):
     """Fits a linear model for in-context regression.
 
     Args:
@@ -408,6 +1222,57 @@ class BatchedInContextXRegLinear(BatchedInContextXRegBase):
         subsampling. This is for speeding up model fitting.
       max_rows_per_col_sample_seed: The seed for the subsampling if needed by
         `max_rows_per_col`.
+      solver: Which linear solver to use. "cholesky" (ridge > 0) and "qr"
+        factorize the system, "lstsq" is SVD based, "cg" is an iterative
+        solver for very wide designs and "pinv" is the eigendecomposition based
+        pseudo-inverse. "auto" picks among "cg", "cholesky" and "qr" based on
+        the design shape and `ridge`. Any solver other than "pinv" and "lstsq"
+        falls back to "pinv" on ill-conditioned designs.
+      sparse_design: Whether to build CSR covariate matrices and fit with the
+        sparse solvers on cpu, see `_solve_sparse`. Use it when the one hot
+        encodings are too wide to fit in memory densely. `force_on_cpu` has no
+        effect then, and the debug covariate matrices are returned unpadded in
+        CSR format.
+      per_input: Whether to fit a separate linear model for each input in the
+        batch rather than one model shared by all inputs. The per-input
+        covariate matrices are padded to a common shape and solved in one
+        vmapped call. Columns that are all zero on an input's context get zero
+        coefficients for that input, and so do the columns constant on it but
+        the first one, e.g. static covariates next to the intercept. Not
+        supported with `sparse_design` or `max_rows_per_col`. The debug
+        targets and covariate matrices are returned padded, of shapes
+        [inputs, rows] and [inputs, rows, cols].
+      chunk_size: If positive, the covariates are encoded `chunk_size` inputs
+        at a time and only their normal equations are accumulated, see
+        `GramAccumulator`, so the full covariate matrix never exists in memory.
+        Not supported with `per_input` or `max_rows_per_col`. The debug
+        covariate matrices are returned as None.
+      gram_accumulator: An optional `GramAccumulator`, e.g. holding the rows
+        of a previous rolling run of the same inputs, to which the new rows of
+        this batch are added before solving. It is updated in place so it can
+        be saved for the next run. Implies chunked fitting with `chunk_size`
+        defaulting to the whole batch. An empty accumulator stores the
+        covariate encoding of this batch, and a non-empty one encodes this
+        batch with its stored encoding, so `design` must then be None.
+      new_rows: With a non-empty `gram_accumulator`, the number of rows at the
+        end of the context of each input that it does not hold yet, i.e. the
+        newly observed time steps. Only these rows are added. All rows are new
+        for an empty accumulator.
+      window_rows: If positive, the accumulator keeps at most the last
+        `window_rows` rows of each input, and downdates the older ones. The
+        rows leaving the window must still be in the context of this batch,
+        e.g. the context of the previous run followed by the new rows.
+      backend: Which library solves the dense linear systems. "numpy" solves
+        the unpadded systems directly, without any compilation. "jax" pads
+        them to powers of 2 and runs jitted solvers, possibly on accelerators,
+        which pays off when the same padded shapes are solved repeatedly.
+        "torch" is like "numpy" but runs on cuda if available and
+        `force_on_cpu` is False. `sparse_design` and `chunk_size` always use
+        numpy and scipy. Note `max_rows_per_col` draws different subsamples
+        for "jax" than for the other backends.
+      design: The covariate matrices from `prepare`, if already built. They
+        must have been prepared with the same `one_hot_encoder_drop`,
+        `use_intercept`, `sparse_design` and `chunk_size`.
       debug_info: Whether to return debug info.
       assert_covariates: Whether to assert the validity of the covariate inputs.
       assert_covariate_shapes: Whether to assert the shapes of the covariate
@@ -424,26 +1289,99 @@ class BatchedInContextXRegLinear(BatchedInContextXRegBase):
         - the covariate matrix for the context, and
         - the covariate matrix for the horizon.
     """
-    flat_targets, x_train_raw, x_test = self.create_covariate_matrix(
-        one_hot_encoder_drop=one_hot_encoder_drop,
-        use_intercept=use_intercept,
-        assert_covariates=assert_covariates,
-        assert_covariate_shapes=assert_covariate_shapes,
-    )
+    chunked = bool(chunk_size) or gram_accumulator is not None
+    if chunked and (per_input or max_rows_per_col):
+      raise ValueError("Chunked fitting is not supported with per_input or"
+                       " max_rows_per_col.")
+    if gram_accumulator is not None and gram_accumulator.num_rows:
+      if gram_accumulator.encoding is None:
+        raise ValueError("The gram_accumulator holds rows that were not added"
+                         " by fit, whose encoding is unknown.")
+      if design is not None:
+        raise ValueError("A design cannot be passed with a non-empty"
+                         " gram_accumulator, whose encoding is reused.")
+      if gram_accumulator.use_intercept != use_intercept:
+        raise ValueError("use_intercept differs from the gram_accumulator's.")
+      if assert_covariates:
+        self._assert_covariates(assert_covariate_shapes)
+      design = XRegDesign(gram_accumulator.encoding, use_intercept, None, [],
+                          chunk_size or len(self.train_lens))
+    elif design is None and chunked:
+      # The chunks are prepared in the same pass as they are fitted.
+      if assert_covariates:
+        self._assert_covariates(assert_covariate_shapes)
+      design = XRegDesign(
+          self._fit_encoding(one_hot_encoder_drop, sparse_design),
+          use_intercept, None, [], chunk_size or len(self.train_lens))
+    elif design is None:
+      design = self.prepare(
+          one_hot_encoder_drop=one_hot_encoder_drop,
+          use_intercept=use_intercept,
+          sparse_output=sparse_design,
+          assert_covariates=assert_covariates,
+          assert_covariate_shapes=assert_covariate_shapes,
+      )
+    else:
+      if chunked != bool(design.chunk_size):
+        raise ValueError("The design was not prepared with the same chunking.")
+      if assert_covariates:
+        self._assert_covariates(assert_covariate_shapes)
+
+    if gram_accumulator is not None:
+      return self._fit_rolling(gram_accumulator, design, new_rows,
+                               window_rows, ridge, solver, debug_info)
+    if chunked:
+      return self._fit_chunked(design, ridge, solver, debug_info)
+
+    flat_targets = _unnest(self.targets)
+    x_train_raw, x_test = design.x_train, design.x_test
+
+    if per_input:
+      if sparse_design or max_rows_per_col:
+        raise ValueError("per_input is not supported with sparse_design or"
+                         " max_rows_per_col.")
+      return self._fit_per_input(flat_targets, x_train_raw, x_test, ridge,
+                                 solver, backend, force_on_cpu, debug_info)
 
     x_train = x_train_raw.copy()
     if max_rows_per_col:
       nrows, ncols = x_train.shape
       if nrows > (w := ncols * max_rows_per_col):
-        subsample = jax.random.choice(
-            jax.random.PRNGKey(max_rows_per_col_sample_seed),
-            nrows,
-            (w,),
-            replace=False,
-        )
+        if backend == "jax":
+          import jax  # pylint: disable=g-import-not-at-top
+          subsample = np.asarray(
+              jax.random.choice(
+                  jax.random.PRNGKey(max_rows_per_col_sample_seed),
+                  nrows,
+                  (w,),
+                  replace=False,
+              ))
+        else:
+          subsample = np.random.default_rng(
+              max_rows_per_col_sample_seed).choice(nrows, w, replace=False)
         x_train = x_train[subsample]
         flat_targets = flat_targets[subsample]
 
+    if sparse_design:
+      beta_hat = _solve_sparse(x_train, flat_targets, ridge, solver)
+      return self._reconstruct(x_test @ beta_hat,
+                               x_train_raw @ beta_hat if debug_info else None,
+                               flat_targets, x_train, x_test, debug_info)
+
+    if backend != "jax":
+      to_backend = functools.partial(_to_backend, backend, force_on_cpu)
+      beta_hat = _solve_dense(to_backend(x_train), to_backend(flat_targets),
+                              ridge, solver)
+      y_hat = _to_numpy(to_backend(x_test) @ beta_hat)
+      y_hat_context = None
+      if debug_info:
+        y_hat_context = _to_numpy(to_backend(x_train_raw) @ beta_hat)
+      return self._reconstruct(y_hat, y_hat_context, flat_targets, x_train,
+                               x_test, debug_info)
+
+    import jax  # pylint: disable=g-import-not-at-top
+    from timesfm import xreg_jax  # pylint: disable=g-import-not-at-top
+
     device = jax.devices("cpu")[0] if force_on_cpu else None
     # Runs jitted version of the solvers which are quicker at the cost of
     # running jitting during the first time calling. Re-jitting happens whenever
@@ -453,34 +1391,227 @@ class BatchedInContextXRegLinear(BatchedInContextXRegBase):
     # 1. Avoid moving data to accelarator memory.
     # 2. Avoid precision loss if any.
     with jax.default_device(device):
-      x_train_raw = _to_padded_jax_array(x_train_raw)
-      x_train = _to_padded_jax_array(x_train)
-      flat_targets = _to_padded_jax_array(flat_targets)
-      x_test = _to_padded_jax_array(x_test)
-      beta_hat = (jnp.linalg.pinv(
-          x_train.T @ x_train + ridge * jnp.eye(x_train.shape[1]),
-          hermitian=True,
-      ) @ x_train.T @ flat_targets)
+      num_cols = x_train.shape[1]
+      x_train_raw = xreg_jax.to_padded_array(x_train_raw)
+      x_train = xreg_jax.to_padded_array(x_train)
+      flat_targets = xreg_jax.to_padded_array(flat_targets)
+      x_test = xreg_jax.to_padded_array(x_test)
+      beta_hat = xreg_jax.solve(x_train, flat_targets, ridge, num_cols, solver)
       y_hat = x_test @ beta_hat
       y_hat_context = x_train_raw @ beta_hat if debug_info else None
 
-    outputs = []
-    outputs_context = []
+    return self._reconstruct(y_hat, y_hat_context, flat_targets, x_train,
+                             x_test, debug_info)
 
-    # Reconstruct the ragged 2-dim batched forecasts from flattened linear fits.
-    train_index, test_index = 0, 0
-    for train_index_delta, test_index_delta in zip(self.train_lens,
-                                                   self.test_lens):
-      outputs.append(np.array(y_hat[test_index:(test_index +
-                                                test_index_delta)]))
+  def _iter_chunks(
+      self, design: XRegDesign
+  ) -> Iterator[tuple[int, int, np.ndarray | sparse.csr_matrix,
+                      np.ndarray | sparse.csr_matrix]]:
+    """Yields the inputs range and covariate matrices of each chunk."""
+    num_inputs = len(self.train_lens)
+    for start in range(0, num_inputs, design.chunk_size):
+      stop = min(start + design.chunk_size, num_inputs)
+      yield start, stop, *self._encode(design.encoding, start, stop,
+                                       design.use_intercept)
+
+  def _fit_chunked(
+      self,
+      design: XRegDesign,
+      ridge: float,
+      solver: XRegSolver,
+      debug_info: bool,
+  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray],
+                                 np.ndarray, None, None]):
+    """Fits the linear model by accumulating the normal equations, see `fit`."""
+    chunks = functools.partial(self._iter_chunks, design)
+    # X^T X is only left to accumulate if the design was not prepared.
+    prepared = design.gram is not None
+    gram = copy.deepcopy(design.gram) if prepared else GramAccumulator()
+    x_tests = design.x_test if prepared else []
+    flat_targets = []
+    for start, stop, x_train, x_test in chunks():
+      if not prepared:
+        gram.update_gram(x_train)
+        # The horizon is short, keep it rather than encoding it again.
+        x_tests.append(x_test)
+      targets = _unnest(self.targets[start:stop])
+      gram.update_targets(x_train, targets)
+      flat_targets.append(targets)
+
+    return self._solve_chunks(gram, x_tests, chunks, flat_targets, ridge,
+                              solver, debug_info)
+
+  def _solve_chunks(
+      self,
+      accumulator: GramAccumulator,
+      x_tests: list[np.ndarray | sparse.csr_matrix],
+      chunks: Any,
+      flat_targets: list[np.ndarray],
+      ridge: float,
+      solver: XRegSolver,
+      debug_info: bool,
+  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray],
+                                 np.ndarray, None, None]):
+    """Solves the accumulated normal equations and predicts the chunks."""
+    beta_hat = accumulator.solve(ridge, solver)
+    y_hat = np.concatenate([x_test @ beta_hat for x_test in x_tests])
+    y_hat_context = None
+    if debug_info:
+      y_hat_context = np.concatenate(
+          [x_train @ beta_hat for _, _, x_train, _ in chunks()])
+    return self._reconstruct(y_hat, y_hat_context, np.concatenate(flat_targets),
+                             None, None, debug_info)
+
+  def _fit_rolling(
+      self,
+      accumulator: GramAccumulator,
+      design: XRegDesign,
+      new_rows: Sequence[int] | None,
+      window_rows: int,
+      ridge: float,
+      solver: XRegSolver,
+      debug_info: bool,
+  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray],
+                                 np.ndarray, None, None]):
+    """Adds the new rows to `accumulator` and solves, see `fit`."""
+    train_lens = np.asarray(self.train_lens, dtype=np.int64)
+    if accumulator.num_rows:
+      if new_rows is None:
+        raise ValueError("new_rows is required with a non-empty"
+                         " gram_accumulator.")
+      if len(accumulator.input_rows) != len(train_lens):
+        raise ValueError(
+            f"The gram_accumulator holds {len(accumulator.input_rows)} inputs,"
+            f" got {len(train_lens)}.")
+      held = accumulator.input_rows
+    else:
+      held = np.zeros_like(train_lens)
+    new = train_lens if new_rows is None else np.asarray(new_rows, np.int64)
+    if np.any(new < 0) or np.any(new > train_lens):
+      raise ValueError("new_rows must be within [0, train_lens].")
+    # Rows are held up to the end of the context, the oldest ones first.
+    dropped = np.zeros_like(held)
+    if window_rows:
+      dropped = np.maximum(held + new - window_rows, 0)
+    first_held = train_lens - new - held
+    if np.any(first_held[dropped > 0] < 0):
+      raise ValueError("The rows leaving the window must be in the context.")
+    first_held = np.maximum(first_held, 0)
+
+    chunks = functools.partial(self._iter_chunks, design)
+    x_tests, flat_targets = [], []
+    for start, stop, x_train, x_test in chunks():
+      targets = _unnest(self.targets[start:stop])
+      lens = train_lens[start:stop]
+      rows = RaggedArray(np.arange(lens.sum()),
+                         np.concatenate([[0], np.cumsum(lens)]))
+      added = rows.slice_each(lens - new[start:stop], lens).values
+      removed = rows.slice_each(
+          first_held[start:stop],
+          first_held[start:stop] + dropped[start:stop]).values
+      accumulator.update(x_train[added], targets[added])
+      if len(removed):
+        accumulator.downdate(x_train[removed], targets[removed])
+      x_tests.append(x_test)
+      flat_targets.append(targets)
+    accumulator.encoding = design.encoding
+    accumulator.use_intercept = design.use_intercept
+    accumulator.input_rows = held + new - dropped
+
+    return self._solve_chunks(accumulator, x_tests, chunks, flat_targets,
+                              ridge, solver, debug_info)
+
+  def _fit_per_input(
+      self,
+      flat_targets: np.ndarray,
+      x_train: np.ndarray,
+      x_test: np.ndarray,
+      ridge: float,
+      solver: XRegSolver,
+      backend: XRegBackend,
+      force_on_cpu: bool,
+      debug_info: bool,
+  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray], Any, Any,
+                                 Any]):
+    """Fits one linear model per input, see `fit`."""
+    num_cols = x_train.shape[1]
+    if backend == "jax":
+      # Padding every dimension to powers of 2 limits re-jitting.
+      pad = lambda n: 2**math.ceil(math.log2(max(n, 1)))
+    else:
+      pad = lambda n: n
+    xs_train = np.zeros((pad(len(self.train_lens)), pad(max(
+        self.train_lens)), pad(num_cols)))
+    xs_test = np.zeros(
+        (xs_train.shape[0], pad(max(self.test_lens)), xs_train.shape[2]))
+    ys = np.zeros(xs_train.shape[:2])
+
+    def scatter_index(lens):
+      group = np.repeat(np.arange(len(lens)), lens)
+      starts = np.repeat(np.cumsum(lens) - lens, lens)
+      return group, np.arange(len(group)) - starts
+
+    train_group, train_pos = scatter_index(np.asarray(self.train_lens))
+    test_group, test_pos = scatter_index(np.asarray(self.test_lens))
+    xs_train[train_group, train_pos, :num_cols] = x_train
+    ys[train_group, train_pos] = flat_targets
+    xs_test[test_group, test_pos, :num_cols] = x_test
+    _drop_constant_columns(xs_train, xs_test, np.asarray(self.train_lens))
+
+    if backend == "jax":
+      import jax  # pylint: disable=g-import-not-at-top
+      import jax.numpy as jnp  # pylint: disable=g-import-not-at-top
+      from timesfm import xreg_jax  # pylint: disable=g-import-not-at-top
+
+      col_mask = np.any(xs_train != 0, axis=1)
+      device = jax.devices("cpu")[0] if force_on_cpu else None
+      with jax.default_device(device):
+        xs_train, ys, xs_test = map(jnp.asarray, (xs_train, ys, xs_test))
+        beta_hat = xreg_jax.solve_grouped(xs_train, ys, ridge,
+                                          jnp.asarray(col_mask), solver)
+        y_hat = np.array(jnp.einsum("gtc,gc->gt", xs_test, beta_hat))
+        if debug_info:
+          y_hat_context = np.array(
+              jnp.einsum("gtc,gc->gt", xs_train, beta_hat))
+    else:
+      to_backend = functools.partial(_to_backend, backend, force_on_cpu)
+      xs_train_ = to_backend(xs_train)
+      beta_hat = _solve_dense(xs_train_, to_backend(ys), ridge, solver)[...,
+                                                                         None]
+      y_hat = _to_numpy(to_backend(xs_test) @ beta_hat)[..., 0]
       if debug_info:
-        outputs_context.append(
-            np.array(y_hat_context[train_index:(train_index +
-                                                train_index_delta)]))
-      train_index += train_index_delta
-      test_index += test_index_delta
+        y_hat_context = _to_numpy(xs_train_ @ beta_hat)[..., 0]
+
+    outputs = [y_hat[i, :test_len] for i, test_len in enumerate(self.test_lens)]
+    if debug_info:
+      outputs_context = [
+          y_hat_context[i, :train_len]
+          for i, train_len in enumerate(self.train_lens)
+      ]
+      return outputs, outputs_context, ys, xs_train, xs_test
+    else:
+      return outputs
 
+  def _reconstruct(
+      self,
+      y_hat: Any,
+      y_hat_context: Any | None,
+      flat_targets: Any,
+      x_train: Any,
+      x_test: Any,
+      debug_info: bool,
+  ) -> (list[np.ndarray] | tuple[list[np.ndarray], list[np.ndarray], Any, Any,
+                                 Any]):
+    """Formats the flattened linear fits as the outputs of `fit`."""
+    # Reconstruct the ragged 2-dim batched forecasts from flattened linear fits,
+    # which may be padded at the end.
+    test_offsets = np.cumsum(self.test_lens)
+    outputs = np.split(
+        np.asarray(y_hat)[:test_offsets[-1]], test_offsets[:-1])
     if debug_info:
+      train_offsets = np.cumsum(self.train_lens)
+      outputs_context = np.split(
+          np.asarray(y_hat_context)[:train_offsets[-1]], train_offsets[:-1])
       return outputs, outputs_context, flat_targets, x_train, x_test
     else:
       return outputs
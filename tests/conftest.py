@@ -0,0 +1,31 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+
+@pytest.fixture
+def make_decoder():
+    """Returns a factory of small, identically initialized decoders."""
+    torch = pytest.importorskip("torch")
+    from timesfm import pytorch_patched_decoder as ppd
+
+    def _make_decoder():
+        torch.manual_seed(0)
+        return ppd.PatchedTimeSeriesDecoder(
+            ppd.TimesFMConfig(num_layers=2, hidden_size=32, intermediate_size=32,
+                              num_heads=2, num_kv_heads=2, head_dim=16, horizon_len=16)
+        )
+
+    return _make_decoder
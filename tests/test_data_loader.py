@@ -0,0 +1,162 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timesfm import data_loader
+
+_NUM_TS = 6
+_HIST_LEN, _PRED_LEN = 32, 8
+
+
+def _make_data(path, **kwargs) -> data_loader.TimeSeriesdata:
+    rng = np.random.default_rng(0)
+    num_steps = 300
+    df = pd.DataFrame(rng.normal(size=(num_steps, _NUM_TS)),
+                      columns=[f"ts{i}" for i in range(_NUM_TS)])
+    df["date"] = pd.date_range("2016-01-01", periods=num_steps, freq="h")
+    df["num"] = rng.normal(size=num_steps)
+    df["cat"] = rng.choice(["a", "b", "c"], num_steps)
+    df.to_csv(path, index=False)
+    return data_loader.TimeSeriesdata(
+        data_path=str(path),
+        datetime_col="date",
+        num_cov_cols=["num"],
+        cat_cov_cols=["cat"],
+        ts_cols=[f"ts{i}" for i in range(_NUM_TS)],
+        train_range=[0, 200],
+        val_range=[200, 250],
+        test_range=[250, 300],
+        hist_len=_HIST_LEN,
+        pred_len=_PRED_LEN,
+        batch_size=4,
+        freq="h",
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def dtl(tmp_path) -> data_loader.TimeSeriesdata:
+    return _make_data(tmp_path / "data.csv")
+
+
+def _reference_window(dtl, start, tsidx):
+    """The fancy indexing version of `_get_features_and_ts`."""
+    dtimes = np.arange(start, start + _HIST_LEN + _PRED_LEN)
+    bts = dtl.data_mat[:, dtimes][tsidx, :]
+    bfeats = np.vstack([dtl.time_mat[:, dtimes], dtl.num_feat_mat[:, dtimes]])
+    return bts, bfeats, dtl.cat_feat_mat[:, dtimes]
+
+
+def test_window_batch_matches_fancy_indexing(dtl) -> None:
+    starts, tsidx = np.array([0, 17, 300 - _HIST_LEN - _PRED_LEN]), np.array([4, 0, 2])
+    batch = dtl.get_window_batch(starts, tsidx)
+    for i, start in enumerate(starts):
+        expected = _reference_window(dtl, start, tsidx)
+        window = dtl._get_features_and_ts(
+            np.arange(start, start + _HIST_LEN + _PRED_LEN), tsidx)
+        for actual, train, pred, e in zip(batch, window[::2], window[1::2], expected):
+            np.testing.assert_array_equal(actual[i], e)
+            np.testing.assert_array_equal(np.hstack([train, pred]), e)
+
+    # The output buffers are reused.
+    reused = dtl.get_window_batch(starts, tsidx, out=batch)
+    assert all(a is b for a, b in zip(reused, batch))
+
+
+@pytest.mark.parametrize("prefetch,prefetch_mode", [(0, "thread"), (2, "thread"),
+                                                    (2, "process")])
+def test_sampler_matches_eval_generator(dtl, prefetch, prefetch_mode) -> None:
+    sampler = dtl.sampler("val", shift=3, prefetch=prefetch, prefetch_mode=prefetch_mode)
+    expected = list(dtl.test_val_gen("val", shift=3))
+    actual = list(sampler)
+    assert len(actual) == len(sampler) == len(expected)
+    for element, expected_element in zip(actual, expected):
+        for x, e, dtype in zip(element, expected_element, data_loader._OUTPUT_DTYPES):
+            assert x.dtype == dtype
+            np.testing.assert_array_equal(x, e.astype(dtype))
+
+
+def test_sampler_batches_train_windows(tmp_path) -> None:
+    dtl = _make_data(tmp_path / "data.csv", permute=False)
+    batches = list(dtl.sampler("train", batch_size=7, shuffle=False))
+    elements = [tuple(x[i] for x in b) for b in batches for i in range(len(b[0]))]
+    # Each window is repeated num_ts // batch_size + 1 times with all series.
+    assert len(elements) == 2 * (200 - _HIST_LEN - _PRED_LEN)
+    for i, element in enumerate(elements):
+        start = i // 2
+        window = dtl._get_features_and_ts(
+            np.arange(start, start + _HIST_LEN + _PRED_LEN), np.arange(_NUM_TS))
+        for x, e in zip(element[:6], window[0::2] + window[1::2]):
+            np.testing.assert_array_equal(x, e.astype(x.dtype))
+
+
+def test_sampler_draws_series_without_replacement(dtl) -> None:
+    sampler = dtl.sampler("train", batch_size=16, seed=0)
+    batch = next(iter(sampler))
+    assert batch[0].shape == (16, 4, _HIST_LEN) and batch[3].shape == (16, 4, _PRED_LEN)
+    assert all(len(set(tsidx)) == 4 for tsidx in batch[6])
+    # Epochs of samplers with the same seed are the same.
+    for x, y in zip(batch, next(iter(dtl.sampler("train", batch_size=16, seed=0)))):
+        np.testing.assert_array_equal(x, y)
+    with pytest.raises(ValueError, match="cannot be batched"):
+        dtl.sampler("val", batch_size=16)
+
+
+def test_columnar_matches_csv(tmp_path) -> None:
+    path = tmp_path / "data.csv"
+    _make_data(path)
+    df = pd.read_csv(path)
+    df.loc[3:5, "ts1"] = np.nan
+    df.loc[7, "cat"] = np.nan
+    df["icat"] = np.arange(len(df)) % 5
+    df.to_csv(path, index=False)
+
+    data_dir = data_loader.convert_csv(str(path), str(tmp_path / "columnar"), "date")
+    kwargs = dict(
+        datetime_col="date",
+        num_cov_cols=["num"],
+        cat_cov_cols=["cat", "icat"],
+        ts_cols=[f"ts{i}" for i in range(_NUM_TS)],
+        train_range=[0, 200],
+        val_range=[200, 250],
+        test_range=[250, 300],
+        hist_len=_HIST_LEN,
+        pred_len=_PRED_LEN,
+        batch_size=4,
+        freq="h",
+    )
+    expected = data_loader.TimeSeriesdata(data_path=str(path), **kwargs)
+    actual = data_loader.TimeSeriesdata(data_path=data_dir, **kwargs)
+    for name in ("data_mat", "time_mat", "num_feat_mat", "cat_feat_mat"):
+        np.testing.assert_array_equal(getattr(actual, name), getattr(expected, name))
+    assert actual.cat_sizes == expected.cat_sizes == [4, 5]
+    # The numerical columns are views of the memory-mapped matrix.
+    base = actual.data_df["ts0"].to_numpy()
+    while base.base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap)
+
+
+@pytest.mark.parametrize("batch_size", [None, 8])
+def test_shared_memory_workers_are_deterministic(dtl, batch_size) -> None:
+    expected = list(dtl.sampler("train", batch_size=batch_size, seed=1, prefetch=0))
+    actual = list(dtl.sampler("train", batch_size=batch_size, seed=1,
+                              prefetch=3, prefetch_mode="process", num_workers=2))
+    assert len(actual) == len(expected)
+    for element, expected_element in zip(actual, expected):
+        for x, e in zip(element, expected_element):
+            np.testing.assert_array_equal(x, e)
@@ -0,0 +1,96 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from finetuning.finetuning_example import TimeSeriesDataset
+from timesfm.xreg_lib import RaggedArray
+
+CONTEXT_LENGTH, HORIZON_LENGTH = 4, 2
+
+
+def _eager_windows(series: np.ndarray) -> list:
+    """The (x_context, x_future) pairs of the former eager implementation."""
+    total_length = CONTEXT_LENGTH + HORIZON_LENGTH
+    return [
+        (series[start:start + CONTEXT_LENGTH],
+         series[start + CONTEXT_LENGTH:start + total_length])
+        for start in range(len(series) - total_length + 1)
+    ]
+
+
+def _assert_windows(dataset: TimeSeriesDataset, expected: list) -> None:
+    assert len(dataset) == len(expected)
+    for index, (context, future) in enumerate(expected):
+        x_context, x_padding, freq, x_future = dataset[index]
+        torch.testing.assert_close(x_context, torch.tensor(context, dtype=torch.float32))
+        torch.testing.assert_close(x_future, torch.tensor(future, dtype=torch.float32))
+        assert torch.equal(x_padding, torch.zeros(CONTEXT_LENGTH))
+        assert torch.equal(freq, torch.tensor([dataset.freq_type]))
+
+
+def _series_list() -> list:
+    rng = np.random.default_rng(0)
+    # The second series is too short for a single window.
+    return [rng.normal(size=n) for n in (10, 3, 12)]
+
+
+def test_windows_match_eager_windows() -> None:
+    series = np.random.default_rng(0).normal(size=20)
+    dataset = TimeSeriesDataset(series, CONTEXT_LENGTH, HORIZON_LENGTH, freq_type=1)
+    _assert_windows(dataset, _eager_windows(series))
+
+
+@pytest.mark.parametrize("as_ragged", [False, True])
+def test_windows_do_not_cross_series(as_ragged) -> None:
+    series = _series_list()
+    inputs = RaggedArray.from_sequences(series) if as_ragged else series
+    dataset = TimeSeriesDataset(inputs, CONTEXT_LENGTH, HORIZON_LENGTH)
+
+    _assert_windows(dataset, [w for s in series for w in _eager_windows(s)])
+    assert dataset.sample_series.tolist() == [0] * 5 + [2] * 7
+    assert dataset.sample_starts.tolist() == list(range(5)) + list(range(7))
+
+
+def test_read_only_memmap_is_not_copied(tmp_path) -> None:
+    series = _series_list()
+    ragged = RaggedArray.from_sequences(series)
+    path = tmp_path / "values.npy"
+    np.save(path, ragged.values.astype(np.float32))
+    values = np.load(path, mmap_mode="r")
+    dataset = TimeSeriesDataset(RaggedArray(values, ragged.offsets),
+                                CONTEXT_LENGTH, HORIZON_LENGTH)
+
+    assert np.shares_memory(dataset._values, values)
+    _assert_windows(dataset, [w for s in series for w in _eager_windows(s)])
+    batch = dataset.__getitems__([0, 11])
+    torch.testing.assert_close(batch[1][3], dataset[11][3])
+
+
+def test_data_loader_batches_match_eager_windows() -> None:
+    series = _series_list()
+    dataset = TimeSeriesDataset(series, CONTEXT_LENGTH, HORIZON_LENGTH)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=5)
+
+    x_context, x_padding, freq, x_future = [torch.cat(x) for x in zip(*loader)]
+    expected = [w for s in series for w in _eager_windows(s)]
+    torch.testing.assert_close(
+        x_context, torch.tensor(np.stack([c for c, _ in expected]), dtype=torch.float32))
+    torch.testing.assert_close(
+        x_future, torch.tensor(np.stack([f for _, f in expected]), dtype=torch.float32))
+    assert x_padding.shape == (12, CONTEXT_LENGTH)
+    assert freq.shape == (12, 1)
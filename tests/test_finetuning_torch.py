@@ -0,0 +1,168 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import socket
+
+import pandas as pd
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from finetuning import finetuning_torch
+
+
+def _make_dataset(num_samples: int = 24) -> torch.utils.data.Dataset:
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(num_samples, 64, generator=generator)
+    return torch.utils.data.TensorDataset(
+        x, torch.zeros_like(x), torch.zeros(num_samples, 1, dtype=torch.long),
+        torch.randn(num_samples, 16, generator=generator))
+
+
+def _train_rank(rank: int, model: torch.nn.Module,
+                config: finetuning_torch.FinetuningConfig, out_dir: str) -> None:
+    finetuner = finetuning_torch.TimesFMFinetuner(model, config, rank=rank)
+    assert torch.get_num_threads() == 1
+    history = finetuner.finetune(_make_dataset(), _make_dataset(8))["history"]
+    torch.save((history, model.state_dict()), f"{out_dir}/rank{rank}.pt")
+
+
+class _GradientRecorder:
+    """Stands in for the optimizer and records the gradients of each step."""
+
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+        self.steps = []
+
+    def step(self) -> None:
+        self.steps.append({name: param.grad.clone()
+                           for name, param in self.model.named_parameters()})
+
+    def zero_grad(self) -> None:
+        self.model.zero_grad()
+
+
+def test_accumulated_micro_batches_match_one_batch(make_decoder) -> None:
+    dataset = _make_dataset(8)
+
+    def step_gradients(batch_size: int, accumulation_steps: int) -> list:
+        config = finetuning_torch.FinetuningConfig(
+            batch_size=batch_size, device="cpu",
+            gradient_accumulation_steps=accumulation_steps)
+        finetuner = finetuning_torch.TimesFMFinetuner(make_decoder(), config)
+        recorder = _GradientRecorder(finetuner.model)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+        finetuner._train_epoch(loader, recorder)
+        return recorder.steps
+
+    # 2 micro-batches of 4 samples and 1 batch of 8 samples per step.
+    accumulated, full = step_gradients(4, 2), step_gradients(8, 1)
+    assert len(accumulated) == len(full) == 1
+    for name, grad in full[0].items():
+        torch.testing.assert_close(accumulated[0][name], grad,
+                                   rtol=1e-5, atol=1e-6)
+
+
+def test_gradient_accumulation_steps_must_be_positive(make_decoder) -> None:
+    config = finetuning_torch.FinetuningConfig(
+        device="cpu", gradient_accumulation_steps=0)
+    with pytest.raises(ValueError, match="gradient_accumulation_steps"):
+        finetuning_torch.TimesFMFinetuner(make_decoder(), config)
+
+
+def test_bf16_autocast_trains(make_decoder) -> None:
+    model = make_decoder()
+    initial = {name: value.clone() for name, value in model.state_dict().items()}
+    config = finetuning_torch.FinetuningConfig(
+        batch_size=4, num_epochs=2, device="cpu", use_bf16_autocast=True)
+    history = finetuning_torch.TimesFMFinetuner(model, config).finetune(
+        _make_dataset(), _make_dataset(8))["history"]
+
+    losses = history["train_loss"] + history["val_loss"]
+    assert all(torch.isfinite(torch.tensor(loss)) for loss in losses)
+    # Autocast only changes the compute dtype, not the one of the weights.
+    for name, value in model.state_dict().items():
+        assert value.dtype == initial[name].dtype
+    assert not torch.equal(model.state_dict()["horizon_ff_layer.output_layer.weight"],
+                           initial["horizon_ff_layer.output_layer.weight"])
+
+
+def test_gloo_ranks_stay_in_sync(make_decoder, tmp_path) -> None:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    config = finetuning_torch.FinetuningConfig(
+        batch_size=4, num_epochs=2, device="cpu", distributed=True, world_size=2,
+        num_threads_per_process=1, master_port=str(port))
+    # Every rank gets a copy of the same initial model.
+    torch.multiprocessing.spawn(_train_rank, args=(make_decoder(), config, str(tmp_path)),
+                                nprocs=2)
+
+    (history0, state0), (history1, state1) = [
+        torch.load(tmp_path / f"rank{rank}.pt") for rank in range(2)]
+    # The losses are averaged over the ranks, and the DDP replicas stay equal.
+    assert history0 == history1
+    initial = make_decoder().state_dict()
+    assert not torch.equal(state0["horizon_ff_layer.output_layer.weight"],
+                           initial["horizon_ff_layer.output_layer.weight"])
+    for name, value in state0.items():
+        torch.testing.assert_close(state1[name], value, rtol=0, atol=0)
+
+
+def test_gloo_cores_are_split_between_local_ranks(monkeypatch) -> None:
+    pinned = []
+    monkeypatch.setattr(finetuning_torch.os, "sched_getaffinity",
+                        lambda pid: set(range(8)), raising=False)
+    monkeypatch.setattr(finetuning_torch.os, "sched_setaffinity",
+                        lambda pid, cores: pinned.append(cores), raising=False)
+    monkeypatch.setattr(torch, "set_num_threads", lambda n: None)
+    # Global rank 5 of 8 is local rank 1 of the 4 processes of its node.
+    monkeypatch.setenv("LOCAL_RANK", "1")
+    monkeypatch.setenv("LOCAL_WORLD_SIZE", "4")
+    finetuning_torch.DistributedManager(8, 5, backend="gloo")._pin_threads()
+    monkeypatch.delenv("LOCAL_RANK")
+    monkeypatch.delenv("LOCAL_WORLD_SIZE")
+    finetuning_torch.DistributedManager(4, 3, backend="gloo")._pin_threads()
+    assert pinned == [[2, 3], [6, 7]]
+
+
+@pytest.mark.parametrize("extension", ["jsonl", "csv"])
+def test_step_metrics_are_logged_locally(make_decoder, tmp_path, extension) -> None:
+    path = tmp_path / f"metrics.{extension}"
+    config = finetuning_torch.FinetuningConfig(
+        batch_size=4, num_epochs=2, device="cpu", log_every_n_steps=4,
+        instrument_steps=True, metrics_path=str(path))
+    history = finetuning_torch.TimesFMFinetuner(make_decoder(), config).finetune(
+        _make_dataset(), _make_dataset(8))["history"]
+
+    if extension == "jsonl":
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+    else:
+        df = pd.read_csv(path)
+        records = [{"step": step, **dict(zip(group.metric, group.value))}
+                   for step, group in df.groupby("step", sort=False)]
+    # 6 steps per epoch, logged every 4 steps, and the epoch metrics.
+    step_records = [r for r in records if "train/loss" in r]
+    epoch_records = [r for r in records if "train_loss" in r]
+    assert [r["step"] for r in step_records] == [4, 8, 12]
+    assert [r["step"] for r in epoch_records] == [6, 12]
+    for record in step_records:
+        assert record["throughput/samples_per_sec"] > 0
+        assert record["throughput/patches_per_sec"] == pytest.approx(
+            2 * record["throughput/samples_per_sec"])
+        assert all(record[f"time/{phase}_ms"] > 0 for phase in ("forward", "backward"))
+        assert record["memory/peak_mb"] > 0
+    assert [r["train_loss"] for r in epoch_records] == pytest.approx(history["train_loss"])
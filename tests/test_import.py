@@ -0,0 +1,68 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+_HEAVY_MODULES = ("jax", "paxml", "praxis", "tensorflow", "torch")
+
+
+def _run(code: str, **env: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, **env},
+    )
+
+
+def test_import_is_lazy_and_silent() -> None:
+    """Benchmarks `import timesfm` in a fresh interpreter."""
+    code = f"""
+import json, sys, time
+start = time.perf_counter()
+import timesfm
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "loaded": [m for m in {_HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+    proc = _run(code)
+    lines = proc.stdout.strip().splitlines()
+    assert len(lines) == 1, f"Unexpected stdout from import: {proc.stdout}"
+    result = json.loads(lines[0])
+    print(f"import timesfm took {result['seconds']:.3f}s")
+    assert result["loaded"] == []
+
+
+def test_backend_from_env_var() -> None:
+    pytest.importorskip("torch")
+    proc = _run(
+        "import sys, timesfm; print(timesfm.TimesFm.__name__, 'jax' in sys.modules)",
+        TIMESFM_BACKEND="torch",
+    )
+    assert proc.stdout.split() == ["TimesFmTorch", "False"]
+
+
+def test_get_model_rejects_unknown_backend() -> None:
+    import timesfm
+
+    with pytest.raises(ValueError, match="Unsupported backend"):
+        timesfm.get_model("tensorflow")
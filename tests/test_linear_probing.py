@@ -0,0 +1,60 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from finetuning import linear_probing
+
+
+class _Windows(torch.utils.data.Dataset):
+
+    def __init__(self, num_samples: int):
+        self.x = torch.randn(num_samples, 64)
+        self.y = torch.randn(num_samples, 16)
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.x[i], torch.zeros(64), torch.zeros(1, dtype=torch.long), self.y[i]
+
+
+@pytest.mark.parametrize("dtype,on_disk", [(np.float32, False), (np.float16, True)])
+def test_probe_on_cache_matches_model(make_decoder, tmp_path, dtype, on_disk) -> None:
+    model = make_decoder()
+    dataset = _Windows(10)
+    cache_dir = str(tmp_path / "cache") if on_disk else None
+    cache = linear_probing.cache_features(model, dataset, batch_size=4,
+                                          cache_dir=cache_dir, dtype=dtype)
+    assert len(cache) == 10 and cache.features.dtype == dtype
+    if on_disk:
+        assert isinstance(cache.features, np.memmap)
+        cache = linear_probing.FeatureCache.load(cache_dir)
+
+    linear_probing.freeze_backbone(model)
+    probe = linear_probing.HorizonProbe(model)
+    assert {n for n, p in probe.named_parameters() if p.requires_grad} == {
+        n for n, _ in probe.named_parameters() if n.startswith("decoder.horizon_ff_layer.")
+    }
+    features, mu, sigma, x_future = next(iter(torch.utils.data.DataLoader(cache, batch_size=10)))
+    torch.testing.assert_close(x_future, dataset.y)
+    with torch.no_grad():
+        expected = model(dataset.x, torch.zeros_like(dataset.x), torch.zeros(10, 1, dtype=torch.long))
+        actual = probe(features, mu, sigma)
+    tolerance = 1e-5 if dtype == np.float32 else 2e-2
+    torch.testing.assert_close(actual, expected, rtol=tolerance, atol=tolerance)
@@ -0,0 +1,78 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from finetuning import lora_torch
+
+
+@pytest.mark.parametrize("target_modules,num_adapters", [("all", 8), ("attention", 4),
+                                                         ("mlp", 4)])
+@pytest.mark.parametrize("use_dora", [False, True])
+def test_adapters_train_and_merge(make_decoder, target_modules, num_adapters,
+                                  use_dora) -> None:
+    model = make_decoder()
+    x = torch.randn(3, 64)
+    paddings, freq = torch.zeros_like(x), torch.zeros(3, 1, dtype=torch.long)
+    with torch.no_grad():
+        expected = model(x, paddings, freq)
+
+    lora_torch.apply_lora(model, rank=4, target_modules=target_modules, use_dora=use_dora)
+    adapters = [m for m in model.modules() if isinstance(m, lora_torch.LoraLinear)]
+    assert len(adapters) == num_adapters
+    # The adapters start as the identity and are the only trainable parameters.
+    with torch.no_grad():
+        torch.testing.assert_close(model(x, paddings, freq), expected)
+    trainable = {n for n, p in model.named_parameters() if p.requires_grad}
+    assert trainable == set(lora_torch.lora_state_dict(model))
+
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=0.1)
+    model(x, paddings, freq).square().mean().backward()
+    optimizer.step()
+    assert all(p.grad is None for p in model.parameters() if not p.requires_grad)
+
+    with torch.no_grad():
+        adapted = model(x, paddings, freq)
+        lora_torch.merge_lora(model)
+        merged = model(x, paddings, freq)
+    assert not torch.allclose(adapted, expected)
+    torch.testing.assert_close(merged, adapted, rtol=1e-4, atol=1e-4)
+    assert set(model.state_dict()) == set(make_decoder().state_dict())
+
+
+def test_unknown_target_modules(make_decoder) -> None:
+    with pytest.raises(ValueError, match="Unknown lora_target_modules"):
+        lora_torch.apply_lora(make_decoder(), rank=4, target_modules="embedding")
+
+
+def test_query_key_value_get_their_own_adapters(make_decoder) -> None:
+    model = lora_torch.apply_lora(make_decoder(), rank=4, target_modules="attention")
+    qkv = model.stacked_transformer.layers[0].self_attn.qkv_proj
+    assert qkv.splits == (32, 32, 32)
+    assert qkv.lora_a.shape == (12, 32)
+    with torch.no_grad():
+        qkv.lora_b.normal_()
+        x = torch.randn(5, 32)
+        torch.testing.assert_close(qkv(x), torch.nn.functional.linear(
+            x, qkv.merged_weight(), qkv.base.bias))
+        # Each block of rows only depends on its own rows of lora_a.
+        update = qkv.merged_weight() - qkv.base.weight
+        qkv.lora_a[4:8] = 0
+        new_update = qkv.merged_weight() - qkv.base.weight
+    torch.testing.assert_close(new_update[:32], update[:32])
+    torch.testing.assert_close(new_update[64:], update[64:])
+    assert torch.count_nonzero(new_update[32:64]) == 0
@@ -0,0 +1,77 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from timesfm import pytorch_patched_decoder as ppd
+
+
+def _reference_shift(mask: torch.Tensor, seq: torch.Tensor) -> torch.Tensor:
+    """Row-by-row shift used as the ground truth for `_shift_padded_seq`."""
+    num_seq = seq.shape[1]
+    out = []
+    for row_mask, row in zip(mask, seq):
+        nonzero = (row_mask == 0).nonzero()
+        shift = int(nonzero[0]) if len(nonzero) else -1
+        out.append(row[(torch.arange(num_seq) - shift) % num_seq])
+    return torch.stack(out)
+
+
+def test_shift_padded_seq_matches_reference() -> None:
+    torch.manual_seed(0)
+    mask = torch.zeros(5, 8)
+    mask[0, :3] = 1
+    mask[1, :] = 1
+    mask[3, :7] = 1
+    seq = torch.randn(5, 8, 4)
+
+    assert torch.equal(ppd._shift_padded_seq(mask, seq), _reference_shift(mask, seq))
+    # A [1, N, D] sequence is broadcast over the batch.
+    assert torch.equal(
+        ppd._shift_padded_seq(mask, seq[:1]),
+        _reference_shift(mask, seq[:1].expand(5, -1, -1)),
+    )
+
+
+def test_positional_embedding_is_cached() -> None:
+    emb = ppd.PositionalEmbedding(embedding_dims=16)
+    first = emb(12)
+    assert first.shape == (1, 12, 16)
+    assert emb(12) is first
+    assert torch.equal(emb(position=torch.arange(12.0)[None, :]), first)
+
+
+def test_gradient_checkpointing_matches_gradients(make_decoder) -> None:
+    model = make_decoder()
+    x = torch.randn(3, 64)
+    freq = torch.zeros(3, 1, dtype=torch.long)
+
+    def gradients(checkpointing: bool) -> list[torch.Tensor]:
+        model.stacked_transformer.gradient_checkpointing = checkpointing
+        model.zero_grad()
+        model(x, torch.zeros_like(x), freq).square().mean().backward()
+        return [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+    for expected, actual in zip(gradients(False), gradients(True)):
+        torch.testing.assert_close(actual, expected)
+
+
+def test_attention_scaling_starts_at_zero() -> None:
+    attention = ppd.TimesFMAttention(hidden_size=32, num_heads=2, num_kv_heads=2, head_dim=16)
+    assert torch.equal(attention.scaling, torch.zeros(16))
+    # A freshly built model starts from the usual 1 / sqrt(head_dim) scaling.
+    query = torch.randn(1, 4, 2, 16)
+    torch.testing.assert_close(attention._per_dim_scaling(query), query / 4)
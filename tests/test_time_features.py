@@ -0,0 +1,89 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timesfm import time_features
+
+
+def _reference_distance(holiday, index: pd.Timestamp) -> int:
+    window = pd.Timedelta(days=time_features.MAX_WINDOW)
+    return (index - holiday.dates(index - window, index + window)[0]).days
+
+
+@pytest.mark.parametrize("holiday", time_features.HOLIDAYS, ids=lambda h: h.name)
+def test_distance_to_holiday_matches_per_timestamp(holiday) -> None:
+    rng = np.random.default_rng(0)
+    minutes = np.sort(rng.integers(0, 30 * 365 * 24 * 60, size=200))
+    datetimes = pd.Timestamp("1995-01-01") + pd.to_timedelta(minutes, unit="min")
+    expected = [_reference_distance(holiday, t) for t in datetimes]
+    np.testing.assert_array_equal(
+        time_features._distance_to_holiday(holiday, pd.DatetimeIndex(datetimes)),
+        expected,
+    )
+
+
+def test_week_of_year_matches_strftime() -> None:
+    datetimes = pd.date_range("1990-01-01", "2030-12-31", freq="D")
+    covariates = time_features.TimeCovariates(
+        datetimes, normalized=False, store=time_features.CalendarFeatureStore()
+    )
+    np.testing.assert_array_equal(
+        covariates._week_of_year(), datetimes.strftime("%U").astype(int)
+    )
+
+
+@pytest.mark.parametrize("holiday", [False, True])
+def test_store_serves_sub_ranges(tmp_path, holiday: bool) -> None:
+    datetimes = pd.date_range("2015-03-01 05:00", "2015-06-01", freq="h")
+    store = time_features.CalendarFeatureStore(cache_dir=str(tmp_path))
+
+    def direct(dti):
+        raw = time_features.TimeCovariates(dti, holiday=holiday)._get_raw_covariates()
+        return time_features._covariates_frame(raw, dti, holiday)
+
+    # A range outside of the cached one extends it, and a sub-range with a gap
+    # is served from the cache, also after reloading it from disk.
+    for dti in (datetimes[100:300], datetimes, datetimes[:50].append(datetimes[60:90])):
+        pd.testing.assert_frame_equal(store.get(dti, holiday=holiday), direct(dti))
+    (segments,) = store._cache.values()
+    ((start, cached),) = segments.items()
+    assert cached.shape[1] == len(datetimes)
+
+    reloaded = time_features.CalendarFeatureStore(cache_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(
+        reloaded.get(datetimes[5:50], holiday=holiday), direct(datetimes[5:50])
+    )
+
+
+def test_store_keeps_far_apart_ranges_separate(tmp_path) -> None:
+    first = pd.date_range("1990-01-01", periods=3, freq="min")
+    second = pd.date_range("2020-01-01", periods=3, freq="min")
+    store = time_features.CalendarFeatureStore(cache_dir=str(tmp_path))
+    for dti in (first, second, first.append(first + pd.Timedelta(minutes=4))):
+        raw = time_features.TimeCovariates(dti)._get_raw_covariates()
+        pd.testing.assert_frame_equal(
+            store.get(dti), time_features._covariates_frame(raw, dti, False)
+        )
+    (segments,) = store._cache.values()
+    assert sorted(c.shape[1] for c in segments.values()) == [3, 7]
+
+    # The least recently used segments are evicted beyond the bound.
+    reloaded = time_features.CalendarFeatureStore(
+        cache_dir=str(tmp_path), max_bytes=min(c.nbytes for c in segments.values()))
+    reloaded.get(second)
+    (segments,) = reloaded._cache.values()
+    assert [c.shape[1] for c in segments.values()] == [3]
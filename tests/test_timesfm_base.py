@@ -0,0 +1,188 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timesfm import timesfm_base
+
+
+class _MeanModel(timesfm_base.TimesFmBase):
+    """Forecasts the mean of each context, without any checkpoint."""
+
+    def load_from_checkpoint(self, checkpoint: timesfm_base.TimesFmCheckpoint) -> None:
+        self._median_index = -1
+
+    def _forecast(self, inputs, freq=None, window_size=None, forecast_context_len=None,
+                  return_forecast_on_context=False):
+        length = self.context_len - self.input_patch_len + self.horizon_len
+        mean = np.stack([np.full(length, np.mean(x[-self.context_len:])) for x in inputs])
+        return mean, np.stack([mean, mean], axis=-1)
+
+
+def _make_model() -> _MeanModel:
+    return _MeanModel(
+        timesfm_base.TimesFmHparams(
+            context_len=64, horizon_len=16, input_patch_len=8, quantiles=(0.5,)
+        ),
+        timesfm_base.TimesFmCheckpoint(),
+    )
+
+
+def _make_frames(seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    history, future = [], []
+    for i in range(5):
+        train_len, test_len = rng.integers(10, 40), rng.integers(3, 8)
+        df = pd.DataFrame({
+            "unique_id": f"s{i}",
+            "ds": pd.date_range("2020-01-01", periods=train_len + test_len, freq="D"),
+            "values": rng.normal(size=train_len + test_len),
+            "x": rng.normal(size=train_len + test_len),
+            "c": rng.choice(["a", "b", "c"], train_len + test_len),
+            "store": "ab"[i % 2],
+        })
+        history.append(df.iloc[:train_len])
+        future.append(df.iloc[train_len:].drop(columns="values"))
+    # Shuffled, as the rows of a dataframe need not be sorted.
+    return (pd.concat(history).sample(frac=1, random_state=0),
+            pd.concat(future).sample(frac=1, random_state=0))
+
+
+@pytest.mark.parametrize("xreg_mode", ["xreg + timesfm", "timesfm + xreg"])
+def test_forecast_with_covariates_on_df_matches_lists(xreg_mode: str) -> None:
+    model = _make_model()
+    history, future = _make_frames()
+    actual = model.forecast_with_covariates_on_df(
+        history, "D", future,
+        dynamic_numerical_covariates=["x"],
+        dynamic_categorical_covariates=["c"],
+        static_categorical_covariates=["store"],
+        xreg_mode=xreg_mode,
+        ridge=1.0,
+    )
+
+    history = history.sort_values(["unique_id", "ds"])
+    future = future.sort_values(["unique_id", "ds"])
+    uids = sorted(history["unique_id"].unique())
+    groups = [(history[history.unique_id == u], future[future.unique_id == u]) for u in uids]
+    expected, _ = model.forecast_with_covariates(
+        inputs=[h["values"].to_numpy() for h, _ in groups],
+        dynamic_numerical_covariates={"x": [np.r_[h.x, f.x] for h, f in groups]},
+        dynamic_categorical_covariates={"c": [np.r_[h.c, f.c] for h, f in groups]},
+        static_categorical_covariates={"store": [h.store.iloc[-1] for h, _ in groups]},
+        freq=[0] * len(uids),
+        xreg_mode=xreg_mode,
+        ridge=1.0,
+    )
+    pd.testing.assert_frame_equal(
+        actual[["unique_id", "ds"]], future[["unique_id", "ds"]].reset_index(drop=True)
+    )
+    np.testing.assert_allclose(actual["timesfm"], np.concatenate(expected), atol=1e-12)
+
+
+def test_forecast_with_covariates_on_df_without_future() -> None:
+    history, _ = _make_frames()
+    actual = _make_model().forecast_with_covariates_on_df(
+        history, "D", static_categorical_covariates=["store"], ridge=1.0
+    )
+    assert actual.groupby("unique_id").size().tolist() == [16] * 5
+    with pytest.raises(ValueError, match="future_df is required"):
+        _make_model().forecast_with_covariates_on_df(
+            history, "D", dynamic_numerical_covariates=["x"]
+        )
+
+
+def test_forecast_with_covariates_fits_residuals_of_long_inputs() -> None:
+    rng = np.random.default_rng(0)
+    inputs = [rng.normal(size=100), rng.normal(size=30)]
+    covariates = [rng.normal(size=len(x) + 4) for x in inputs]
+
+    def forecast(truncate: int):
+        return _make_model().forecast_with_covariates(
+            inputs=[x[-truncate:] for x in inputs],
+            dynamic_numerical_covariates={"x": [c[-truncate - 4:] for c in covariates]},
+            freq=[0, 0],
+            xreg_mode="timesfm + xreg",
+            ridge=1.0,
+        )
+
+    # The residuals are only fit on the last context_len points of an input.
+    for actual, expected in zip(forecast(100), forecast(64)):
+        for a, e in zip(actual, expected):
+            np.testing.assert_allclose(a, e)
+
+
+class _PipelineModel(timesfm_base.TimesFmBase):
+    """Decodes the row sums of its inputs, with uneven delays in each stage."""
+
+    def load_from_checkpoint(self, checkpoint: timesfm_base.TimesFmCheckpoint) -> None:
+        self.failing_stage = None
+
+    def _stage(self, name: str, batch_index: int) -> None:
+        time.sleep(0.002 * ((3 * batch_index + len(name)) % 4))
+        if self.failing_stage == name and batch_index == 2:
+            raise RuntimeError(f"{name} failed")
+
+    def _prepare_batch(self, input_ts, input_padding, inp_freq):
+        batch_index = int(inp_freq[0, 0])
+        self._stage("prepare", batch_index)
+        return batch_index, input_ts + input_padding
+
+    def _decode_batch(self, batch):
+        batch_index, x = batch
+        self._stage("decode", batch_index)
+        return batch_index, x.sum(axis=1)
+
+    def _fetch_batch(self, outputs, return_forecast_on_context):
+        batch_index, sums = outputs
+        self._stage("fetch", batch_index)
+        return sums[:, None], np.stack([sums, -sums], axis=-1)[:, None]
+
+
+def _decode(pipeline_depth: int, failing_stage: str | None = None):
+    model = _PipelineModel(
+        timesfm_base.TimesFmHparams(per_core_batch_size=2,
+                                    pipeline_depth=pipeline_depth),
+        timesfm_base.TimesFmCheckpoint(),
+    )
+    model.failing_stage = failing_stage
+    input_ts = np.arange(10 * 4, dtype=np.float32).reshape(10, 4)
+    # The frequency holds the index of the batch of each row.
+    inp_freq = np.repeat(np.arange(5), 2)[:, None]
+    outputs = model._pipelined_decode(input_ts, np.zeros_like(input_ts), inp_freq)
+    return outputs, model.last_forecast_timings
+
+
+def test_pipelined_decode_matches_sequential_decode() -> None:
+    (mean0, full0), timings0 = _decode(0)
+    (mean2, full2), timings2 = _decode(2)
+    expected = np.arange(40, dtype=np.float32).reshape(10, 4).sum(axis=1)
+    np.testing.assert_array_equal(mean0[:, 0], expected)
+    np.testing.assert_array_equal(full0[:, 0], np.stack([expected, -expected], -1))
+    np.testing.assert_array_equal(mean2, mean0)
+    np.testing.assert_array_equal(full2, full0)
+    assert timings0.num_batches == timings2.num_batches == 5
+    assert timings2.decode_seconds > 0 and timings2.total_seconds > 0
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 2])
+@pytest.mark.parametrize("stage", ["prepare", "decode", "fetch"])
+def test_pipelined_decode_raises_stage_errors(pipeline_depth: int, stage: str) -> None:
+    with pytest.raises(RuntimeError, match=f"{stage} failed"):
+        _decode(pipeline_depth, failing_stage=stage)
+
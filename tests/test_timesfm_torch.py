@@ -0,0 +1,106 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import timesfm
+from timesfm import pytorch_patched_decoder as ppd
+from timesfm import timesfm_torch
+
+
+_HPARAMS = timesfm.TimesFmHparams(
+    context_len=64, horizon_len=32, input_patch_len=32, output_patch_len=32,
+    num_layers=1, num_heads=16, model_dims=32, per_core_batch_size=2,
+    quantiles=[0.1, 0.5, 0.9])
+
+
+@pytest.fixture(scope="module")
+def decoder() -> ppd.PatchedTimeSeriesDecoder:
+    torch.manual_seed(0)
+    return ppd.PatchedTimeSeriesDecoder(
+        ppd.TimesFMConfig(num_layers=1, num_heads=16, hidden_size=32,
+                          intermediate_size=32, patch_len=32, horizon_len=32,
+                          head_dim=2, quantiles=_HPARAMS.quantiles)).eval()
+
+
+@pytest.fixture(scope="module")
+def checkpoint_path(decoder, tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp("checkpoint") / "torch_model.ckpt")
+    torch.save(decoder.state_dict(), path)
+    return path
+
+
+def _load(path: str) -> timesfm_torch.TimesFmTorch:
+    return timesfm_torch.TimesFmTorch(
+        _HPARAMS, timesfm.TimesFmCheckpoint(version="torch", path=path))
+
+
+@pytest.fixture(scope="module")
+def tfm(checkpoint_path) -> timesfm_torch.TimesFmTorch:
+    return _load(checkpoint_path)
+
+
+@pytest.mark.parametrize("safetensors", [False, True])
+def test_checkpoint_round_trip(decoder, checkpoint_path, tmp_path, safetensors) -> None:
+    path = checkpoint_path
+    if safetensors:
+        path = timesfm_torch.convert_checkpoint_to_safetensors(
+            checkpoint_path, str(tmp_path / "torch_model.safetensors"))
+        assert path.endswith(".safetensors")
+    loaded = _load(path)
+
+    # The model is built on the meta device and adopts the loaded tensors.
+    parameters = dict(loaded._model.named_parameters())
+    assert parameters.keys() == dict(decoder.named_parameters()).keys()
+    for name, param in decoder.named_parameters():
+        assert not parameters[name].is_meta
+        assert torch.equal(parameters[name], param)
+    assert not any(buffer.is_meta for buffer in loaded._model.buffers())
+
+    rng = np.random.default_rng(0)
+    inputs = [rng.normal(size=n) for n in (70, 30, 50)]
+    reference = _load(checkpoint_path)
+    reference._model = decoder
+    for actual, expected in zip(loaded.forecast(inputs), reference.forecast(inputs)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_pool_matches_forecast(tfm) -> None:
+    rng = np.random.default_rng(0)
+    inputs = [rng.normal(size=n) for n in (70, 30, 50, 64, 10)]
+    expected = tfm.forecast(inputs, freq=[0, 1, 2, 0, 1])
+    with timesfm_torch.TimesFmTorchPool(tfm, num_workers=2) as pool:
+        actual = pool.forecast(inputs, freq=[0, 1, 2, 0, 1])
+        point, full = pool.forecast([])
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, rtol=1e-5, atol=1e-5)
+    assert point.shape == (0, 32)
+    assert full.shape == (0, 32, 4)
+
+
+def test_pool_closes_when_a_worker_dies(tfm) -> None:
+    pool = timesfm_torch.TimesFmTorchPool(tfm, num_workers=2)
+    killed, other = pool._workers
+    killed.kill()
+    killed.join()
+    with pytest.raises(RuntimeError, match="worker died"):
+        pool.forecast([np.arange(40.0)] * 4)
+    # The other worker is stopped, and no later call can read its results.
+    assert not other.is_alive()
+    with pytest.raises(ValueError, match="closed"):
+        pool.forecast([np.arange(40.0)] * 4)
+    pool.close()
@@ -0,0 +1,325 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+import numpy as np
+import pytest
+
+from timesfm import xreg_lib
+
+
+def _make_xreg(num_series: int = 4, seed: int = 0) -> xreg_lib.BatchedInContextXRegLinear:
+    rng = np.random.default_rng(seed)
+    train_lens = rng.integers(20, 40, size=num_series).tolist()
+    test_lens = rng.integers(5, 10, size=num_series).tolist()
+    lens = [a + b for a, b in zip(train_lens, test_lens)]
+    num = [rng.normal(size=n) for n in lens]
+    cat = [rng.integers(0, 5, size=n) for n in lens]
+    return xreg_lib.BatchedInContextXRegLinear(
+        targets=[rng.normal(size=n) for n in train_lens],
+        train_lens=train_lens,
+        test_lens=test_lens,
+        train_dynamic_numerical_covariates={"x": [v[:n] for v, n in zip(num, train_lens)]},
+        test_dynamic_numerical_covariates={"x": [v[n:] for v, n in zip(num, train_lens)]},
+        train_dynamic_categorical_covariates={"c": [v[:n] for v, n in zip(cat, train_lens)]},
+        test_dynamic_categorical_covariates={"c": [v[n:] for v, n in zip(cat, train_lens)]},
+        static_numerical_covariates={"s": rng.normal(size=num_series).tolist()},
+    )
+
+
+@pytest.mark.parametrize("backend", ["numpy", "jax", "torch"])
+@pytest.mark.parametrize("ridge", [0.0, 1.0])
+@pytest.mark.parametrize("solver", ["auto", "cholesky", "qr", "lstsq", "cg"])
+def test_solvers_match_pinv(backend: str, ridge: float, solver: str) -> None:
+    if backend != "numpy":
+        pytest.importorskip(backend)
+    xreg = _make_xreg()
+    drop = None if ridge > 0 else "first"
+    expected = xreg.fit(ridge=ridge, one_hot_encoder_drop=drop, solver="pinv")
+    actual = xreg.fit(
+        ridge=ridge, one_hot_encoder_drop=drop, solver=solver, backend=backend
+    )
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, atol=1e-4)
+
+
+def test_solver_falls_back_on_collinear_design() -> None:
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(64, 3))
+    x = np.concatenate([x, x[:, :1]], axis=1)  # Duplicated column.
+    y = rng.normal(size=64)
+
+    expected = np.linalg.pinv(x) @ y
+    for solver in ("cholesky", "qr"):
+        np.testing.assert_allclose(
+            xreg_lib._solve_dense(x, y, 0.0, solver), expected, atol=1e-8
+        )
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_cholesky_solves_batches_of_designs(backend: str) -> None:
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(3, 40, 5))
+    y = rng.normal(size=(3, 40))
+    expected = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(x, y)])
+    if backend == "torch":
+        torch = pytest.importorskip("torch")
+        x, y = torch.from_numpy(x), torch.from_numpy(y)
+    actual = xreg_lib._solve_dense(x, y, 0.0, "cholesky")
+    np.testing.assert_allclose(xreg_lib._to_numpy(actual), expected, atol=1e-10)
+
+
+class _NoGramArray(np.ndarray):
+    """A design that fails any matrix product with a [cols, cols] result."""
+
+    def __array_finalize__(self, obj):
+        # Also set on the transposed views of the design.
+        self.cols = getattr(obj, "cols", self.shape[-1] if self.ndim else 0)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        cols = self.cols
+        inputs = [np.asarray(x) if isinstance(x, _NoGramArray) else x for x in inputs]
+        out = getattr(ufunc, method)(*inputs, **kwargs)
+        if ufunc is np.matmul:
+            assert out.shape[-2:] != (cols, cols), "The Gram matrix was formed."
+        return out
+
+
+def test_cg_does_not_form_the_gram_matrix() -> None:
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(30, 50))
+    y = rng.normal(size=30)
+    expected = xreg_lib._solve_dense(x, y, 1.0, "pinv")
+
+    actual = xreg_lib._solve_dense(x.view(_NoGramArray), y, 1.0, "cg", cg_tol=1e-10)
+    np.testing.assert_allclose(actual, expected, atol=1e-6)
+    with pytest.raises(AssertionError, match="Gram matrix"):
+        xreg_lib._solve_dense(x.view(_NoGramArray), y, 1.0, "cholesky")
+
+
+def test_import_does_not_load_jax() -> None:
+    import subprocess
+    import sys
+
+    code = "import sys, timesfm.xreg_lib; print('jax' in sys.modules)"
+    proc = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert proc.stdout.strip() == "False"
+
+
+@pytest.mark.parametrize("solver", ["auto", "pinv", "lstsq"])
+def test_sparse_design_matches_dense(solver: str) -> None:
+    xreg = _make_xreg()
+    xreg.static_categorical_covariates = {"store": ["a", "b", "c", "a"]}
+    _, x_dense, _ = xreg.create_covariate_matrix()
+    _, x_sparse, _ = xreg.create_covariate_matrix(sparse_output=True)
+    np.testing.assert_array_equal(x_sparse.toarray(), x_dense)
+
+    expected = xreg.fit(ridge=1.0, one_hot_encoder_drop=None)
+    actual = xreg.fit(
+        ridge=1.0, one_hot_encoder_drop=None, solver=solver, sparse_design=True
+    )
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, atol=1e-4)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "jax"])
+def test_per_input_fit_matches_separate_fits(backend: str) -> None:
+    if backend != "numpy":
+        pytest.importorskip(backend)
+    xreg = _make_xreg(num_series=3)
+    outputs, outputs_context, *_ = xreg.fit(
+        per_input=True, backend=backend, debug_info=True
+    )
+    for i in range(3):
+        single = xreg_lib.BatchedInContextXRegLinear(
+            targets=[xreg.targets[i]],
+            train_lens=[xreg.train_lens[i]],
+            test_lens=[xreg.test_lens[i]],
+            train_dynamic_numerical_covariates={
+                k: [v[i]] for k, v in xreg.train_dynamic_numerical_covariates.items()
+            },
+            test_dynamic_numerical_covariates={
+                k: [v[i]] for k, v in xreg.test_dynamic_numerical_covariates.items()
+            },
+            train_dynamic_categorical_covariates={
+                k: [v[i]] for k, v in xreg.train_dynamic_categorical_covariates.items()
+            },
+            test_dynamic_categorical_covariates={
+                k: [v[i]] for k, v in xreg.test_dynamic_categorical_covariates.items()
+            },
+        )
+        expected, expected_context, *_ = single.fit(solver="pinv", debug_info=True)
+        np.testing.assert_allclose(outputs[i], expected[0], atol=1e-4)
+        np.testing.assert_allclose(outputs_context[i], expected_context[0], atol=1e-4)
+
+
+@pytest.mark.parametrize("use_intercept", [False, True])
+def test_per_input_fit_drops_static_columns(caplog, use_intercept: bool) -> None:
+    xreg = _make_xreg(num_series=3)
+    xreg.static_categorical_covariates = {"g": ["a", "b", "a"]}
+    with caplog.at_level(logging.INFO):
+        actual, _, _, xs_train, xs_test = xreg.fit(
+            per_input=True, solver="cholesky", use_intercept=use_intercept,
+            debug_info=True)
+    assert "falling back to pinv" not in caplog.text
+    expected = xreg.fit(per_input=True, solver="pinv", use_intercept=use_intercept)
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, atol=1e-6)
+    # Only one of the intercept and the static columns remains per input.
+    for x_train, x_test, train_len in zip(xs_train, xs_test, xreg.train_lens):
+        x_train = x_train[:train_len]
+        constant = np.all(x_train == x_train[:1], axis=0) & np.any(x_train != 0, axis=0)
+        assert constant.sum() == 1
+        assert np.all(x_test[:, np.any(x_train != 0, axis=0) == 0] == 0)
+
+
+def test_chunked_fit_matches_dense() -> None:
+    xreg = _make_xreg(num_series=5)
+    expected, expected_context, *_ = xreg.fit(ridge=1.0, debug_info=True)
+    actual, actual_context, *_ = xreg.fit(ridge=1.0, chunk_size=2, debug_info=True)
+    for a, e in zip(actual + actual_context, expected + expected_context):
+        np.testing.assert_allclose(a, e, atol=1e-4)
+
+
+def test_gram_accumulator_rolling_update(tmp_path) -> None:
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=(100, 5)), rng.normal(size=100)
+    path = str(tmp_path / "gram.npz")
+    xreg_lib.GramAccumulator().update(x[:60], y[:60]).save(path)
+
+    accumulator = xreg_lib.GramAccumulator.load(path)
+    accumulator.update(x[60:], y[60:]).downdate(x[:20], y[:20])
+    assert accumulator.num_rows == 80
+    expected = np.linalg.solve(x[20:].T @ x[20:] + np.eye(5), x[20:].T @ y[20:])
+    np.testing.assert_allclose(accumulator.solve(ridge=1.0), expected, atol=1e-10)
+
+
+def _make_window_xreg(series, start: int, stop: int, test_len: int = 5):
+    num, cat, store, targets = series
+    return xreg_lib.BatchedInContextXRegLinear(
+        targets=[y[start:stop] for y in targets],
+        train_lens=[stop - start] * len(targets),
+        test_lens=[test_len] * len(targets),
+        train_dynamic_numerical_covariates={"x": [v[start:stop] for v in num]},
+        test_dynamic_numerical_covariates={"x": [v[stop:stop + test_len] for v in num]},
+        train_dynamic_categorical_covariates={"c": [v[start:stop] for v in cat]},
+        test_dynamic_categorical_covariates={"c": [v[stop:stop + test_len] for v in cat]},
+        static_categorical_covariates={"store": store},
+    )
+
+
+def test_rolling_fit_adds_new_rows_with_the_saved_encoding(tmp_path) -> None:
+    rng = np.random.default_rng(0)
+    num = [rng.normal(size=60) for _ in range(3)]
+    cat = [rng.choice(["a", "b", "c"], size=60) for _ in range(3)]
+    targets = [rng.normal(size=60) for _ in range(3)]
+    series = (num, cat, ["s0", "s1", "s0"], targets)
+    path = str(tmp_path / "gram.npz")
+
+    accumulator = xreg_lib.GramAccumulator()
+    _make_window_xreg(series, 0, 40).fit(ridge=1.0, gram_accumulator=accumulator)
+    accumulator.save(path)
+
+    # The window slides by 10 steps: 10 rows are added and the 10 first rows
+    # of the context are dropped.
+    accumulator = xreg_lib.GramAccumulator.load(path)
+    actual = _make_window_xreg(series, 0, 50).fit(
+        ridge=1.0, gram_accumulator=accumulator, new_rows=[10] * 3, window_rows=40)
+    np.testing.assert_array_equal(accumulator.input_rows, [40] * 3)
+    assert accumulator.num_rows == 120
+
+    xreg = _make_window_xreg(series, 10, 50)
+    encoding = xreg_lib.GramAccumulator.load(path).encoding
+    x_train, x_test = xreg._encode(encoding, 0, 3, use_intercept=True)
+    y = np.concatenate([t[10:50] for t in targets])
+    beta = np.linalg.solve(x_train.T @ x_train + np.eye(x_train.shape[1]), x_train.T @ y)
+    np.testing.assert_allclose(np.concatenate(actual), x_test @ beta, atol=1e-8)
+
+    with pytest.raises(ValueError, match="new_rows is required"):
+        xreg.fit(ridge=1.0, gram_accumulator=accumulator)
+    with pytest.raises(ValueError, match="must be in the context"):
+        xreg.fit(ridge=1.0, gram_accumulator=accumulator, new_rows=[10] * 3,
+                 window_rows=40)
+
+
+def test_ragged_array_slice_each() -> None:
+    sequences = [np.arange(5), np.arange(10, 13), np.arange(20, 24)]
+    ragged = xreg_lib.RaggedArray.from_sequences(sequences)
+    np.testing.assert_array_equal(ragged.lens, [5, 3, 4])
+    np.testing.assert_array_equal(ragged[1], sequences[1])
+    np.testing.assert_array_equal(ragged[1:].flat_values, np.concatenate(sequences[1:]))
+
+    sliced = ragged.slice_each(np.array([1, 0, 2]), np.array([4, 3, 2]))
+    for actual, expected in zip(sliced, [[1, 2, 3], [10, 11, 12], []]):
+        np.testing.assert_array_equal(actual, expected)
+    for starts, stops in [(-1, 2), (2, 1), (0, np.array([5, 4, 4]))]:
+        with pytest.raises(ValueError, match="slice_each requires"):
+            ragged.slice_each(starts, stops)
+
+
+@pytest.mark.parametrize("layout", ["array", "ragged"])
+def test_contiguous_covariates_match_lists(layout: str) -> None:
+    rng = np.random.default_rng(0)
+    num_series, train_len, test_len = 4, 30, 6
+    targets = rng.normal(size=(num_series, train_len))
+    num = rng.normal(size=(num_series, train_len + test_len))
+    cat = rng.integers(0, 5, size=(num_series, train_len + test_len))
+
+    def make(convert):
+        return xreg_lib.BatchedInContextXRegLinear(
+            targets=convert(targets),
+            train_lens=[train_len] * num_series,
+            test_lens=[test_len] * num_series,
+            train_dynamic_numerical_covariates={"x": convert(num[:, :train_len])},
+            test_dynamic_numerical_covariates={"x": convert(num[:, train_len:])},
+            train_dynamic_categorical_covariates={"c": convert(cat[:, :train_len])},
+            test_dynamic_categorical_covariates={"c": convert(cat[:, train_len:])},
+            static_categorical_covariates={"s": ["a", "b", "a", "c"]},
+        )
+
+    if layout == "array":
+        convert = np.ascontiguousarray
+    else:
+        convert = xreg_lib.RaggedArray.from_sequences
+    expected = make(lambda x: [list(v) for v in x]).fit(
+        ridge=1.0, debug_info=True, assert_covariates=True, assert_covariate_shapes=True
+    )
+    actual = make(convert).fit(
+        ridge=1.0, debug_info=True, assert_covariates=True, assert_covariate_shapes=True
+    )
+    for a, e in zip(actual[0] + actual[1], expected[0] + expected[1]):
+        np.testing.assert_array_equal(a, e)
+
+
+@pytest.mark.parametrize("chunk_size", [0, 2])
+def test_prepared_design_matches_fit(chunk_size: int) -> None:
+    xreg = _make_xreg(num_series=5)
+    expected, expected_context, *_ = xreg.fit(
+        ridge=1.0, chunk_size=chunk_size, debug_info=True
+    )
+
+    targets, xreg.targets = xreg.targets, None
+    design = xreg.prepare(
+        chunk_size=chunk_size, assert_covariates=True, assert_covariate_shapes=True
+    )
+    xreg.targets = targets
+    for _ in range(2):  # The design can be reused.
+        actual, actual_context, *_ = xreg.fit(
+            ridge=1.0, chunk_size=chunk_size, design=design, debug_info=True
+        )
+        for a, e in zip(actual + actual_context, expected + expected_context):
+            np.testing.assert_allclose(a, e, atol=1e-10)